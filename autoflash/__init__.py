@@ -1,2 +1,4 @@
 from .serial import Serial  # noqa
 from .network import Network  # noqa
+from .power import Power  # noqa
+from .limits import Limits  # noqa
@@ -0,0 +1,281 @@
+from .misc import sha256
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import mkdtemp
+from typing import Dict, List, Optional, Tuple
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(src: Path, dest: Path):
+    """make dest a copy-on-write clone of src; raises OSError if this is not
+    supported"""
+    with open(src, "rb") as src_f:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd, FICLONE, src_f.fileno())
+        except OSError:
+            os.unlink(dest)
+            raise
+        finally:
+            os.close(fd)
+
+
+def link_or_copy(src: Path, dest: Path) -> str:
+    """make dest have the same contents as src, without copying if possible;
+    returns the method used"""
+    try:
+        reflink(src, dest)
+        return "reflink"
+    except OSError:
+        pass
+
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+
+    shutil.copyfile(src, dest)
+    return "copy"
+
+
+def default_store_path() -> Path:
+    cache = os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")
+    return Path(cache) / "autoflash" / "artifacts"
+
+
+@dataclass
+class Artifact:
+    digest: str
+    path: Path
+    size: int
+
+
+class StagedFiles:
+    """a directory containing files from an ArtifactStore, with the given
+    names; the files are locked so that they are not evicted until close()"""
+
+    def __init__(self, store: "ArtifactStore", files: Dict[str, str]):
+        self.store = store
+        self.path = Path(mkdtemp(dir=store.staging_dir))
+        self.lock_fds: List[int] = []
+
+        try:
+            self.lock(self.path / ".lock")
+            for name, src_path in files.items():
+                artifact = store.add(src_path, self.lock_fds)
+
+                dest_path = self.path / name
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(artifact.path, dest_path)
+                except OSError:
+                    os.symlink(artifact.path, dest_path)
+        except BaseException:
+            self.close()
+            raise
+
+    def lock(self, path: Path):
+        fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+        self.lock_fds.append(fd)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        for fd in self.lock_fds:
+            os.close(fd)
+        self.lock_fds.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArtifactStore:
+    """a store of files named by their sha256, so that the same file can be
+    staged for several boots without copying it each time
+
+    Files are added by reflink or hardlink where possible, and are only
+    copied when the store is on a different filesystem. Files which have not
+    been used for max_age seconds are evicted, as are the least recently used
+    files when the total size is over max_size, unless they are staged.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        max_size: int = 2 * 1024**3,
+        max_age: float = 7 * 24 * 60 * 60,
+    ):
+        self.path = Path(path) if path is not None else default_store_path()
+        self.objects_dir = self.path / "objects"
+        self.staging_dir = self.path / "staging"
+        self.max_size = max_size
+        self.max_age = max_age
+        self.logger = logging.getLogger("artifacts")
+
+        # (path, device, inode, size, mtime) to digest, so that unchanged
+        # files are not hashed again
+        self.digests: Dict[Tuple[str, int, int, int, int], str] = {}
+        self.lock = threading.Lock()
+
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+
+    def digest(self, path: Path) -> str:
+        st = os.stat(path)
+        key = (str(path.resolve()), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            if key in self.digests:
+                return self.digests[key]
+        digest = sha256(path)
+        with self.lock:
+            self.digests[key] = digest
+        return digest
+
+    def add(self, src_path, lock_fds: Optional[List[int]] = None) -> Artifact:
+        """add a file to the store, returning the stored Artifact
+
+        If lock_fds is given, the stored file is locked against eviction
+        before this returns, and the file descriptor to close to unlock it is
+        appended to lock_fds.
+        """
+        src_path = Path(src_path)
+        digest = self.digest(src_path)
+        path = self.objects_dir / digest
+        meta_path = self.objects_dir / f"{digest}.meta"
+
+        with self.store_lock():
+            if path.exists() and not self.object_valid(path, meta_path):
+                self.logger.warning(f"{path} was modified; replacing it")
+                path.unlink()
+
+            if path.exists():
+                self.logger.debug(f"using stored {src_path} ({digest})")
+            else:
+                method = link_or_copy(src_path, path)
+                self.logger.debug(f"stored {src_path} by {method} ({digest})")
+                st = os.stat(path)
+                meta_path.write_text(f"{st.st_size} {st.st_mtime_ns}\n")
+
+            # the meta file mtime records when the artifact was last used
+            meta_path.touch()
+            if lock_fds is not None:
+                fd = os.open(path, os.O_RDONLY)
+                lock_fds.append(fd)
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            self.evict_locked()
+        return Artifact(digest, path, path.stat().st_size)
+
+    @staticmethod
+    def object_valid(path: Path, meta_path: Path) -> bool:
+        """check that the object has not been changed since it was stored,
+        which may happen if it is a hardlink to a file which was modified"""
+        try:
+            size, mtime_ns = map(int, meta_path.read_text().split())
+        except (OSError, ValueError):
+            return False
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns) == (size, mtime_ns)
+
+    def stage(self, files: Dict[str, str]) -> StagedFiles:
+        """stage files (a dict from name to local path) into a directory"""
+        return StagedFiles(self, files)
+
+    @staticmethod
+    def try_lock(path: Path) -> Optional[int]:
+        """lock path exclusively, returning a file descriptor to close, or
+        None if it is in use"""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    @contextmanager
+    def store_lock(self):
+        """lock the store against changes from other threads and processes"""
+        with self.lock:
+            with open(self.path / "lock", "a") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                yield
+
+    def evict(self):
+        """remove unused artifacts according to max_age and max_size, and
+        staging directories left behind by processes which died"""
+        with self.store_lock():
+            self.evict_locked()
+
+    def evict_locked(self):
+        now = time.time()
+
+        for staged in self.staging_dir.iterdir():
+            # new directories may not be locked yet
+            try:
+                if now - staged.stat().st_mtime < 60:
+                    continue
+            except FileNotFoundError:
+                continue
+            fd = self.try_lock(staged / ".lock")
+            if fd is not None:
+                self.logger.debug(f"removing stale staging directory {staged}")
+                shutil.rmtree(staged, ignore_errors=True)
+                os.close(fd)
+
+        objects = []
+        for meta_path in self.objects_dir.glob("*.meta"):
+            path = meta_path.with_suffix("")
+            try:
+                objects.append((meta_path.stat().st_mtime, path, path.stat().st_size))
+            except FileNotFoundError:
+                meta_path.unlink(missing_ok=True)
+
+        # oldest first
+        objects.sort()
+        total_size = sum(size for _used, _path, size in objects)
+
+        for used, path, size in objects:
+            if now - used <= self.max_age and total_size <= self.max_size:
+                break
+            fd = self.try_lock(path)
+            if fd is None:
+                continue
+            try:
+                self.logger.debug(f"evicting {path}")
+                path.unlink()
+                path.with_suffix(".meta").unlink(missing_ok=True)
+                total_size -= size
+            finally:
+                os.close(fd)
+
+
+_default_store: Optional[ArtifactStore] = None
+_default_store_lock = threading.Lock()
+
+
+def default_store() -> ArtifactStore:
+    """get the ArtifactStore used by default, which is shared between all
+    users in this process"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = ArtifactStore()
+        return _default_store
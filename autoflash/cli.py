@@ -8,14 +8,29 @@ from typing import (
     Union,
     Container,
     Optional,
+    Set,
 )
 import typing
+import asyncio
+import functools
 import inspect
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from contextvars import copy_context
 from dataclasses import dataclass
 import argparse
 from argparse import ArgumentParser, Namespace
+import logging
+import signal
 import sys
-from .exceptions import UserError
+import threading
+import time
+from . import metrics
+from .events import StepFinished, StepStarted, bus, open_sink
+from .exceptions import Timeout, UserError
+from .inventory import InventorySlot, load_inventory
+from .limits import Deadline, Limits, check_deadline, deadline, wake_on_cancel
+from .timing import Timeline, recording, span
 from .registry import Context, DeviceRegistry, Device
 
 
@@ -58,6 +73,10 @@ class ArgumentBase:
     def get_argument(self, parsed_args) -> Any:
         return getattr(parsed_args, self.param.name)
 
+    def parse_value(self, value: str) -> Any:
+        """parse a value given as a string outside of argparse"""
+        return self.get_type()(value)
+
 
 class BoolArg(ArgumentBase):
     def add_to_parser(self, parser: argparse._ActionsContainer, **kwargs):
@@ -80,6 +99,16 @@ class BoolArg(ArgumentBase):
             **kwargs,
         )
 
+    def parse_value(self, value: str) -> Any:
+        if value.lower() in ("1", "true", "yes"):
+            return True
+        elif value.lower() in ("0", "false", "no"):
+            return False
+        else:
+            raise UserError(
+                f"expected boolean value for {self.param.name}, got {value}"
+            )
+
 
 def is_optional(t: Type[Any]) -> bool:
     return (
@@ -131,10 +160,13 @@ class Step:
     func: Callable
     context_args: List[inspect.Parameter]
     option_args: List[ParameterInfo]
+    #: name of the device this step is for, if any
+    device: Optional[str]
 
-    def __init__(self, name: str, func: Callable):
+    def __init__(self, name: str, func: Callable, device: Optional[str] = None):
         self.name = name
         self.func = func  # type: ignore
+        self.device = device
 
         self.context_args = []
         self.option_args = []
@@ -147,6 +179,10 @@ class Step:
             else:
                 self.option_args.append(ParameterInfo(param))
 
+    @property
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.func)
+
     def make_parser(self) -> Tuple[ArgumentParser, Callable[[Namespace], Kwargs]]:
         p = ArgumentParser(
             prog=self.name, description=getattr(self.func, "__help__", None)
@@ -173,31 +209,84 @@ class ContextInfo:
         ]
 
 
+@dataclass
+class Slot:
+    """one device in a fleet run, with context options which override the
+    global ones (typically the serial port and interface)"""
+
+    name: str
+    device: CLIDevice
+    context_overrides: Kwargs
+
+
+@dataclass
+class SlotResult:
+    slot: Slot
+    error: Optional[Exception]
+    duration: float
+
+
+def current_slot() -> Optional[str]:
+    """get the name of the fleet slot being run by this thread, if any"""
+    return getattr(threading.current_thread(), "autoflash_slot", None)
+
+
+def set_current_slot(name: Optional[str]):
+    setattr(threading.current_thread(), "autoflash_slot", name)
+
+
+class SlotLogFilter(logging.Filter):
+    """adds a slot attribute to log records, containing the slot name in
+    brackets followed by a space in fleet runs, or an empty string"""
+
+    def filter(self, record):
+        slot = current_slot()
+        record.slot = f"[{slot}] " if slot is not None else ""
+        return True
+
+
 class Runner:
     def __init__(self, registry: DeviceRegistry):
-        self.devices = {
-            device.name: CLIDevice(
-                device=device,
-                steps={
-                    step_fn.__name__: Step(step_fn.__name__, step_fn)
-                    for step_fn in device.steps
-                },
-            )
-            for device in registry.devices
-        }
+        self.registry = registry
 
-        context_types = set(
-            arg.annotation
-            for device in self.devices.values()
-            for step in device.steps.values()
-            for arg in step.context_args
-        )
+        # devices are added as they are loaded from the registry
+        self.devices: Dict[str, CLIDevice] = {}
+        for device in registry.devices:
+            self.add_device(device)
+
+        context_types = list(registry.context_types)
+        for cli_device in self.devices.values():
+            for step in cli_device.steps.values():
+                for arg in step.context_args:
+                    if arg.annotation not in context_types:
+                        context_types.append(arg.annotation)
 
         self.context_types = [
             ContextInfo(context_type.__name__, context_type)
             for context_type in context_types
         ]
 
+        # deadlines for the step chains being run, which are cancelled by
+        # cancel()
+        self.runs: Set[Deadline] = set()
+        self.runs_lock = threading.Lock()
+        self.cancelled = False
+
+        # records spans for steps and the phases within them, if enabled
+        self.timeline: Optional[Timeline] = None
+        self.logger = logging.getLogger("runner")
+
+    def add_device(self, device: Device) -> CLIDevice:
+        cli_device = CLIDevice(
+            device=device,
+            steps={
+                step_fn.__name__: Step(step_fn.__name__, step_fn, device.name)
+                for step_fn in device.steps
+            },
+        )
+        self.devices[device.name] = cli_device
+        return cli_device
+
     def list_steps(self, device: CLIDevice):
         print(f"available steps for {device.device.name}:")
         for step in device.steps.values():
@@ -205,8 +294,8 @@ class Runner:
         sys.exit(0)
 
     def list_devices(self):
-        for device in self.devices.values():
-            print(device.device.architecture, device.device.name)
+        for architecture, name in self.registry.list_devices():
+            print(architecture, name)
         sys.exit(0)
 
     def parse_step_args(self, device: CLIDevice, step_args: List[str]):
@@ -251,10 +340,49 @@ class Runner:
             return self.devices[device_name]
         elif device_name == "list":
             self.list_devices()
-        else:
+
+        device = self.registry.get_device(device_name)
+        if device is None:
             raise UserError(
                 f"device {device_name} not known; use 'list' to show known devices"
             )
+        return self.add_device(device)
+
+    def get_context_option(self, name: str) -> ArgumentBase:
+        for ctx_type in self.context_types:
+            for option in ctx_type.option_args:
+                if option.name == name:
+                    return handle_arg_base(option)
+        raise UserError(f"unknown option {name}")
+
+    def parse_slot(self, name: str, spec: str) -> Slot:
+        """parse a slot specification, like
+        bt_homehub-v5a,serial-port=/dev/ttyUSB0,ifname=eth1"""
+        device_name, *options = spec.split(",")
+        device = self.get_device(device_name)
+
+        context_overrides = {}
+        for option in options:
+            option_name, sep, value = option.partition("=")
+            if not sep:
+                raise UserError(f"expected NAME=VALUE in slot, got {option}")
+            option_name = option_name.replace("-", "_")
+            arg = self.get_context_option(option_name)
+            context_overrides[option_name] = arg.parse_value(value)
+
+        return Slot(name, device, context_overrides)
+
+    def slot_from_inventory(self, inventory_slot: InventorySlot) -> Slot:
+        device = self.get_device(inventory_slot.device)
+
+        context_overrides = {}
+        for name, value in inventory_slot.options.items():
+            arg = self.get_context_option(name)
+            if isinstance(value, str) and arg.get_type() is not str:
+                value = arg.parse_value(value)
+            context_overrides[name] = value
+
+        return Slot(inventory_slot.name, device, context_overrides)
 
     def parse_and_run(self, args: List[str]):
         main_parser = ArgumentParser()
@@ -262,7 +390,63 @@ class Runner:
         context_args = self.add_context_args(main_parser)
 
         main_parser.add_argument(
-            "device", help="device name; use 'list' to show known devices"
+            "--slot",
+            action="append",
+            default=[],
+            metavar="DEVICE[,OPTION=VALUE...]",
+            help="device and options for one slot of a fleet run; "
+            "use with device name 'fleet'",
+        )
+        main_parser.add_argument(
+            "--inventory",
+            metavar="FILE",
+            help="TOML file listing the slots on a bench, for fleet runs and "
+            "scheduling",
+        )
+        main_parser.add_argument(
+            "--timing",
+            metavar="FILE",
+            help="write a JSON timeline of steps and the phases within them to "
+            "FILE, and print a summary",
+        )
+        main_parser.add_argument(
+            "--trace",
+            metavar="FILE",
+            help="write the timeline to FILE in Chrome trace event format, for "
+            "chrome://tracing or Perfetto",
+        )
+        main_parser.add_argument(
+            "--events",
+            metavar="FILE|unix:PATH",
+            help="write structured events (serial lines, DHCP and TFTP, steps, "
+            "upload progress) as JSON lines to FILE, or to a unix socket",
+        )
+        main_parser.add_argument(
+            "--log-lines",
+            action="store_true",
+            default=None,
+            help="log every line received and sent on serial, and output by "
+            "ssh; this is the default except with 'fleet', 'schedule' and "
+            "'daemon', as it is slow with many slots",
+        )
+        main_parser.add_argument(
+            "--no-log-lines",
+            action="store_false",
+            dest="log_lines",
+            help="don't log lines received and sent on serial, or ssh output",
+        )
+        main_parser.add_argument(
+            "--metrics",
+            metavar="[HOST:]PORT",
+            help="serve Prometheus metrics on http://HOST:PORT/metrics; HOST "
+            "defaults to 127.0.0.1",
+        )
+        main_parser.add_argument(
+            "device",
+            help="device name; use 'list' to show known devices, "
+            "'fleet' to run on all slots, 'schedule QUEUE_DIR' to run jobs "
+            "from QUEUE_DIR on inventory slots, or 'daemon SOCKET' to run "
+            "commands from autoflash-client",
         )
         main_parser.add_argument(
             "commands", metavar="command [arg ...] ...", nargs="..."
@@ -270,10 +454,86 @@ class Runner:
 
         main_args = main_parser.parse_args(args)
 
+        with ExitStack() as stack:
+            lines_logger = logging.getLogger("lines")
+            stack.callback(lines_logger.setLevel, lines_logger.level)
+            if main_args.log_lines is not None:
+                lines_logger.setLevel(
+                    logging.DEBUG if main_args.log_lines else logging.WARNING
+                )
+            elif main_args.device in ("fleet", "schedule", "daemon"):
+                lines_logger.setLevel(logging.WARNING)
+
+            if main_args.events is not None:
+                sink = open_sink(main_args.events)
+                stack.callback(sink.close)
+                bus.add_sink(sink)
+                stack.callback(bus.remove_sink, sink)
+            if main_args.metrics is not None:
+                stack.enter_context(metrics.MetricsServer(main_args.metrics))
+            self.run_with_timing(main_args, context_args)
+
+    def run_with_timing(self, main_args: Namespace, context_args):
+        if main_args.timing is not None or main_args.trace is not None:
+            self.timeline = Timeline()
+            try:
+                self.run_main(main_args, context_args)
+            finally:
+                self.write_timeline(main_args.timing, main_args.trace)
+        else:
+            self.run_main(main_args, context_args)
+
+    def write_timeline(self, timing_path: Optional[str], trace_path: Optional[str]):
+        assert self.timeline is not None
+        if timing_path is not None:
+            self.timeline.write_json(timing_path)
+        if trace_path is not None:
+            self.timeline.write_chrome_trace(trace_path)
+        print("timing summary:")
+        print(self.timeline.summary())
+
+    def run_main(self, main_args: Namespace, context_args):
         context_args_parsed = {
             ctx.type: get_args(main_args) for ctx, get_args in context_args
         }
 
+        slots = [
+            self.parse_slot(f"slot{i}", spec) for i, spec in enumerate(main_args.slot)
+        ]
+        if main_args.inventory is not None:
+            inventory = load_inventory(main_args.inventory)
+            slots.extend(self.slot_from_inventory(slot) for slot in inventory.slots)
+
+        if main_args.device == "fleet":
+            if not slots:
+                raise UserError("fleet runs need at least one --slot or --inventory")
+            self.run_fleet(slots, main_args.commands, context_args_parsed)
+            return
+        elif main_args.device == "schedule":
+            from .scheduler import Scheduler, JobQueueDir
+
+            if not slots:
+                raise UserError("scheduling needs at least one --slot or --inventory")
+            if len(main_args.commands) != 1:
+                raise UserError("usage: schedule QUEUE_DIR")
+            scheduler = Scheduler(self, slots, context_args_parsed)
+            scheduler.run_queue_dir(JobQueueDir(main_args.commands[0]))
+            return
+        elif main_args.device == "daemon":
+            from .daemon import Daemon
+
+            if not slots:
+                raise UserError("the daemon needs at least one --slot or --inventory")
+            if len(main_args.commands) != 1:
+                raise UserError("usage: daemon SOCKET")
+            Daemon(self, slots, context_args_parsed).serve(main_args.commands[0])
+            return
+        elif slots:
+            raise UserError(
+                "--slot and --inventory can only be used with 'fleet', 'schedule' "
+                "or 'daemon'"
+            )
+
         device = self.get_device(main_args.device)
 
         steps_and_args = self.parse_step_args(device, main_args.commands)
@@ -281,36 +541,276 @@ class Runner:
         self.run(steps_and_args, context_args_parsed)
 
     def run(self, steps_and_args, context_args_parsed):
-        required_contexts = set(
+        contexts = self.make_contexts(steps_and_args, context_args_parsed)
+
+        # contexts are exited (in reverse order) even if a step or entering a
+        # later context fails, times out or is cancelled
+        with ExitStack() as stack:
+            for ctx in contexts.values():
+                ctx.__enter__()
+                stack.callback(ctx.__exit__)
+
+            self.run_steps(
+                steps_and_args, contexts, self.make_limits(context_args_parsed)
+            )
+
+    def make_limits(self, context_args_parsed) -> Limits:
+        return Limits(**context_args_parsed.get(Limits, {}))
+
+    @contextmanager
+    def cancellable(self):
+        """run the with block under a deadline which is cancelled by
+        cancel()"""
+        with deadline(None, "run") as run_deadline:
+            with self.runs_lock:
+                self.runs.add(run_deadline)
+                if self.cancelled:
+                    run_deadline.cancel()
+            try:
+                yield
+            finally:
+                with self.runs_lock:
+                    self.runs.remove(run_deadline)
+
+    def cancel(self):
+        """cancel all step chains being run, and any started later; waits in
+        them raise Cancelled, so that their contexts are exited"""
+        with self.runs_lock:
+            self.cancelled = True
+            runs = list(self.runs)
+        for run_deadline in runs:
+            run_deadline.cancel()
+
+    def run_steps(self, steps_and_args, contexts, limits: Optional[Limits] = None):
+        """run steps with already-entered contexts"""
+        if limits is None:
+            limits = Limits()
+        self.bind_contexts(steps_and_args, contexts)
+
+        counting = self.counting(steps_and_args)
+        with self.cancellable(), recording(self.timeline), counting:
+            if any(step.is_async for step, _kwargs in steps_and_args):
+                asyncio.run(self.run_steps_async(steps_and_args, limits))
+            else:
+                for step, kwargs in steps_and_args:
+                    self.run_step(step, kwargs, limits)
+
+    @contextmanager
+    def counting(self, steps_and_args):
+        """count a run of steps as a flash in the metrics, if enabled"""
+        if not metrics.registry.enabled:
+            yield
+            return
+
+        device = steps_and_args[0][0].device if steps_and_args else None
+        labels = (device or "", metrics.slot_label(current_slot()))
+        metrics.flashes_started.inc(1, *labels)
+        try:
+            yield
+        except BaseException:
+            metrics.flashes_failed.inc(1, *labels)
+            raise
+        metrics.flashes_succeeded.inc(1, *labels)
+
+    @contextmanager
+    def reporting(self, step: Step):
+        """record a step in the timeline and metrics, log the time it took,
+        and emit events for its start and end"""
+        start = time.monotonic()
+        if bus.enabled:
+            bus.emit(StepStarted(step.name))
+        error = None
+        try:
+            with span(step.name, "step"):
+                yield
+        except BaseException as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            duration = time.monotonic() - start
+            if bus.enabled:
+                bus.emit(StepFinished(step.name, duration, error))
+            if metrics.registry.enabled:
+                metrics.step_duration.observe(
+                    duration,
+                    step.device or "",
+                    step.name,
+                    metrics.slot_label(current_slot()),
+                )
+        self.logger.info("%s took %.2fs", step.name, duration)
+
+    def run_step(self, step: Step, kwargs, limits: Limits):
+        with self.reporting(step), limits.step_deadline(step.name) as step_deadline:
+            try:
+                step.func(**kwargs)
+            except Timeout:
+                # report the step timing out rather than the wait it was in
+                step_deadline.check()
+                raise
+
+    async def run_step_async(self, step: Step, kwargs, limits: Limits):
+        with self.reporting(step), limits.step_deadline(step.name) as step_deadline:
+            try:
+                # wait_for also covers awaits which don't use the deadline
+                await asyncio.wait_for(step.func(**kwargs), limits.step_timeout)
+            except (Timeout, asyncio.TimeoutError):
+                step_deadline.check()
+                raise
+
+    async def run_steps_async(self, steps_and_args, limits: Limits):
+        """run steps on an event loop; async steps are awaited directly, while
+        sync steps are run in a worker thread so that they don't block it"""
+        # the worker thread is started from this thread after the contexts
+        # have been entered, so inherits any per-thread state they set up
+        # (like the network namespace)
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        assert task is not None
+
+        def cancel():
+            loop.call_soon_threadsafe(task.cancel)
+
+        with ThreadPoolExecutor(
+            max_workers=1, initializer=set_current_slot, initargs=(current_slot(),)
+        ) as executor, wake_on_cancel(cancel):
+            try:
+                for step, kwargs in steps_and_args:
+                    if step.is_async:
+                        await self.run_step_async(step, kwargs, limits)
+                    else:
+                        # in a copy of this context, to see the run deadline
+                        await loop.run_in_executor(
+                            executor,
+                            functools.partial(
+                                copy_context().run, self.run_step, step, kwargs, limits
+                            ),
+                        )
+            except asyncio.CancelledError:
+                # raises Cancelled if this was cancelled by cancel()
+                check_deadline()
+                raise
+
+    def run_fleet(
+        self, slots: List[Slot], step_args: List[str], context_args_parsed
+    ) -> List[SlotResult]:
+        """run the same steps on all slots in parallel, each in its own thread,
+        printing a summary at the end
+
+        raises UserError if any slot failed
+        """
+        # parse everything before starting, so that mistakes are found early
+        runs = [
+            (
+                slot,
+                self.parse_step_args(slot.device, list(step_args)),
+                self.get_slot_context_args(slot, context_args_parsed),
+            )
+            for slot in slots
+        ]
+
+        results: List[Optional[SlotResult]] = [None] * len(runs)
+
+        def run_slot(i, slot, steps_and_args, slot_context_args):
+            results[i] = self.run_slot(slot, steps_and_args, slot_context_args)
+
+        threads = [
+            threading.Thread(target=run_slot, name=run[0].name, args=(i, *run))
+            for i, run in enumerate(runs)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print("fleet summary:")
+        for result in results:
+            assert result is not None
+            status = "ok" if result.error is None else f"failed: {result.error}"
+            print(
+                f"  {result.slot.name} {result.slot.device.device.name}: "
+                f"{status} ({result.duration:.1f}s)"
+            )
+
+        n_failed = sum(1 for result in results if result and result.error)
+        if n_failed:
+            raise UserError(f"{n_failed} of {len(results)} slots failed")
+
+        return typing.cast(List[SlotResult], results)
+
+    def get_slot_context_args(self, slot: Slot, context_args_parsed):
+        """apply the context overrides in slot to the global context args"""
+        return {
+            ctx: {
+                name: slot.context_overrides.get(name, value)
+                for name, value in args.items()
+            }
+            for ctx, args in context_args_parsed.items()
+        }
+
+    def run_slot(self, slot: Slot, steps_and_args, context_args_parsed) -> SlotResult:
+        """run steps for slot in the current thread, logging any errors"""
+        set_current_slot(slot.name)
+        logger = logging.getLogger("fleet")
+        start = time.monotonic()
+        error: Optional[Exception] = None
+        try:
+            self.run(steps_and_args, context_args_parsed)
+        except UserError as e:
+            logger.error(str(e))
+            error = e
+        except Exception as e:
+            logger.exception("step failed")
+            error = e
+        finally:
+            set_current_slot(None)
+        return SlotResult(slot, error, time.monotonic() - start)
+
+    def required_contexts(self, steps_and_args) -> Set[Type[Context]]:
+        return set(
             arg.annotation
             for step, _kwargs in steps_and_args
             for arg in step.context_args
         )
 
-        contexts = {ctx: ctx(**context_args_parsed[ctx]) for ctx in required_contexts}
+    def make_contexts(self, steps_and_args, context_args_parsed):
+        """make the contexts required by steps"""
+        return {
+            # contexts not registered with the registry have no options
+            ctx: ctx(**context_args_parsed.get(ctx, {}))
+            for ctx in self.required_contexts(steps_and_args)
+        }
 
+    def bind_contexts(self, steps_and_args, contexts):
+        """add contexts to the step arguments"""
         for step, kwargs in steps_and_args:
             for ctx_arg in step.context_args:
                 kwargs[ctx_arg.name] = contexts[ctx_arg.annotation]
 
-        for ctx in contexts.values():
-            ctx.__enter__()
-
-        for step, kwargs in steps_and_args:
-            step.func(**kwargs)
-
-        for ctx in contexts.values():
-            ctx.__exit__()
-
 
 def main():
     from .devices import registry
     import sys
-    import logging
 
-    logging.basicConfig(level=logging.DEBUG)
+    handler = logging.StreamHandler()
+    handler.addFilter(SlotLogFilter())
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(slot)s%(levelname)s:%(name)s:%(message)s",
+        handlers=[handler],
+    )
 
     r = Runner(registry)
+
+    def on_sigterm(signum, frame):
+        # cancel steps running on other threads (in fleet runs etc.), and
+        # exit normally, so that contexts are cleaned up; cancelling wakes
+        # waits up, so is done on another thread in case this one is
+        # holding a lock they need
+        threading.Thread(target=r.cancel).start()
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
     try:
         r.parse_and_run(sys.argv[1:])
     except UserError as e:
@@ -0,0 +1,55 @@
+import json
+import os
+import socket
+import sys
+from typing import List, TextIO
+
+
+def resolve_paths(args: List[str]) -> List[str]:
+    """make paths to local files absolute, as the daemon has a different
+    working directory; only arguments which look like paths (containing / or
+    .) are considered, so that steps are not mistaken for files"""
+    return [
+        (
+            os.path.abspath(arg)
+            if ("/" in arg or "." in arg) and os.path.exists(arg)
+            else arg
+        )
+        for arg in args
+    ]
+
+
+def run_command(socket_path: str, args: List[str], log: TextIO = sys.stderr) -> bool:
+    """send a command to the daemon listening on socket_path, printing log
+    messages to log, and returning True if it succeeded"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(dict(args=resolve_paths(args))).encode() + b"\n")
+
+        with sock.makefile("rb") as f:
+            for line in f:
+                message = json.loads(line)
+                if "log" in message:
+                    print(message["log"], file=log)
+                else:
+                    if not message["ok"]:
+                        print(message["error"], file=log)
+                    return message["ok"]
+
+    print("connection to daemon closed unexpectedly", file=log)
+    return False
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(
+            f"usage: {sys.argv[0]} SOCKET [--slot NAME] DEVICE STEP [ARG ...] ...",
+            file=sys.stderr,
+        )
+        sys.exit(2)
+
+    sys.exit(0 if run_command(sys.argv[1], sys.argv[2:]) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+from . import iputils
+import os
+import pytest
+
+
+@pytest.fixture
+def veth():
+    """enter a new network namespace containing a veth pair, returning the
+    interface names"""
+    pyroute2 = pytest.importorskip("pyroute2")
+    import pyroute2.netns
+
+    name = f"aftest_{os.getpid()}"
+    try:
+        pyroute2.netns.create(name)
+    except OSError as e:
+        pytest.skip(f"can't create network namespaces: {e}")
+
+    try:
+        with iputils.in_netns(name):
+            with pyroute2.IPRoute() as ipr:
+                ipr.link("add", ifname="af0", kind="veth", peer="af1")
+            yield "af0", "af1"
+    finally:
+        pyroute2.netns.remove(name)
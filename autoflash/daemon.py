@@ -0,0 +1,259 @@
+from argparse import ArgumentParser
+from concurrent.futures import Future
+import json
+import logging
+import itertools
+import os
+import socket
+import socketserver
+import stat
+import threading
+from queue import Queue
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+from .cli import Runner, Slot, set_current_slot
+from .exceptions import UserError
+from .registry import Context
+
+logger = logging.getLogger("daemon")
+
+
+def current_request() -> Optional[int]:
+    """get the id of the daemon request being run by this thread, if any"""
+    return getattr(threading.current_thread(), "autoflash_request", None)
+
+
+def set_current_request(request_id: Optional[int]):
+    setattr(threading.current_thread(), "autoflash_request", request_id)
+
+
+class WarmSlot:
+    """a slot whose contexts are kept open between step chains
+
+    Everything for the slot happens on one worker thread, including entering
+    and exiting the contexts, so that per-thread state (like the network
+    namespace) stays in place between requests.
+    """
+
+    def __init__(self, runner: Runner, slot: Slot, context_args):
+        self.runner = runner
+        self.slot = slot
+        self.context_args = context_args
+
+        self.contexts: Dict[Type[Context], Context] = {}
+        self.requests: "Queue[Optional[Tuple[Any, int, Future]]]" = Queue()
+        # number of requests submitted but not finished
+        self.load = 0
+        self.load_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run, name=slot.name, daemon=True)
+        self.thread.start()
+
+    def submit(self, steps_and_args, request_id: int) -> Future:
+        """run steps_and_args after any earlier requests; while running,
+        current_request() returns request_id in the worker thread"""
+        future: Future = Future()
+        with self.load_lock:
+            self.load += 1
+        self.requests.put((steps_and_args, request_id, future))
+        return future
+
+    def run(self):
+        set_current_slot(self.slot.name)
+        while True:
+            request = self.requests.get()
+            if request is None:
+                self.close_contexts()
+                return
+
+            steps_and_args, request_id, future = request
+            set_current_request(request_id)
+            try:
+                self.open_contexts(steps_and_args)
+                self.runner.run_steps(
+                    steps_and_args,
+                    self.contexts,
+                    self.runner.make_limits(self.context_args),
+                )
+            except Exception as e:
+                # start again with fresh contexts after a failure, as they may
+                # be in an unknown state
+                self.close_contexts()
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+            finally:
+                set_current_request(None)
+                with self.load_lock:
+                    self.load -= 1
+
+    def open_contexts(self, steps_and_args):
+        for ctx_type in self.runner.required_contexts(steps_and_args):
+            if ctx_type not in self.contexts:
+                ctx = ctx_type(**self.context_args[ctx_type])
+                ctx.__enter__()
+                self.contexts[ctx_type] = ctx
+
+    def close_contexts(self):
+        for ctx in reversed(list(self.contexts.values())):
+            try:
+                ctx.__exit__()
+            except Exception:
+                logger.exception(f"error closing {type(ctx).__name__}")
+        self.contexts.clear()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+class ClientLogHandler(logging.Handler):
+    """sends log records made while running a request to the client which
+    sent it
+
+    Records are matched by request rather than slot, so that a client waiting
+    for a busy slot doesn't get the log of the request before it.
+    """
+
+    def __init__(self, request_id: int, send: Callable[[Dict[str, Any]], None]):
+        super().__init__()
+        self.request_id = request_id
+        self.send = send
+        self.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+
+    def emit(self, record):
+        if current_request() == self.request_id:
+            try:
+                self.send(dict(log=self.format(record)))
+            except OSError:
+                pass
+
+
+class Daemon:
+    """runs step chains sent by clients on warm slots
+
+    Clients connect to a unix socket and send a JSON object with an args key
+    holding a command line like "[--slot NAME] DEVICE STEP [ARG ...] ...";
+    the daemon replies with JSON lines holding log messages ({"log": ...}),
+    then the result ({"ok": ..., "error": ...}).
+
+    The contexts used by steps (serial port readers and network namespaces)
+    are kept warm. TFTP servers (dnsmasq or TftpServer) are not: boot steps
+    start them with the files for that command, and stop them when done.
+    """
+
+    def __init__(self, runner: Runner, slots: List[Slot], context_args_parsed):
+        self.runner = runner
+        self.warm_slots = {
+            slot.name: WarmSlot(
+                runner, slot, runner.get_slot_context_args(slot, context_args_parsed)
+            )
+            for slot in slots
+        }
+        self.request_ids = itertools.count()
+
+    def choose_slot(self, device_name: str, slot_name: Optional[str]) -> WarmSlot:
+        if slot_name is not None:
+            if slot_name not in self.warm_slots:
+                raise UserError(f"unknown slot {slot_name}")
+            warm_slot = self.warm_slots[slot_name]
+            if warm_slot.slot.device.device.name != device_name:
+                raise UserError(f"slot {slot_name} is not a {device_name}")
+            return warm_slot
+
+        matching = [
+            warm_slot
+            for warm_slot in self.warm_slots.values()
+            if warm_slot.slot.device.device.name == device_name
+        ]
+        if not matching:
+            raise UserError(f"no slot has device {device_name}")
+        return min(matching, key=lambda warm_slot: warm_slot.load)
+
+    def handle(self, args: List[str], send: Callable[[Dict[str, Any]], None]):
+        """run a command from a client, sending log messages and the result"""
+        try:
+            parser = ArgumentParser(prog="autoflash-client")
+            parser.add_argument("--slot", help="name of slot to run on")
+            parser.add_argument("device")
+            parser.add_argument(
+                "commands", metavar="command [arg ...] ...", nargs="..."
+            )
+            try:
+                parsed_args = parser.parse_args(args)
+                warm_slot = self.choose_slot(parsed_args.device, parsed_args.slot)
+                steps_and_args = self.runner.parse_step_args(
+                    warm_slot.slot.device, parsed_args.commands
+                )
+            except SystemExit:
+                raise UserError("invalid arguments; run them locally for details")
+
+            request_id = next(self.request_ids)
+            handler = ClientLogHandler(request_id, send)
+            logging.getLogger().addHandler(handler)
+            try:
+                warm_slot.submit(steps_and_args, request_id).result()
+            finally:
+                logging.getLogger().removeHandler(handler)
+        except Exception as e:
+            send(dict(ok=False, error=str(e)))
+        else:
+            send(dict(ok=True, error=None))
+
+    def serve(self, socket_path: str):
+        """serve requests on a unix socket at socket_path until interrupted"""
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline())
+                send_lock = threading.Lock()
+
+                def send(message):
+                    with send_lock:
+                        self.wfile.write(json.dumps(message).encode() + b"\n")
+
+                daemon.handle(request["args"], send)
+
+        try:
+            remove_stale_socket(socket_path)
+        except BaseException:
+            self.close()
+            raise
+
+        with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+            self.server = server
+            logger.info(f"listening on {socket_path}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.close()
+                os.unlink(socket_path)
+
+    def close(self):
+        for warm_slot in self.warm_slots.values():
+            warm_slot.close()
+
+
+def remove_stale_socket(socket_path: str):
+    """remove a socket left at socket_path by a daemon which didn't exit
+    cleanly, raising UserError if something else is there, or if another
+    daemon is listening on it"""
+    try:
+        mode = os.stat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise UserError(f"{socket_path} exists and is not a socket")
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            pass
+        else:
+            raise UserError(f"another daemon is listening on {socket_path}")
+
+    logger.info(f"removing stale socket {socket_path}")
+    os.unlink(socket_path)
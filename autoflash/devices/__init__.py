@@ -1,8 +1,16 @@
 from ..registry import DeviceRegistry
+from .. import Serial, Network, Power, Limits
 
 registry = DeviceRegistry(__name__)
 
-registry.add_from_module(".lantiq.bt_homehub_v5a")
-registry.add_from_module(".lantiq.netgear_dm200")
-registry.add_from_module(".realtek.gs1900_8hp_v2")
-registry.add_from_module(".mikrotik.generic")
+registry.add_context(Serial)
+registry.add_context(Network)
+registry.add_context(Power)
+registry.add_context(Limits)
+
+registry.add_lazy("lantiq", "bt_homehub-v5a", ".lantiq.bt_homehub_v5a")
+registry.add_lazy("lantiq", "netgear_dm200", ".lantiq.netgear_dm200")
+registry.add_lazy("realtek", "zyxel_gs1900-8hp-v2", ".realtek.gs1900_8hp_v2")
+registry.add_lazy("generic", "routerboard_generic", ".mikrotik.generic")
+
+registry.add_entry_points()
@@ -1,34 +1,74 @@
+from ...exceptions import UserError
 from ...registry import Device
-from ... import Serial, Network
+from ... import Serial, Network, Power, Limits
 from ...dnsmasq import Dnsmasq
+from ...tftp import TftpServer
 from ...ssh import do_sysupgrade_ssh, wait_for_ssh
+from ...flash import boot_then_sysupgrade
+from ...limits import retry
 
 device = Device("lantiq", "netgear_dm200")
 
 
 @device.register_step
-def get_boot_console(serial: Serial):
+def power_cycle(power: Power, off_time: float = 2.0):
+    power.cycle(off_time)
+
+
+@device.register_step
+def get_boot_console(serial: Serial, limits: Limits):
     serial.setup(115200)
 
-    serial.wait_for_partial(b"Hit any key to stop autoboot:")
-    serial.write(b"a")
-    serial.wait_for_partial(b"VR9 #")
+    # the prompt may have been printed just before this step (by an earlier
+    # get_boot_console, for example), in which case we're already there; an
+    # older one may be from before a power cycle
+    index, _match = serial.expect(
+        [b"Hit any key to stop autoboot:", b"VR9 #"],
+        partial=True,
+        start=serial.since(1.0),
+    )
+    # don't type into an existing prompt, but check that it's still live
+    key = b"a" if index == 0 else b"\n"
+
+    def interrupt():
+        serial.write(key)
+        serial.wait_for_partial(b"VR9 #", timeout=limits.retry_wait_timeout())
+
+    retry(interrupt, limits.retries, "interrupting U-Boot")
 
 
 @device.register_step
-def boot(serial: Serial, network: Network, initramfs: str, failsafe: bool = False):
+def boot(
+    serial: Serial,
+    network: Network,
+    limits: Limits,
+    initramfs: str,
+    failsafe: bool = False,
+    builtin_tftp: bool = False,
+):
     serial.setup(115200)
-    get_boot_console(serial)
+    get_boot_console(serial, limits)
 
     network.setup_ipv4("192.168.1.2")
-    with Dnsmasq(tftp={"initramfs.bin": initramfs}):
-        serial.write(
-            b"setenv ipaddr 192.168.1.1;"
-            b"setenv serverip 192.168.1.2;"
-            b"tftpboot 0x82000000 initramfs.bin;"
-            b"bootm 0x82000000\n"
-        )
-        serial.wait_for(b"done$")
+    tftp = {"initramfs.bin": initramfs}
+    with TftpServer(tftp=tftp) if builtin_tftp else Dnsmasq(tftp=tftp):
+
+        def load():
+            serial.write(
+                b"setenv ipaddr 192.168.1.1;"
+                b"setenv serverip 192.168.1.2;"
+                b"tftpboot 0x82000000 initramfs.bin\n"
+            )
+            index, match = serial.expect(
+                [b"done$", b"TFTP error", b"Retry count exceeded"]
+            )
+            # back to the prompt before trying again or booting
+            serial.wait_for_partial(b"VR9 #", timeout=limits.retry_wait_timeout())
+            if index != 0:
+                raise UserError(f"failed to load initramfs: {match.string!r}")
+
+        retry(load, limits.retries, "loading initramfs")
+        serial.write(b"bootm 0x82000000\n")
 
     if failsafe:
         serial.wait_for(
@@ -40,11 +80,39 @@ def boot(serial: Serial, network: Network, initramfs: str, failsafe: bool = Fals
 @device.register_step
 def sysupgrade(network: Network, sysupgrade: str, options: str = "-v"):
     network.setup_ipv4("192.168.1.2")
-    wait_for_ssh("192.168.1.1")
+    network.wait_for_neighbour("192.168.1.1")
+    wait_for_ssh("192.168.1.1", name=device.name)
     do_sysupgrade_ssh(
         "192.168.1.1",
         sysupgrade,
         options=options,
+        session=network.ssh_session(),
+    )
+
+
+@device.register_step
+def flash(
+    serial: Serial,
+    network: Network,
+    limits: Limits,
+    initramfs: str,
+    sysupgrade: str,
+    options: str = "-v",
+    builtin_tftp: bool = False,
+):
+    """boot initramfs then sysupgrade, overlapping the two"""
+
+    def boot_initramfs():
+        boot(serial, network, limits, initramfs, builtin_tftp=builtin_tftp)
+
+    boot_then_sysupgrade(
+        serial,
+        network,
+        boot_initramfs,
+        "192.168.1.1",
+        sysupgrade,
+        options=options,
+        name=device.name,
     )
 
 
@@ -1,6 +1,6 @@
 from ...registry import Device
 from ... import Network
-from ...dnsmasq import Dnsmasq
+from ...dnsmasq import DhcpHost, Dnsmasq
 from ...ssh import do_sysupgrade_ssh, wait_for_ssh
 from ... import ssh
 import re
@@ -11,10 +11,16 @@ device = Device("generic", "routerboard_generic")
 @device.register_step
 def get_key(network: Network, fname: str):
     network.setup_ipv4("192.168.88.10")
-    ssh.wait_for_ssh("192.168.88.1")
+    network.wait_for_neighbour("192.168.88.1")
+    ssh.wait_for_ssh("192.168.88.1", name=device.name)
 
-    ssh.run_command("admin@192.168.88.1", "/system license output".split())
-    file_list_str = ssh.run_command("admin@192.168.88.1", "/file print".split())
+    session = network.ssh_session()
+    ssh.run_command(
+        "admin@192.168.88.1", "/system license output".split(), session=session
+    )
+    file_list_str = ssh.run_command(
+        "admin@192.168.88.1", "/file print".split(), session=session
+    )
 
     # parse key file from listing
     remote_fname = None
@@ -25,23 +31,25 @@ def get_key(network: Network, fname: str):
 
     assert remote_fname is not None
 
-    ssh.scp_file("admin@192.168.88.1", remote_fname, fname)
+    ssh.scp_file("admin@192.168.88.1", remote_fname, fname, session=session)
+
+
+boot_message = """
+To start the TFTP bootloader:
+    - power-cycle or reset the device
+    - immediately hold the reset button (before lights turn on)
+    - wait for a light to:
+        - turn on for 5 seconds
+        - flash for 5 seconds
+        - stay on for 5 seconds
+        - turn off
+    - release the reset button
+"""
 
 
 @device.register_step
 def boot(network: Network, initramfs: str):
-    message = """
-    To start the TFTP bootloader:
-        - power-cycle or reset the device
-        - immediately hold the reset button (before lights turn on)
-        - wait for a light to:
-            - turn on for 5 seconds
-            - flash for 5 seconds
-            - stay on for 5 seconds
-            - turn off
-        - release the reset button
-    """
-    print(message)
+    print(boot_message)
     network.setup_ipv4("192.168.1.2")
     with Dnsmasq(
         tftp={"initramfs.bin": initramfs},
@@ -54,12 +62,35 @@ def boot(network: Network, initramfs: str):
     print("for failsafe, press reset button once light starts to flash")
 
 
+@device.register_step
+def boot_many(network: Network, initramfs: str, macs: str):
+    """boot several devices on the same network, with MAC addresses given as
+    a comma-separated list"""
+    print(boot_message)
+    network.setup_ipv4("192.168.1.2")
+    mac_list = [mac.strip() for mac in macs.split(",")]
+    with Dnsmasq(
+        tftp={"initramfs.bin": initramfs},
+        dhcp="192.168.1.100,192.168.1.200",
+        hosts=[
+            DhcpHost(mac, f"192.168.1.{100 + i}", "initramfs.bin")
+            for i, mac in enumerate(mac_list)
+        ],
+        bootp=True,
+    ) as dnsmasq:
+        for mac in mac_list:
+            sent = dnsmasq.wait_for_tftp("initramfs.bin", mac=mac)
+            print(f"sent initramfs to {mac} ({sent.address})")
+
+
 @device.register_step
 def sysupgrade(network: Network, sysupgrade: str, options: str = "-v"):
     network.setup_ipv4("192.168.1.2")
-    wait_for_ssh("192.168.1.1")
+    network.wait_for_neighbour("192.168.1.1")
+    wait_for_ssh("192.168.1.1", name=device.name)
     do_sysupgrade_ssh(
         "192.168.1.1",
         sysupgrade,
         options=options,
+        session=network.ssh_session(),
     )
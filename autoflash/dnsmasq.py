@@ -1,103 +1,289 @@
-from typing import Optional
+from .artifacts import ArtifactStore, StagedFiles, default_store
+from . import metrics
+from .events import bus, thread_slot
+from .exceptions import Timeout, UserError
+from .limits import check_deadline, limit_timeout, notify_on_cancel, run_in_executor
+from .timing import Span, Timeline, current_timeline
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, List, Optional, Type, TypeVar
 from tempfile import TemporaryDirectory
-import shutil
 from pathlib import Path
 import subprocess
 import logging
 import time
 import getpass
 import threading
-from queue import Queue
-import os
+import re
 
-responder_script = """#!/bin/bash
-fifo="{fifo}"
+# log lines look like "dnsmasq-tftp: sent ...", or, if written by the log
+# process, "Oct 17 12:00:00 dnsmasq-tftp[123]: sent ..."
+log_line_re = re.compile(r"(?:^|\s)dnsmasq(?:-(\w+))?(?:\[\d+\])?: (.*)$")
+tftp_sent_re = re.compile(r"sent (.*) to (\S+)$")
+dhcp_ack_re = re.compile(r"(DHCPACK|BOOTP)\((\S+)\) (\S+) (\S+)(?: (\S+))?$")
 
-(
-    for arg in "$@"; do
-        echo "arg $arg"
-    done
 
-    env | grep ^DNSMASQ | while read var; do
-        echo "var $var"
-    done
+@dataclass
+class DnsmasqEvent:
+    #: time.time() when the event was received
+    time: float
 
-    echo end
-) >> $fifo
-"""
 
+@dataclass
+class DhcpLease(DnsmasqEvent):
+    interface: str
+    address: str
+    mac: str
+    hostname: Optional[str]
 
-class ReaderThread(threading.Thread):
-    def __init__(self, fifo_path, queue):
-        self.fifo_path = fifo_path
-        self.queue = queue
 
-        super().__init__()
+@dataclass
+class TftpSent(DnsmasqEvent):
+    path: Path
+    address: str
+
+
+def parse_log_line(line: str, now: float) -> Optional[DnsmasqEvent]:
+    """parse an event from a line of dnsmasq log output"""
+    log_match = log_line_re.search(line)
+    if log_match is None:
+        return None
+    facility, message = log_match.groups()
+
+    if facility == "tftp":
+        match = tftp_sent_re.match(message)
+        if match is not None:
+            return TftpSent(now, Path(match.group(1)), match.group(2))
+    elif facility == "dhcp":
+        match = dhcp_ack_re.match(message)
+        if match is not None:
+            _kind, interface, address, mac, hostname = match.groups()
+            return DhcpLease(now, interface, address, mac, hostname)
+
+    return None
+
+
+EventT = TypeVar("EventT", bound=DnsmasqEvent)
+
+
+class LogReaderThread(threading.Thread):
+    """read dnsmasq's log output (on stderr), passing it on to a logger and
+    events to on_event, and detect when it has started (after binding its
+    sockets) or exited"""
+
+    def __init__(self, stream, logger, on_event):
+        self.stream = stream
+        self.logger = logger
+        self.on_event = on_event
+        self.started = False
+        self.done = threading.Event()
+        self.lines: Deque[str] = deque(maxlen=20)
+
+        super().__init__(daemon=True)
 
     def run(self):
-        while True:
-            with open(self.fifo_path, "r") as f:
-                contents = f.read()
-                args = []
-                variables = {}
-                for line in contents.splitlines(False):
-                    cmd, sep, rest = line.partition(" ")
-
-                    if cmd == "quit":
-                        return
-                    elif cmd == "arg":
-                        args.append(rest)
-                    elif cmd == "var":
-                        name, value = rest.split("=", 1)
-                        variables[name] = value
-                    elif cmd == "end":
-                        self.queue.put((args.copy(), variables.copy()))
-                        args.clear()
-                        variables.clear()
-
-    def quit(self):
-        with open(self.fifo_path, "w") as f:
-            f.write("quit\n")
-        self.join()
+        for line in self.stream:
+            now = time.time()
+            line = line.rstrip("\n")
+            self.lines.append(line)
+            self.logger.debug(line)
+
+            if not self.started:
+                if "started, version" in line:
+                    self.started = True
+                    self.done.set()
+                continue
+
+            event = parse_log_line(line, now)
+            if event is not None:
+                self.on_event(event)
+        self.done.set()
+
+
+@dataclass
+class DhcpHost:
+    """DHCP configuration for one client, identified by MAC address"""
+
+    mac: str
+    address: Optional[str] = None
+    boot_file: Optional[str] = None
+
+
+@dataclass
+class DhcpRange:
+    """a DHCP range, like "192.168.1.100,192.168.1.200", with an optional boot
+    file for clients in it; dnsmasq picks the range on the subnet of the
+    interface that the request arrived on, so this can be used to serve a
+    different file on each interface"""
+
+    range: str
+    boot_file: Optional[str] = None
 
 
 class Dnsmasq:
-    def __init__(self, tftp: dict = {}, dhcp=None, dhcp_boot=None, bootp=False):
+    """run dnsmasq to serve files over TFTP, and optionally DHCP/BOOTP
+
+    tftp is a dict from names to serve to local paths. dhcp is a DHCP range
+    (a string) to serve, and dhcp_boot is the boot file for all clients.
+
+    To boot several devices from one server, boot files can be assigned per
+    range (one per interface), or per client with hosts. wait_for_dhcp and
+    wait_for_tftp can then wait for a particular client. Events are kept
+    for the lifetime of the server, so a client which finished before the
+    wait started is still found.
+    """
+
+    def __init__(
+        self,
+        tftp: dict = {},
+        dhcp=None,
+        dhcp_boot=None,
+        bootp=False,
+        store: Optional[ArtifactStore] = None,
+        ranges: List[DhcpRange] = [],
+        hosts: List[DhcpHost] = [],
+    ):
         self.tftp = tftp
         self.dhcp = dhcp
         self.dhcp_boot = dhcp_boot
         self.bootp = bootp
+        self.store = store
+        self.ranges = ranges
+        self.hosts = hosts
+        self.events: List[DnsmasqEvent] = []
+        self.events_changed = threading.Condition()
         self.tmpdir: Optional[TemporaryDirectory[str]] = None
-        self.dnsmasq = None
+        self.staged: Optional[StagedFiles] = None
+        self.process: Optional[subprocess.Popen] = None
+        self.startup_time: Optional[float] = None
         self.logger = logging.getLogger("dnsmasq")
+        # the span covering the time dnsmasq is running, if timing is enabled
+        self.timeline: Optional[Timeline] = None
+        self.span: Optional[Span] = None
+        # events are added on the log reader thread, so are emitted with the
+        # slot of the thread which started dnsmasq
+        self.slot: Optional[str] = None
 
-        if self.dhcp_boot is not None:
-            assert self.dhcp is not None
+        if self.dhcp_boot is not None or self.hosts:
+            assert self.dhcp is not None or self.ranges
 
-    def wait_for_tftp(self, filename=None):
-        while True:
-            args, env = self.queue.get()
-            if args[0] == "tftp":
-                size, address, path = args[1:]
+    def add_event(self, event: DnsmasqEvent):
+        with self.events_changed:
+            self.events.append(event)
+            self.events_changed.notify_all()
+        if bus.enabled:
+            bus.emit(event, self.slot)
+        if metrics.registry.enabled:
+            metrics.dnsmasq_events.inc(
+                1, type(event).__name__, metrics.slot_label(self.slot)
+            )
 
-                if filename is None or self.tftp_root / filename == Path(path):
-                    return
+        if self.span is not None:
+            args = {k: str(v) for k, v in vars(event).items() if k != "time"}
+            self.record(type(event).__name__, **args)
 
-    def __enter__(self):
-        self.tmpdir = TemporaryDirectory("dnsmasq")
-        pid_file = Path(self.tmpdir.name) / "dnsmasq.pid"
+    def record(self, name: str, **args):
+        """record an instant in the dnsmasq span, if timing is enabled; this is
+        called from the log reader thread, so the span is given explicitly"""
+        if self.timeline is not None and self.span is not None:
+            self.timeline.instant(
+                name, "dnsmasq", parent=self.span, slot=self.span.slot, **args
+            )
+
+    def wait_for_event(
+        self,
+        event_type: Type[EventT],
+        matches,
+        timeout: Optional[float] = None,
+        start: int = 0,
+    ) -> EventT:
+        """wait for an event of event_type for which matches(event) is True,
+        looking at events from index start onwards"""
+        timeout = limit_timeout(timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with notify_on_cancel(self.events_changed), self.events_changed:
+            i = start
+            while True:
+                for event in self.events[i:]:
+                    if isinstance(event, event_type) and matches(event):
+                        return event
+                i = len(self.events)
+                check_deadline()
+
+                if deadline is None:
+                    self.events_changed.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Timeout(
+                            f"timed out after {timeout}s waiting for "
+                            f"{event_type.__name__}"
+                        )
+                    self.events_changed.wait(remaining)
+
+    def mark(self) -> int:
+        """get an index to pass as start to wait methods, to wait for only
+        events after now"""
+        with self.events_changed:
+            return len(self.events)
+
+    def wait_for_tftp(
+        self,
+        filename: Optional[str] = None,
+        timeout: Optional[float] = None,
+        mac: Optional[str] = None,
+        start: int = 0,
+    ) -> TftpSent:
+        """wait for a TFTP transfer (of filename, if specified, and to the
+        client with the given MAC address, if specified) to finish"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        address = None
+        if mac is not None:
+            address = self.wait_for_dhcp(mac, timeout, start).address
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+
+        def matches(event):
+            if filename is not None and self.tftp_root / filename != event.path:
+                return False
+            return address is None or event.address == address
+
+        return self.wait_for_event(TftpSent, matches, timeout, start)
+
+    async def wait_for_tftp_async(
+        self,
+        filename: Optional[str] = None,
+        timeout: Optional[float] = None,
+        mac: Optional[str] = None,
+        start: int = 0,
+    ) -> TftpSent:
+        return await run_in_executor(self.wait_for_tftp, filename, timeout, mac, start)
 
-        self.fifo = Path(self.tmpdir.name) / "fifo"
-        os.mkfifo(self.fifo)
+    def wait_for_dhcp(
+        self, mac: Optional[str] = None, timeout: Optional[float] = None, start: int = 0
+    ) -> DhcpLease:
+        """wait for a DHCP (or BOOTP) lease to be given out (to mac, if
+        specified)"""
+        return self.wait_for_event(
+            DhcpLease,
+            lambda event: mac is None or event.mac.lower() == mac.lower(),
+            timeout,
+            start,
+        )
 
-        self.queue = Queue()
-        self.reader_thread = ReaderThread(self.fifo, self.queue)
-        self.reader_thread.start()
+    async def wait_for_dhcp_async(
+        self, mac: Optional[str] = None, timeout: Optional[float] = None, start: int = 0
+    ) -> DhcpLease:
+        return await run_in_executor(self.wait_for_dhcp, mac, timeout, start)
 
-        script_f = Path(self.tmpdir.name) / "script"
-        with open(script_f, "w") as f:
-            f.write(responder_script.format(fifo=self.fifo))
-        script_f.chmod(0o777)
+    def __enter__(self):
+        self.slot = thread_slot()
+        self.timeline = current_timeline()
+        if self.timeline is not None:
+            self.span = self.timeline.begin("dnsmasq", "dnsmasq")
+
+        self.tmpdir = TemporaryDirectory("dnsmasq")
+        pid_file = Path(self.tmpdir.name) / "dnsmasq.pid"
 
         args = [
             "dnsmasq",
@@ -106,21 +292,33 @@ class Dnsmasq:
             "--keep-in-foreground",
             "--log-facility=-",
             "--user=" + getpass.getuser(),
-            f"--dhcp-script={script_f}",
         ]
 
         if self.dhcp is not None:
             args.append(f"--dhcp-range={self.dhcp}")
 
         if self.tftp:
-            self.tftp_root = Path(self.tmpdir.name) / "tftp"
-            for name, src_path in self.tftp.items():
-                dest_path = self.tftp_root / name
-                dest_path.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy(src_path, dest_path)
+            # link files from the store rather than copying them each time
+            store = self.store if self.store is not None else default_store()
+            self.staged = store.stage(self.tftp)
+            self.tftp_root = self.staged.path
 
             args.extend(["--enable-tftp", f"--tftp-root={self.tftp_root}"])
 
+        # tagged boot files take priority over the untagged dhcp_boot
+        for i, dhcp_range in enumerate(self.ranges):
+            args.append(f"--dhcp-range=set:range{i},{dhcp_range.range}")
+            if dhcp_range.boot_file is not None:
+                args.append(f"--dhcp-boot=tag:range{i},{dhcp_range.boot_file}")
+
+        for i, host in enumerate(self.hosts):
+            host_arg = f"--dhcp-host={host.mac},set:host{i}"
+            if host.address is not None:
+                host_arg += f",{host.address}"
+            args.append(host_arg)
+            if host.boot_file is not None:
+                args.append(f"--dhcp-boot=tag:host{i},{host.boot_file}")
+
         if self.dhcp_boot:
             args.append(f"--dhcp-boot={self.dhcp_boot}")
 
@@ -128,24 +326,48 @@ class Dnsmasq:
             args.append("--bootp-dynamic")
 
         self.logger.debug(f"running {' '.join(args)}")
-        self.process = subprocess.Popen(args)
+        start_time = time.monotonic()
+        self.process = subprocess.Popen(
+            args, stderr=subprocess.PIPE, text=True, errors="replace"
+        )
+        self.log_reader = LogReaderThread(
+            self.process.stderr, self.logger, self.add_event
+        )
+        self.log_reader.start()
+
+        if not self.log_reader.done.wait(timeout=30):
+            self.__exit__(None, None, None)
+            raise UserError("dnsmasq did not start within 30s")
+        if not self.log_reader.started:
+            returncode = self.process.wait()
+            self.log_reader.join()
+            output = "\n".join(self.log_reader.lines)
+            self.__exit__(None, None, None)
+            raise UserError(f"dnsmasq failed to start ({returncode}):\n{output}")
 
-        for _i in range(30):
-            if pid_file.exists():
-                break
-            self.logger.debug("waiting for dnsmasq to start")
-            time.sleep(1)
-        else:
-            raise Exception("dnsmasq failed to start")
+        self.startup_time = time.monotonic() - start_time
+        self.logger.debug(f"dnsmasq started in {self.startup_time * 1000:.1f}ms")
+        self.record("started", startup_time=self.startup_time)
+        if metrics.registry.enabled:
+            metrics.dnsmasq_startup.observe(
+                self.startup_time, metrics.slot_label(self.slot)
+            )
 
         return self
 
     def __exit__(self, *exc):
-        self.reader_thread.quit()
-
         if self.process is not None:
             self.process.kill()
             self.process.wait()
+            self.log_reader.join()
+            self.process = None
+
+        if self.staged is not None:
+            self.staged.close()
 
         if self.tmpdir is not None:
             self.tmpdir.cleanup()
+
+        if self.span is not None:
+            self.span.end = time.monotonic()
+            self.span = None
@@ -0,0 +1,186 @@
+from dataclasses import dataclass, fields, is_dataclass
+from pathlib import Path
+from queue import Full, Queue
+from typing import Any, List, Optional, Tuple
+import json
+import logging
+import socket
+import threading
+import time
+from .exceptions import UserError
+
+# a process-wide bus for structured events, written as JSON lines to sinks
+#
+# emitting is cheap, and free when there are no sinks: callers check
+# bus.enabled before making an event, and events are only converted to JSON
+# on the sink's writer thread, so nothing is formatted on hot paths like
+# serial reception
+
+
+@dataclass
+class SerialRx:
+    port: str
+    data: bytes
+
+
+@dataclass
+class SerialTx:
+    port: str
+    data: bytes
+
+
+@dataclass
+class StepStarted:
+    step: str
+
+
+@dataclass
+class StepFinished:
+    step: str
+    duration: float
+    error: Optional[str] = None
+
+
+@dataclass
+class SshOutput:
+    address: str
+    line: bytes
+
+
+def to_json(value: Any) -> Any:
+    """convert an event field to something JSON can encode"""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="backslashreplace")
+    elif isinstance(value, Path):
+        return str(value)
+    elif isinstance(value, (list, tuple)):
+        return [to_json(v) for v in value]
+    elif is_dataclass(value):
+        return {f.name: to_json(getattr(value, f.name)) for f in fields(value)}
+    else:
+        return value
+
+
+# time.monotonic(), slot, event
+Record = Tuple[float, Optional[str], Any]
+
+
+def format_record(record: Record) -> str:
+    t, slot, event = record
+    return json.dumps(
+        dict(time=t, slot=slot, event=type(event).__name__, data=to_json(event)),
+        default=str,
+    )
+
+
+class JsonLinesSink:
+    """writes events as JSON lines to a binary stream, on its own thread
+
+    If the stream can't keep up, records are dropped (and counted) rather
+    than blocking the threads emitting them.
+    """
+
+    def __init__(self, stream, max_queued: int = 100000):
+        self.stream = stream
+        self.queue: "Queue[Optional[Record]]" = Queue(max_queued)
+        self.dropped = 0
+        self.logger = logging.getLogger("events")
+        self.thread = threading.Thread(target=self.run, name="events", daemon=True)
+        self.thread.start()
+
+    def put(self, record: Record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            lines = [format_record(record)]
+            # write whatever else is queued in one go
+            while not self.queue.empty():
+                record = self.queue.get()
+                if record is None:
+                    self.write(lines)
+                    return
+                lines.append(format_record(record))
+            self.write(lines)
+
+    def write(self, lines: List[str]):
+        try:
+            self.stream.write("".join(line + "\n" for line in lines).encode())
+            self.stream.flush()
+        except OSError as e:
+            self.logger.error(f"error writing events: {e}")
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped:
+            self.logger.warning(f"{self.dropped} events dropped")
+        self.stream.close()
+
+
+def open_sink(spec: str) -> JsonLinesSink:
+    """open a sink writing to a file, or to a unix socket if spec is
+    unix:PATH"""
+    try:
+        if spec.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(spec[len("unix:") :])
+            except OSError:
+                sock.close()
+                raise
+            return JsonLinesSink(sock.makefile("wb"))
+        else:
+            return JsonLinesSink(open(spec, "ab"))
+    except OSError as e:
+        raise UserError(f"can't write events to {spec}: {e}")
+
+
+# every line received and sent on serial and output by ssh is logged (at
+# DEBUG) to children of the "lines" logger, which the cli turns off for
+# fleet, schedule and daemon runs (unless --log-lines is given) so that
+# lines are not formatted; they are still available as events
+
+
+def lines_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"lines.{name}")
+
+
+def thread_slot() -> Optional[str]:
+    """the fleet slot being run by this thread (see cli.current_slot), which
+    can't be imported here as cli imports everything"""
+    return getattr(threading.current_thread(), "autoflash_slot", None)
+
+
+class EventBus:
+    def __init__(self):
+        self.sinks: List[JsonLinesSink] = []
+        #: check this before making an event to emit
+        self.enabled = False
+
+    # sinks is replaced rather than modified, so that emit doesn't need a lock
+
+    def add_sink(self, sink: JsonLinesSink):
+        self.sinks = [*self.sinks, sink]
+        self.enabled = True
+
+    def remove_sink(self, sink: JsonLinesSink):
+        self.sinks = [s for s in self.sinks if s is not sink]
+        self.enabled = bool(self.sinks)
+
+    def emit(self, event, slot: Optional[str] = None):
+        """send event (a dataclass) to all sinks; slot defaults to the slot of
+        the current thread, and should be given for events from other
+        threads"""
+        record = (time.monotonic(), slot if slot is not None else thread_slot(), event)
+        for sink in self.sinks:
+            sink.put(record)
+
+
+bus = EventBus()
@@ -2,3 +2,15 @@ class UserError(Exception):
     """error which can be shown directly to the user without a traceback"""
 
     pass
+
+
+class Timeout(UserError):
+    """a wait did not complete before its deadline"""
+
+    pass
+
+
+class Cancelled(UserError):
+    """work was cancelled, for example because autoflash is exiting"""
+
+    pass
@@ -0,0 +1,153 @@
+from .exceptions import UserError
+from .serial import Line, Serial, compile_patterns
+from .network import Network
+from .ssh import do_sysupgrade_ssh, log_progress, wait_for_ssh
+from .timing import span
+from typing import Callable, Optional
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger("flash")
+
+#: printed (through the kernel log, so after a timestamp) by procd once the
+#: initramfs has finished starting services, shortly before dropbear accepts
+#: connections
+init_complete = rb".*procd: - init complete -"
+
+
+class ImagePrefetch:
+    """read and hash a file in a background thread, so that it is in the page
+    cache and its checksum is known before it is needed
+
+    result() waits for this to finish, returning the checksum, or raising
+    any error which occurred.
+    """
+
+    def __init__(self, fname: str, block_size: int = 1024 * 1024):
+        self.fname = fname
+        self.block_size = block_size
+        self.checksum: Optional[str] = None
+        self.elapsed: Optional[float] = None
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            h = hashlib.sha256()
+            buf = bytearray(self.block_size)
+            view = memoryview(buf)
+            size = 0
+            with open(self.fname, "rb") as f:
+                while n := f.readinto(buf):
+                    h.update(view[:n])
+                    size += n
+            if size == 0:
+                raise UserError(f"sysupgrade image {self.fname} is empty")
+            self.checksum = h.hexdigest()
+        except BaseException as e:
+            self.error = e
+        self.elapsed = time.monotonic() - start
+
+    def result(self) -> str:
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        assert self.checksum is not None
+        return self.checksum
+
+
+class MarkerWatch:
+    """watch serial for a line matching marker in a background thread,
+    setting seen when it arrives; stops at close()
+
+    The history is read from start with a position separate from the cursor
+    used by Serial.expect, so this doesn't disturb waits in the foreground
+    thread.
+    """
+
+    def __init__(self, serial: Serial, marker: bytes, start: int):
+        self.serial = serial
+        self.pattern_set = compile_patterns((marker,))
+        self.seq = start
+        self.seen = threading.Event()
+        self.seen_time: Optional[float] = None
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop.is_set():
+            # wakes up regularly to check stop
+            for entry in self.serial.history.read(self.seq, timeout=0.5):
+                self.seq = entry.seq + 1
+                if isinstance(entry.item, Line) and self.pattern_set.match(
+                    entry.item.data
+                ):
+                    self.seen_time = time.monotonic()
+                    self.seen.set()
+                    return
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def boot_then_sysupgrade(
+    serial: Serial,
+    network: Network,
+    boot: Callable[[], None],
+    address: str,
+    sysupgrade: str,
+    options: str = "-v",
+    name: Optional[str] = None,
+    on_progress=log_progress,
+):
+    """boot an initramfs by calling boot, then sysupgrade it over SSH,
+    overlapping the two where possible
+
+    The sysupgrade image is read and hashed while the device boots, so the
+    upload doesn't wait for the disk or hash the image itself. The SSH probe
+    starts as soon as boot returns, and retries immediately when procd
+    prints init_complete on serial rather than waiting out its backoff.
+    """
+    start = time.monotonic()
+    image = ImagePrefetch(sysupgrade)
+
+    with span("boot initramfs", "flash"):
+        boot()
+    booted = time.monotonic()
+
+    with span("wait for initramfs", "flash"), MarkerWatch(
+        serial, init_complete, serial.mark()
+    ) as marker:
+        network.wait_for_neighbour(address)
+        wait_for_ssh(address, name=name, wake=marker.seen)
+    ready = time.monotonic()
+
+    with span("wait for image hash", "flash"):
+        checksum = image.result()
+    logger.info(
+        f"image hashed in {image.elapsed:.2f}s; booted after {booted - start:.2f}s, "
+        f"ssh ready after {ready - start:.2f}s"
+    )
+    if marker.seen_time is not None:
+        logger.info(f"ssh ready {ready - marker.seen_time:.2f}s after init complete")
+
+    do_sysupgrade_ssh(
+        address,
+        sysupgrade,
+        options=options,
+        on_progress=on_progress,
+        session=network.ssh_session(),
+        checksum=checksum,
+    )
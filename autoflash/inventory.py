@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List
+from .exceptions import UserError
+
+
+@dataclass
+class InventorySlot:
+    """a slot on the bench: a device of a particular type, with context
+    options (like serial_port, ifname and power_on) needed to talk to it"""
+
+    name: str
+    device: str
+    options: Dict[str, Any]
+
+
+@dataclass
+class Inventory:
+    slots: List[InventorySlot]
+
+
+def load_toml(path: str) -> Dict[str, Any]:
+    try:
+        import tomllib  # type: ignore
+    except ImportError:
+        try:
+            import tomli as tomllib  # type: ignore
+        except ImportError:
+            raise UserError("reading TOML files requires python 3.11+ or tomli")
+
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+def load_inventory(path: str) -> Inventory:
+    """load an inventory file, which looks like:
+
+        [[slot]]
+        name = "homehub-1"
+        device = "bt_homehub-v5a"
+        serial_port = "/dev/ttyUSB0"
+        ifname = "eth1"
+        power_on = "usbrelay RELAY_1=1"
+        power_off = "usbrelay RELAY_1=0"
+
+    everything except name and device is a context option; names default to
+    slot0, slot1 etc.
+    """
+    data = load_toml(path)
+
+    slots = []
+    for i, slot_data in enumerate(data.get("slot", [])):
+        options = {key.replace("-", "_"): value for key, value in slot_data.items()}
+        name = options.pop("name", f"slot{i}")
+        if "device" not in options:
+            raise UserError(f"{path}: slot {name} has no device")
+        device = options.pop("device")
+
+        slots.append(InventorySlot(name, device, options))
+
+    names = [slot.name for slot in slots]
+    for name in set(names):
+        if names.count(name) > 1:
+            raise UserError(f"{path}: slot name {name} is used more than once")
+
+    return Inventory(slots)
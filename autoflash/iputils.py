@@ -1,109 +1,306 @@
-import subprocess
-import json
+from contextlib import contextmanager
+from .exceptions import Timeout, UserError
+from .limits import check_deadline, limit_timeout
+from typing import Optional
+import logging
+import os
+import select
+import socket
+import time
 
+# these use netlink through pyroute2 rather than running ip, which saves
+# several process spawns per call. Each function can be passed an IPRoute to
+# reuse; otherwise one is opened for the call. pyroute2 is imported in
+# functions as it is slow to import.
 
-def run(cmd, netns=None):
-    cmd = ["ip", "-j"] + cmd
-    if netns is not None:
-        cmd = ["ip", "netns", "exec", netns] + cmd
-    output = subprocess.check_output(cmd)
-    if output:
-        return json.loads(output)
+logger = logging.getLogger("iputils")
+
+
+@contextmanager
+def iproute(ipr=None):
+    """get an IPRoute for the current thread's network namespace, or use the
+    one given"""
+    if ipr is not None:
+        yield ipr
     else:
-        return []
+        from pyroute2 import IPRoute
+
+        with IPRoute() as ipr:
+            yield ipr
+
+
+@contextmanager
+def in_netns(name):
+    """move this thread into the named network namespace for the duration of
+    the with block"""
+    import pyroute2.netns
+
+    saved_netns = os.open("/proc/thread-self/ns/net", os.O_RDONLY)
+    try:
+        pyroute2.netns.setns(name, flags=0)
+        yield
+    finally:
+        pyroute2.netns.setns(saved_netns)
+        os.close(saved_netns)
+
+
+def format_ifname(ifname, vlan):
+    return f"{ifname}.{vlan}" if vlan is not None else ifname
 
 
-def get_if_info(ifname, info):
-    [if_info] = [info_i for info_i in info if info_i["ifname"] == ifname]
-    return if_info
+def get_index(ipr, ifname):
+    indices = ipr.link_lookup(ifname=ifname)
+    if not indices:
+        raise UserError(f"network interface {ifname} not found")
+    return indices[0]
 
 
-def setup_vlans(ifname, vlans=[]):
-    info = run(["link", "show", "type", "vlan"])
+# dumping links is the slowest part (as pyroute2 decodes every attribute in
+# python), so functions take an optional list of links from ipr.get_links(),
+# which setup_ipv4 shares between them
 
-    current = [
-        int(interface["ifname"].split(".")[1])
-        for interface in info
-        if interface["link"] == ifname
-    ]
 
-    for to_remove in set(current) - set(vlans):
-        run(["link", "delete", f"{ifname}.{to_remove}"])
-    for to_add in set(vlans) - set(current):
-        run(
-            [
-                "link",
+def find_link(links, ifname):
+    for link in links:
+        if link.get_attr("IFLA_IFNAME") == ifname:
+            return link
+    raise UserError(f"network interface {ifname} not found")
+
+
+def get_vlans(links, index):
+    """get a dict from VLAN ID to interface index for VLAN interfaces on top
+    of the interface with the given index"""
+    vlans = {}
+    for link in links:
+        if link.get_attr("IFLA_LINK") != index:
+            continue
+        link_info = link.get_attr("IFLA_LINKINFO")
+        if link_info is None or link_info.get_attr("IFLA_INFO_KIND") != "vlan":
+            continue
+        vlan_id = link_info.get_attr("IFLA_INFO_DATA").get_attr("IFLA_VLAN_ID")
+        vlans[vlan_id] = link["index"]
+    return vlans
+
+
+def setup_vlans(ifname, vlans=[], ipr=None, links=None):
+    """make vlans the only VLANs on ifname; returns True if anything was
+    changed"""
+    with iproute(ipr) as ipr:
+        if links is None:
+            links = ipr.get_links()
+        index = find_link(links, ifname)["index"]
+        current = get_vlans(links, index)
+
+        for to_remove in set(current) - set(vlans):
+            ipr.link("del", index=current[to_remove])
+        for to_add in set(vlans) - set(current):
+            ipr.link(
                 "add",
-                "link",
-                ifname,
-                "name",
-                f"{ifname}.{to_add}",
-                "type",
-                "vlan",
-                "id",
-                str(to_add),
-            ]
-        )
+                ifname=format_ifname(ifname, to_add),
+                kind="vlan",
+                link=index,
+                vlan_id=to_add,
+            )
+        return set(current) != set(vlans)
 
 
-def setup_ipv4(ifname, ip, prefixlen=24, vlan=None):
-    setup_vlans(ifname, [vlan] if vlan is not None else [])
-    ensure_ipv4(ifname, ip, prefixlen, vlan=vlan)
-    ensure_up(ifname, vlan=vlan)
+def setup_ipv4(ifname, ip, prefixlen=24, vlan=None, ipr=None):
+    with iproute(ipr) as ipr:
+        links = ipr.get_links()
+        if setup_vlans(ifname, [vlan] if vlan is not None else [], ipr, links):
+            links = ipr.get_links()
+        ensure_ipv4(ifname, ip, prefixlen, vlan=vlan, ipr=ipr, links=links)
+        ensure_up(ifname, vlan=vlan, ipr=ipr, links=links)
 
 
-def format_ifname(ifname, vlan):
-    return f"{ifname}.{vlan}" if vlan is not None else ifname
+def ensure_ipv4(ifname, ip, prefixlen, vlan=None, ipr=None, links=None):
+    """make ip/prefixlen the only IPv4 address on ifname (or the given VLAN on
+    it), removing addresses from ifname and its other VLANs"""
+    with iproute(ipr) as ipr:
+        if links is None:
+            links = ipr.get_links()
+        index = find_link(links, ifname)["index"]
+        indices = {index, *get_vlans(links, index).values()}
+        target_index = find_link(links, format_ifname(ifname, vlan))["index"]
 
+        current = set()
+        for addr in ipr.get_addr(family=socket.AF_INET):
+            if addr["index"] in indices:
+                address = addr.get_attr("IFA_LOCAL") or addr.get_attr("IFA_ADDRESS")
+                current.add((addr["index"], address, addr["prefixlen"]))
+        target = {(target_index, ip, prefixlen)}
 
-def ensure_ipv4(ifname, ip, prefixlen, vlan=None):
-    info = run(["addr", "show"])
+        for addr_index, addr_ip, addr_prefixlen in current - target:
+            ipr.addr("del", index=addr_index, address=addr_ip, prefixlen=addr_prefixlen)
+        for addr_index, addr_ip, addr_prefixlen in target - current:
+            ipr.addr("add", index=addr_index, address=addr_ip, prefixlen=addr_prefixlen)
 
-    current = []
-    for if_info in info:
-        if if_info["ifname"] == ifname or (
-            "link" in if_info and if_info["link"] == ifname
-        ):
-            if "." in if_info["ifname"]:
-                addr_name, addr_vlan = if_info["ifname"].split(".")
-                addr_vlan = int(addr_vlan)
-            else:
-                addr_name, addr_vlan = if_info["ifname"], None
 
-            for addr_info in if_info["addr_info"]:
-                current.append(
-                    (addr_name, addr_vlan, addr_info["local"], addr_info["prefixlen"])
-                )
-    target = [(ifname, vlan, ip, prefixlen)]
+def ensure_up(ifname, vlan, ipr=None, links=None):
+    with iproute(ipr) as ipr:
+        if links is None:
+            links = ipr.get_links()
+        if vlan is not None:
+            ensure_up(ifname, None, ipr=ipr, links=links)
+
+        link = find_link(links, format_ifname(ifname, vlan))
+        if not link["flags"] & IFF_UP:
+            ipr.link("set", index=link["index"], state="up")
+
 
-    for ifname, vlan, ip, prefixlen in set(current) - set(target):
-        run(["addr", "del", f"{ip}/{prefixlen}", "dev", format_ifname(ifname, vlan)])
+# from linux/if.h, linux/rtnetlink.h and linux/neighbour.h
+IFF_UP = 0x1
+IFF_LOWER_UP = 0x10000
+RTMGRP_LINK = 0x1
+RTMGRP_NEIGH = 0x4
+NUD_INCOMPLETE = 0x01
+NUD_REACHABLE = 0x02
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+NUD_PERMANENT = 0x80
 
-    for ifname, vlan, ip, prefixlen in set(target) - set(current):
-        run(["addr", "add", f"{ip}/{prefixlen}", "dev", format_ifname(ifname, vlan)])
 
+def receive(ipr, deadline: Optional[float], what: str, interval: float = 1.0):
+    """receive messages from a bound IPRoute, waiting until deadline (a
+    time.monotonic() value, or None) for some to arrive; returns an empty
+    list if none arrived within interval, so that callers can do something
+    periodically, and so that cancellation is noticed"""
+    check_deadline()
+    timeout = interval
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Timeout(f"timed out waiting for {what}")
+        timeout = min(timeout, remaining)
 
-def ensure_up(ifname, vlan):
-    if vlan is not None:
-        ensure_up(ifname, None)
+    ready, _, _ = select.select([ipr.fileno()], [], [], timeout)
+    return ipr.get() if ready else []
 
-    ifname = format_ifname(ifname, vlan)
 
-    info = get_if_info(ifname, run(["link", "show", ifname]))
-    if "UP" not in info["flags"]:
-        run(["link", "set", "up", "dev", ifname])
+def has_carrier(link):
+    return (link["flags"] & (IFF_UP | IFF_LOWER_UP)) == IFF_UP | IFF_LOWER_UP
 
 
-def make_netns(name, interfaces):
-    current_netns = [info["name"] for info in run(["netns", "list"])]
-    if name not in current_netns:
-        run(["netns", "add", name])
+def wait_for_carrier(ifname, timeout: Optional[float] = None):
+    """wait for ifname to be up with a carrier, using netlink events"""
+    from pyroute2 import IPRoute
 
-    current_interfaces = [info["ifname"] for info in run(["link"], netns=name)]
+    timeout = limit_timeout(timeout)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with IPRoute() as monitor:
+        # subscribe before checking, so that changes in between aren't missed
+        monitor.bind(groups=RTMGRP_LINK)
+        with iproute() as ipr:
+            if has_carrier(find_link(ipr.get_links(), ifname)):
+                return
 
-    for interface in set(interfaces) - set(current_interfaces):
-        run(["link", "set", interface, "netns", name])
+        while True:
+            for msg in receive(monitor, deadline, f"carrier on {ifname}"):
+                if (
+                    msg["event"] == "RTM_NEWLINK"
+                    and msg.get_attr("IFLA_IFNAME") == ifname
+                    and has_carrier(msg)
+                ):
+                    return
+
+
+def neighbour_confirmed(msg, ip) -> bool:
+    """is msg a neighbour entry for ip which has been confirmed (by an ARP
+    reply, for example) recently, or is static"""
+    return msg.get_attr("NDA_DST") == ip and bool(
+        msg["state"] & (NUD_REACHABLE | NUD_NOARP | NUD_PERMANENT)
+    )
+
+
+def wait_for_neighbour(ip, timeout: Optional[float] = None, interval: float = 0.2):
+    """wait for ip to answer a neighbour (ARP) request, using netlink events
+
+    An entry which existed before this was called doesn't count, as it may be
+    left over from an earlier boot stage (U-Boot, for example), which
+    answered ARP using the same address. To make the kernel ask again rather
+    than trust it, existing dynamic entries for ip are removed at the start.
+
+    Resolution is triggered by sending an empty UDP packet to ip every
+    interval. Unresolved (incomplete or failed) entries are also removed
+    before each probe, as otherwise the kernel only sends ARP requests once a
+    second.
+    """
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.exceptions import NetlinkError
+
+    timeout = limit_timeout(timeout)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with IPRoute() as monitor, iproute() as ipr, socket.socket(
+        socket.AF_INET, socket.SOCK_DGRAM
+    ) as sock:
+        monitor.bind(groups=RTMGRP_NEIGH)
+
+        def delete(msg):
+            try:
+                ipr.neigh("del", dst=ip, ifindex=msg["ifindex"])
+            except NetlinkError:
+                pass
+
+        # after subscribing, so that a confirmation after this isn't missed
+        for msg in ipr.get_neighbours(socket.AF_INET):
+            if msg.get_attr("NDA_DST") == ip and not msg["state"] & (
+                NUD_NOARP | NUD_PERMANENT
+            ):
+                logger.debug(f"removing existing neighbour entry for {ip}")
+                delete(msg)
+
+        def probe():
+            """probe ip, returning True if it has been confirmed since the
+            start"""
+            for msg in ipr.get_neighbours(socket.AF_INET):
+                if msg.get_attr("NDA_DST") != ip:
+                    continue
+                if neighbour_confirmed(msg, ip):
+                    return True
+                if msg["state"] & (NUD_INCOMPLETE | NUD_FAILED):
+                    delete(msg)
+
+            try:
+                # the discard port
+                sock.sendto(b"", (ip, 9))
+            except OSError:
+                # for example, no route yet
+                pass
+            return False
+
+        while True:
+            if probe():
+                return
+            next_probe = time.monotonic() + interval
+
+            while time.monotonic() < next_probe:
+                remaining = next_probe - time.monotonic()
+                for msg in receive(monitor, deadline, f"neighbour {ip}", remaining):
+                    if msg["event"] == "RTM_NEWNEIGH" and neighbour_confirmed(msg, ip):
+                        return
+
+
+def make_netns(name, interfaces, ipr=None):
+    """make a network namespace (if it doesn't exist) containing interfaces,
+    moving them from the current namespace if necessary"""
+    import pyroute2.netns
+
+    if name not in pyroute2.netns.listnetns():
+        pyroute2.netns.create(name)
+
+    with iproute(ipr) as ipr:
+        for interface in interfaces:
+            indices = ipr.link_lookup(ifname=interface)
+            if indices:
+                ipr.link("set", index=indices[0], net_ns_fd=name)
+            else:
+                # should already be in the namespace
+                with in_netns(name):
+                    with iproute() as netns_ipr:
+                        get_index(netns_ipr, interface)
 
 
 def del_netns(name):
-    run(["netns", "del", name])
+    import pyroute2.netns
+
+    pyroute2.netns.remove(name)
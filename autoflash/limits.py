@@ -0,0 +1,234 @@
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Callable, List, Optional, Tuple, Type, TypeVar
+from .exceptions import Cancelled, Timeout, UserError
+from .registry import Context
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger("limits")
+
+# deadlines apply to every wait made in the thread (or asyncio task) which
+# entered them, so that a step can be given a time limit without passing a
+# timeout to everything it calls; waits call limit_timeout to combine their
+# own timeout with the current deadline
+
+
+class Deadline:
+    """a time limit on some work, which can also be cancelled from another
+    thread; a deadline is also cancelled or expired if its parent is"""
+
+    def __init__(
+        self,
+        timeout: Optional[float],
+        what: str,
+        parent: Optional["Deadline"] = None,
+        wait_timeout: Optional[float] = None,
+    ):
+        self.timeout = timeout
+        self.expiry = None if timeout is None else time.monotonic() + timeout
+        self.what = what
+        self.parent = parent
+        # default timeout for waits which don't specify one
+        self.wait_timeout = wait_timeout
+        if wait_timeout is None and parent is not None:
+            self.wait_timeout = parent.wait_timeout
+
+        self.cancelled = False
+        self.lock = threading.Lock()
+        # called (from the cancelling thread) on cancel, to wake up waits
+        self.wakers: List[Callable[[], object]] = []
+
+    def chain(self):
+        deadline: Optional[Deadline] = self
+        while deadline is not None:
+            yield deadline
+            deadline = deadline.parent
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            wakers = list(self.wakers)
+        for waker in wakers:
+            waker()
+
+    def is_cancelled(self) -> bool:
+        return any(deadline.cancelled for deadline in self.chain())
+
+    def remaining(self) -> Optional[float]:
+        """time until the earliest expiry in the chain, or None"""
+        expiries = [d.expiry for d in self.chain() if d.expiry is not None]
+        if not expiries:
+            return None
+        return max(0.0, min(expiries) - time.monotonic())
+
+    def check(self):
+        """raise Cancelled or Timeout if this deadline has been cancelled or
+        has expired"""
+        for deadline in self.chain():
+            if deadline.cancelled:
+                raise Cancelled(f"{deadline.what} was cancelled")
+        for deadline in self.chain():
+            if deadline.expiry is not None and time.monotonic() >= deadline.expiry:
+                raise Timeout(f"{deadline.what} timed out after {deadline.timeout}s")
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current.get()
+
+
+@contextmanager
+def deadline(timeout: Optional[float], what: str, wait_timeout: Optional[float] = None):
+    """apply a deadline of timeout seconds (or None for none) to waits in
+    the with block, which is nested within any current deadline"""
+    new_deadline = Deadline(timeout, what, current_deadline(), wait_timeout)
+    token = _current.set(new_deadline)
+    try:
+        yield new_deadline
+    finally:
+        _current.reset(token)
+
+
+def limit_timeout(timeout: Optional[float], use_default: bool = True):
+    """get the timeout to use for a wait, given the wait's own timeout
+
+    If there is no current deadline this is just timeout. Otherwise, a
+    timeout of None is replaced by the default wait timeout (if use_default),
+    the result is limited to the time remaining, and Cancelled or Timeout is
+    raised if the deadline has already been cancelled or has expired.
+    """
+    current = current_deadline()
+    if current is None:
+        return timeout
+
+    current.check()
+    if timeout is None and use_default:
+        timeout = current.wait_timeout
+    remaining = current.remaining()
+    if remaining is not None and (timeout is None or remaining < timeout):
+        return remaining
+    return timeout
+
+
+def check_deadline():
+    """raise Cancelled or Timeout if the current deadline has been cancelled
+    or has expired; waits should call this when their own timeout expires,
+    so that the error says why"""
+    current = current_deadline()
+    if current is not None:
+        current.check()
+
+
+def is_cancelled() -> bool:
+    current = current_deadline()
+    return current is not None and current.is_cancelled()
+
+
+@contextmanager
+def wake_on_cancel(waker: Callable[[], object]):
+    """call waker (from another thread) if the current deadline (or one of
+    its parents) is cancelled during the with block"""
+    current = current_deadline()
+    if current is None:
+        yield
+        return
+
+    chain = list(current.chain())
+    for deadline in chain:
+        with deadline.lock:
+            deadline.wakers.append(waker)
+    try:
+        yield
+    finally:
+        for deadline in chain:
+            with deadline.lock:
+                deadline.wakers.remove(waker)
+
+
+async def run_in_executor(fn, *args, **kwargs):
+    """run fn in the default executor, in a copy of the current context so
+    that it sees the current deadline"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(copy_context().run, fn, *args, **kwargs)
+    )
+
+
+def notify_on_cancel(cond: threading.Condition):
+    """wake_on_cancel for waits on cond"""
+
+    def notify():
+        with cond:
+            cond.notify_all()
+
+    return wake_on_cancel(notify)
+
+
+T = TypeVar("T")
+
+
+def retry(
+    fn: Callable[[], T],
+    retries: int,
+    what: str,
+    exceptions: Tuple[Type[BaseException], ...] = (UserError,),
+    delay: float = 0.0,
+) -> T:
+    """call fn, retrying up to retries times if it raises one of exceptions;
+    Cancelled, and Timeout from the current deadline expiring, are not
+    retried"""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except exceptions as e:
+            if isinstance(e, Cancelled) or attempt == retries:
+                raise
+            check_deadline()
+            logger.warning(f"{what} failed ({e}); retrying")
+            if delay:
+                time.sleep(delay)
+    assert False
+
+
+class Limits(Context):
+    """time limits and retries for steps
+
+    step_timeout limits the time taken by each step, and wait_timeout the
+    time taken by each wait within a step which doesn't have its own
+    timeout (for example, waiting for U-Boot or SSH). Steps which support it
+    retry the parts which are prone to failing (like interrupting U-Boot and
+    TFTP booting) up to retries times.
+    """
+
+    def __init__(
+        self,
+        step_timeout: Optional[float] = None,
+        wait_timeout: Optional[float] = None,
+        retries: int = 0,
+    ):
+        self.step_timeout = step_timeout
+        self.wait_timeout = wait_timeout
+        self.retries = retries
+
+    #: timeout for waits which are retried, like waiting for a prompt
+    retry_timeout = 5.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def retry_wait_timeout(self) -> Optional[float]:
+        """timeout for a wait within something which will be retried on
+        failure: retry_timeout if retries are enabled, so that a retry starts
+        promptly, otherwise None, so only the wait timeout applies"""
+        return self.retry_timeout if self.retries > 0 else None
+
+    def step_deadline(self, step_name: str):
+        return deadline(self.step_timeout, f"step {step_name}", self.wait_timeout)
@@ -0,0 +1,290 @@
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+from .exceptions import UserError
+import bisect
+import logging
+import math
+import threading
+
+# process-wide metrics, exposed over HTTP in the Prometheus text exposition
+# format for benches running fleets or the daemon
+#
+# like the event bus, this costs nothing unless enabled: callers check
+# registry.enabled before updating a metric, and text is only generated when
+# the endpoint is scraped
+
+logger = logging.getLogger("metrics")
+
+LabelValues = Tuple[str, ...]
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    labels = ",".join(f'{n}="{escape_label(v)}"' for n, v in zip(names, values))
+    return "{" + labels + "}"
+
+
+def slot_label(slot: Optional[str]) -> str:
+    """label value for a fleet slot, which is empty outside of fleet runs"""
+    return slot if slot is not None else ""
+
+
+class Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def check_labels(self, values: LabelValues):
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} has labels {self.label_names}")
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """the lines of the exposition for this metric, after the HELP and
+        TYPE comments"""
+
+    def expose(self) -> str:
+        return "".join(
+            [
+                f"# HELP {self.name} {self.help}\n",
+                f"# TYPE {self.name} {self.type}\n",
+                *(sample + "\n" for sample in self.samples()),
+            ]
+        )
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help, label_names)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float, *label_values: str):
+        self.check_labels(label_values)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def get(self, *label_values: str) -> float:
+        with self.lock:
+            return self.values.get(label_values, 0.0)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = dict(self.values)
+        return [
+            f"{self.name}{format_labels(self.label_names, labels)} "
+            f"{format_value(value)}"
+            for labels, value in sorted(values.items())
+        ]
+
+
+class HistogramValue:
+    def __init__(self, n_buckets: int):
+        # non-cumulative counts; the last is for values above every bound
+        self.counts = [0] * (n_buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = (),
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = sorted(buckets)
+        self.values: Dict[LabelValues, HistogramValue] = {}
+
+    def observe(self, value: float, *label_values: str):
+        self.check_labels(label_values)
+        # buckets are upper bounds, inclusive
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            hist = self.values.get(label_values)
+            if hist is None:
+                hist = self.values[label_values] = HistogramValue(len(self.buckets))
+            hist.counts[index] += 1
+            hist.sum += value
+            hist.count += 1
+
+    def get(self, *label_values: str) -> Optional[HistogramValue]:
+        with self.lock:
+            return self.values.get(label_values)
+
+    def samples(self) -> List[str]:
+        bucket_labels = (*self.label_names, "le")
+        samples = []
+        with self.lock:
+            for labels, hist in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip([*self.buckets, math.inf], hist.counts):
+                    cumulative += count
+                    le = format_labels(bucket_labels, (*labels, format_value(bound)))
+                    samples.append(f"{self.name}_bucket{le} {cumulative}")
+                label_str = format_labels(self.label_names, labels)
+                samples.append(f"{self.name}_sum{label_str} {format_value(hist.sum)}")
+                samples.append(f"{self.name}_count{label_str} {hist.count}")
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        #: check this before updating a metric
+        self.enabled = False
+
+    def counter(self, name: str, help: str, label_names: Sequence[str] = ()):
+        counter = Counter(name, help, label_names)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = (),
+    ):
+        histogram = Histogram(name, help, label_names, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def expose(self) -> str:
+        """all metrics in the Prometheus text exposition format"""
+        return "".join(metric.expose() for metric in self.metrics)
+
+
+registry = MetricsRegistry()
+
+duration_buckets = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+throughput_buckets = (1e5, 2e5, 5e5, 1e6, 2e6, 5e6, 1e7, 2e7, 5e7, 1e8)
+
+flashes_started = registry.counter(
+    "autoflash_flashes_started_total",
+    "runs of a sequence of steps (one command line, fleet slot or job)",
+    ["device", "slot"],
+)
+flashes_succeeded = registry.counter(
+    "autoflash_flashes_succeeded_total",
+    "runs of a sequence of steps which succeeded",
+    ["device", "slot"],
+)
+flashes_failed = registry.counter(
+    "autoflash_flashes_failed_total",
+    "runs of a sequence of steps which failed, timed out or were cancelled",
+    ["device", "slot"],
+)
+step_duration = registry.histogram(
+    "autoflash_step_duration_seconds",
+    "time taken by each step, whether it succeeded or not",
+    ["device", "step", "slot"],
+    duration_buckets,
+)
+tftp_throughput = registry.histogram(
+    "autoflash_tftp_throughput_bytes_per_second",
+    "average throughput of completed transfers from the built-in TFTP server",
+    ["slot"],
+    throughput_buckets,
+)
+dnsmasq_events = registry.counter(
+    "autoflash_dnsmasq_events_total",
+    "DHCP leases and TFTP transfers logged by dnsmasq",
+    ["event", "slot"],
+)
+dnsmasq_startup = registry.histogram(
+    "autoflash_dnsmasq_startup_seconds",
+    "time taken for dnsmasq to start",
+    ["slot"],
+    (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2),
+)
+ssh_ready_time = registry.histogram(
+    "autoflash_ssh_ready_seconds",
+    "time from starting to wait for SSH until it was ready",
+    ["slot"],
+    (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+)
+upload_throughput = registry.histogram(
+    "autoflash_upload_throughput_bytes_per_second",
+    "average throughput of sysupgrade image uploads over SSH",
+    ["slot"],
+    throughput_buckets,
+)
+serial_received = registry.counter(
+    "autoflash_serial_received_bytes_total",
+    "bytes received on each serial port",
+    ["port"],
+)
+
+
+class MetricsServer:
+    """serves registry on /metrics from a background thread, and enables it
+    while running"""
+
+    def __init__(self, address: str, registry: MetricsRegistry = registry):
+        host, _sep, port = address.rpartition(":")
+        if not port.isdigit():
+            raise UserError(f"expected [HOST:]PORT for metrics, got {address}")
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.expose().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        # only listen locally unless asked to
+        try:
+            self.server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+        except OSError as e:
+            raise UserError(f"can't serve metrics on {address}: {e}")
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True
+        )
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def __enter__(self):
+        self.registry.enabled = True
+        self.thread.start()
+        logger.info(f"serving metrics on port {self.port}")
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.registry.enabled = False
@@ -1,28 +1,164 @@
-import pyroute2.netns
+import fcntl
+import logging
+import os
+from pathlib import Path
 from typing import Optional
+from .exceptions import UserError
+from .limits import run_in_executor
+from .timing import span
 from .registry import Context
+from .ssh import SshSession
 from . import iputils
 
+# a lock file for each namespace is held while it is in use, so that
+# namespaces left behind by processes which died can be found and removed;
+# namespaces kept with keep_netns have a .keep file
+lock_dir = Path("/run/autoflash/netns")
+netns_prefix = "autoflash_"
+
+
+def lock_netns(name: str) -> Optional[int]:
+    """lock the namespace with the given name, returning a file descriptor to
+    close to unlock it, or None if it is in use"""
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_dir / f"{name}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def reclaim_stale_netns(logger, prefix: Optional[str] = None):
+    """remove autoflash namespaces (those starting with prefix, or
+    netns_prefix) which are not in use or kept, returning their interfaces to
+    the current namespace"""
+    import pyroute2.netns
+
+    if prefix is None:
+        prefix = netns_prefix
+
+    for name in pyroute2.netns.listnetns():
+        if not name.startswith(prefix) or (lock_dir / f"{name}.keep").exists():
+            continue
+        fd = lock_netns(name)
+        if fd is None:
+            continue
+        try:
+            # may have been removed before the lock was taken
+            if name in pyroute2.netns.listnetns():
+                logger.warning(f"removing stale network namespace {name}")
+                iputils.del_netns(name)
+        finally:
+            os.close(fd)
+
 
 class Network(Context):
+    """configures a network interface, which is moved into its own network
+    namespace (if use_netns) so that it doesn't interfere with the host
+
+    With keep_netns, the namespace (and the interface in it) is left in place
+    on exit, so that the next run on the same interface doesn't have to set
+    it up again, and the host doesn't reconfigure the interface in between.
+    """
+
     # XXX: make non-optional?
-    def __init__(self, ifname: Optional[str] = None, use_netns: bool = True):
+    def __init__(
+        self,
+        ifname: Optional[str] = None,
+        use_netns: bool = True,
+        netns_name: Optional[str] = None,
+        keep_netns: bool = False,
+    ):
         assert ifname is not None
         self.ifname: str = ifname
         self.use_netns = use_netns
+        # named after the interface by default, so that runs using different
+        # interfaces don't collide
+        self.netns_name = (
+            netns_name if netns_name is not None else f"{netns_prefix}{ifname}"
+        )
+        self.keep_netns = keep_netns
+        self.logger = logging.getLogger("network")
+        self._ssh_session: Optional[SshSession] = None
 
     def __enter__(self):
         if self.use_netns:
-            self.netns_name = "autoflash_tmp"
-            iputils.make_netns(self.netns_name, [self.ifname])
-            pyroute2.netns.pushns(self.netns_name)
+            # imported here as pyroute2 is slow to import
+            import pyroute2.netns
+
+            lock_fd = lock_netns(self.netns_name)
+            if lock_fd is None:
+                raise UserError(
+                    f"network namespace {self.netns_name} is in use by another run"
+                )
+            self.lock_fd = lock_fd
+
+            try:
+                reclaim_stale_netns(self.logger)
+                iputils.make_netns(self.netns_name, [self.ifname])
+            except BaseException:
+                os.close(self.lock_fd)
+                raise
+
+            # network namespaces are per-thread, so only this thread (and
+            # threads and processes it starts) are moved; pyroute2.netns.pushns
+            # saves the namespace of the main thread, so isn't used
+            self.saved_netns = os.open("/proc/thread-self/ns/net", os.O_RDONLY)
+            pyroute2.netns.setns(self.netns_name)
 
         return self
 
     def __exit__(self, *exc):
+        if self._ssh_session is not None:
+            self._ssh_session.close()
+            self._ssh_session = None
+
         if self.use_netns:
-            pyroute2.netns.popns()
-            iputils.del_netns(self.netns_name)
+            import pyroute2.netns
+
+            pyroute2.netns.setns(self.saved_netns)
+            os.close(self.saved_netns)
+
+            keep_path = lock_dir / f"{self.netns_name}.keep"
+            try:
+                if self.keep_netns:
+                    keep_path.touch()
+                else:
+                    keep_path.unlink(missing_ok=True)
+                    iputils.del_netns(self.netns_name)
+            finally:
+                os.close(self.lock_fd)
+
+    def ssh_session(self) -> SshSession:
+        """get an SshSession which keeps connections open until this context
+        is exited, so that they can be reused by several steps"""
+        if self._ssh_session is None:
+            self._ssh_session = SshSession()
+        return self._ssh_session
 
     def setup_ipv4(self, ip, prefixlen=24, vlan=None):
-        iputils.setup_ipv4(self.ifname, ip, prefixlen=prefixlen, vlan=vlan)
+        with span("set up network", "network"):
+            iputils.setup_ipv4(self.ifname, ip, prefixlen=prefixlen, vlan=vlan)
+
+    async def setup_ipv4_async(self, ip, prefixlen=24, vlan=None):
+        await run_in_executor(self.setup_ipv4, ip, prefixlen=prefixlen, vlan=vlan)
+
+    def wait_for_carrier(self, vlan=None, timeout: Optional[float] = None):
+        """wait for the interface (or the given VLAN on it) to be up with a
+        carrier"""
+        with span("wait for carrier", "network"):
+            iputils.wait_for_carrier(iputils.format_ifname(self.ifname, vlan), timeout)
+
+    async def wait_for_carrier_async(self, vlan=None, timeout: Optional[float] = None):
+        await run_in_executor(self.wait_for_carrier, vlan, timeout)
+
+    def wait_for_neighbour(self, ip: str, timeout: Optional[float] = None):
+        """wait for ip to respond to ARP, after this is called (see
+        iputils.wait_for_neighbour)"""
+        with span(f"wait for neighbour {ip}", "network"):
+            iputils.wait_for_neighbour(ip, timeout)
+
+    async def wait_for_neighbour_async(self, ip: str, timeout: Optional[float] = None):
+        await run_in_executor(self.wait_for_neighbour, ip, timeout)
@@ -0,0 +1,39 @@
+import logging
+import subprocess
+import time
+from typing import Optional
+from .exceptions import UserError
+from .registry import Context
+
+
+class Power(Context):
+    """controls the power to a device by running shell commands, for example
+    to switch a relay or a smart plug"""
+
+    def __init__(self, power_on: Optional[str] = None, power_off: Optional[str] = None):
+        self.power_on = power_on
+        self.power_off = power_off
+        self.logger = logging.getLogger("power")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def run(self, command: Optional[str], state: str):
+        if command is None:
+            raise UserError(f"no command configured to turn power {state}")
+        self.logger.info(f"turning power {state}: {command}")
+        subprocess.run(command, shell=True, check=True)
+
+    def on(self):
+        self.run(self.power_on, "on")
+
+    def off(self):
+        self.run(self.power_off, "off")
+
+    def cycle(self, off_time: float = 2.0):
+        self.off()
+        time.sleep(off_time)
+        self.on()
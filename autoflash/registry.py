@@ -1,5 +1,6 @@
-from typing import List, Callable
+from typing import List, Callable, Dict, Optional, Tuple, Type
 import importlib
+import importlib.metadata
 
 
 class Context:
@@ -18,11 +19,100 @@ class Device:
         return step
 
 
+class DeviceInfo:
+    """metadata about a device, which can be listed without importing the
+    module which defines it"""
+
+    def __init__(
+        self,
+        architecture: str,
+        name: str,
+        module_name: str,
+        attr_name: str = "device",
+        package: Optional[str] = None,
+    ):
+        self.architecture = architecture
+        self.name = name
+        self.module_name = module_name
+        self.attr_name = attr_name
+        self.package = package
+
+    def load(self) -> Device:
+        mod = importlib.import_module(self.module_name, self.package)
+        device = getattr(mod, self.attr_name)
+        assert device.name == self.name, f"expected {self.name}, got {device.name}"
+        assert device.architecture == self.architecture
+        return device
+
+
 class DeviceRegistry:
     def __init__(self, base_package=None):
         self.base_package = base_package
-        self.devices = []
+        # devices which have been loaded
+        self.devices: List[Device] = []
+        # devices which will be loaded when they are used
+        self.lazy_devices: Dict[str, DeviceInfo] = {}
+        # context types which may be used by lazy devices, so that their
+        # options can be given on the command line
+        self.context_types: List[Type[Context]] = []
 
     def add_from_module(self, module_name: str, attr_name: str = "device"):
         mod = importlib.import_module(module_name, self.base_package)
         self.devices.append(getattr(mod, attr_name))
+
+    def add_lazy(
+        self,
+        architecture: str,
+        name: str,
+        module_name: str,
+        attr_name: str = "device",
+    ):
+        """register a device, which is only imported from module_name when
+        it's needed"""
+        self.lazy_devices[name] = DeviceInfo(
+            architecture, name, module_name, attr_name, self.base_package
+        )
+
+    def add_context(self, context_type: Type[Context]):
+        self.context_types.append(context_type)
+
+    def add_entry_points(self, group: str = "autoflash.devices"):
+        """load plugins from entry points in group
+
+        Each entry point should be a function which is called with this
+        registry, and should register devices using add_lazy (and add_context
+        for any new context types). It should avoid importing anything heavy,
+        as this happens for every invocation.
+        """
+        entry_points = importlib.metadata.entry_points()
+        if hasattr(entry_points, "select"):
+            group_entry_points = entry_points.select(group=group)
+        else:
+            group_entry_points = entry_points.get(group, [])  # type: ignore
+
+        for entry_point in group_entry_points:
+            entry_point.load()(self)
+
+    def list_devices(self) -> List[Tuple[str, str]]:
+        """get the architecture and name of all devices, without loading
+        them"""
+        devices = [(device.architecture, device.name) for device in self.devices]
+        devices.extend(
+            (info.architecture, info.name)
+            for info in self.lazy_devices.values()
+            if (info.architecture, info.name) not in devices
+        )
+        return devices
+
+    def get_device(self, name: str) -> Optional[Device]:
+        """get a device by name, loading it if necessary"""
+        for device in self.devices:
+            if device.name == name:
+                return device
+
+        if name in self.lazy_devices:
+            device = self.lazy_devices[name].load()
+            self.devices.append(device)
+            return device
+
+        return None
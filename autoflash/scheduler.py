@@ -0,0 +1,195 @@
+from dataclasses import asdict, dataclass
+from pathlib import Path
+import json
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from .cli import Runner, Slot, SlotResult
+from .exceptions import UserError
+
+
+@dataclass
+class Job:
+    """a chain of steps (as given on the command line) to run on a device of
+    a given type, or on a particular slot"""
+
+    device: str
+    steps: List[str]
+    slot: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Job":
+        try:
+            job = cls(**data)
+        except TypeError as e:
+            raise UserError(f"invalid job: {e}")
+        if not isinstance(job.steps, list) or not all(
+            isinstance(step, str) for step in job.steps
+        ):
+            raise UserError("invalid job: steps must be a list of strings")
+        return job
+
+
+class JobQueueDir:
+    """a directory of pending jobs, each a JSON file like:
+
+        {"device": "bt_homehub-v5a", "steps": ["boot", "/srv/initramfs.bin"]}
+
+    Jobs are taken in order of modification time, then name. Once started, a
+    job is moved into running/, then into done/ or failed/ when it finishes,
+    alongside a .result.json file.
+
+    Jobs which can't be parsed are failed, so writers must not create them
+    in place: write to a name not ending in .json, then rename it (as submit
+    does).
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        for subdir in "running", "done", "failed":
+            (self.path / subdir).mkdir(parents=True, exist_ok=True)
+        self.logger = logging.getLogger("scheduler")
+
+    def pending(self) -> List[Tuple[Path, Job]]:
+        """get the pending jobs; invalid jobs are moved to failed/"""
+        paths = sorted(
+            self.path.glob("*.json"), key=lambda path: (path.stat().st_mtime, path.name)
+        )
+
+        jobs = []
+        for path in paths:
+            try:
+                with open(path) as f:
+                    jobs.append((path, Job.from_dict(json.load(f))))
+            except (ValueError, UserError) as e:
+                self.logger.error(f"{path.name}: {e}")
+                self.finish(self.start(path), {"ok": False, "error": str(e)})
+        return jobs
+
+    def submit(self, job: Job, name: str) -> Path:
+        """add job as name.json, writing it to a temporary file first so that
+        it is never seen partly written"""
+        path = self.path / f"{name}.json"
+        tmp_path = self.path / f".{name}.json.tmp"
+        data = {key: value for key, value in asdict(job).items() if value is not None}
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        tmp_path.rename(path)
+        return path
+
+    def start(self, path: Path) -> Path:
+        running_path = self.path / "running" / path.name
+        path.rename(running_path)
+        return running_path
+
+    def finish(self, running_path: Path, result: Dict[str, Any]):
+        dest_dir = self.path / ("done" if result["ok"] else "failed")
+        running_path.rename(dest_dir / running_path.name)
+        with open(dest_dir / (running_path.stem + ".result.json"), "w") as f:
+            json.dump(result, f, indent=4)
+
+
+class Scheduler:
+    """assigns jobs to free slots with the right type of device, running each
+    on its own thread"""
+
+    def __init__(self, runner: Runner, slots: List[Slot], context_args_parsed):
+        self.runner = runner
+        self.slots = slots
+        self.context_args_parsed = context_args_parsed
+
+        self.lock = threading.Lock()
+        self.busy: Dict[str, threading.Thread] = {}
+        # set when a job finishes, to wake up run_queue_dir
+        self.job_finished = threading.Event()
+        self.logger = logging.getLogger("scheduler")
+
+    def can_run(self, job: Job, slot: Slot) -> bool:
+        return slot.device.device.name == job.device and (
+            job.slot is None or job.slot == slot.name
+        )
+
+    def find_slot(self, job: Job) -> Optional[Slot]:
+        """find a free slot to run job on, raising UserError if no slot
+        could ever run it"""
+        matching = [slot for slot in self.slots if self.can_run(job, slot)]
+        if not matching:
+            raise UserError(f"no slot can run jobs for device {job.device}")
+
+        with self.lock:
+            for slot in matching:
+                if slot.name not in self.busy:
+                    return slot
+        return None
+
+    def start_job(
+        self, job: Job, slot: Slot, on_finished: Callable[[SlotResult], None]
+    ) -> threading.Thread:
+        """start running job on slot in a new thread, calling on_finished
+        (from that thread) with the result"""
+        try:
+            steps_and_args = self.runner.parse_step_args(slot.device, list(job.steps))
+        except SystemExit:
+            # argparse has already printed the details
+            raise UserError("invalid arguments in job steps")
+
+        context_args = self.runner.get_slot_context_args(slot, self.context_args_parsed)
+
+        def run():
+            result = self.runner.run_slot(slot, steps_and_args, context_args)
+            try:
+                on_finished(result)
+            finally:
+                with self.lock:
+                    del self.busy[slot.name]
+                self.job_finished.set()
+
+        thread = threading.Thread(target=run, name=slot.name)
+        with self.lock:
+            self.busy[slot.name] = thread
+        thread.start()
+        return thread
+
+    def schedule(self, queue: JobQueueDir) -> List[threading.Thread]:
+        """start as many pending jobs from queue as possible, returning the
+        new job threads"""
+        threads = []
+        for path, job in queue.pending():
+            try:
+                slot = self.find_slot(job)
+            except UserError as e:
+                self.logger.error(f"{path.name}: {e}")
+                queue.finish(queue.start(path), {"ok": False, "error": str(e)})
+                continue
+            if slot is None:
+                continue
+
+            running_path = queue.start(path)
+            self.logger.info(f"running {path.name} on {slot.name}")
+
+            def on_finished(result: SlotResult, running_path=running_path):
+                queue.finish(running_path, result_to_dict(result))
+
+            try:
+                threads.append(self.start_job(job, slot, on_finished))
+            except UserError as e:
+                self.logger.error(f"{path.name}: {e}")
+                queue.finish(running_path, {"ok": False, "error": str(e)})
+        return threads
+
+    def run_queue_dir(self, queue: JobQueueDir, poll_interval: float = 1.0):
+        """run jobs from queue forever"""
+        self.logger.info(f"waiting for jobs in {queue.path}")
+        while True:
+            self.job_finished.clear()
+            self.schedule(queue)
+            self.job_finished.wait(poll_interval)
+
+
+def result_to_dict(result: SlotResult) -> Dict[str, Any]:
+    return dict(
+        ok=result.error is None,
+        error=None if result.error is None else str(result.error),
+        slot=result.slot.name,
+        duration=result.duration,
+    )
@@ -1,10 +1,29 @@
+import asyncio
 import logging
+from collections import deque
+from concurrent.futures import Future
 from dataclasses import dataclass
-from queue import Queue, Empty
+import functools
+import itertools
+import os
 import re
+import selectors
 import serial
 import serial.threaded
-from typing import Optional
+import threading
+import time
+from typing import Callable, Deque, List, Optional, Sequence, Tuple, Union
+from .exceptions import Timeout
+from .limits import (
+    check_deadline,
+    is_cancelled,
+    limit_timeout,
+    notify_on_cancel,
+    wake_on_cancel,
+)
+from .timing import span
+from . import metrics
+from .events import SerialRx, SerialTx, bus, lines_logger, thread_slot
 from .registry import Context
 
 
@@ -23,30 +42,305 @@ class PartialLine(SerialData):
     pass
 
 
+class LineSplitter:
+    """incrementally split a stream of bytes into lines
+
+    Only newly received bytes are searched for the separator, so the cost of
+    feeding data is linear in its length, however long the lines are.
+
+    The unterminated tail is reported as a PartialLine so that prompts can be
+    matched, but consumers should not be flooded with near-identical copies of
+    a long tail. A changed tail is always reported when the stream goes idle
+    (the sender has paused, as it does at a prompt). While data is still
+    arriving, a tail of at most partial_bytes is reported at most once per
+    partial_interval seconds; once longer, it is only reported each time its
+    length doubles, so the total size of partial lines stays proportional to
+    the size of the stream, except for one copy per pause.
+    """
+
+    def __init__(self, sep: bytes = b"\r\n", partial_bytes=1024, partial_interval=0.1):
+        self.sep = sep
+        self.partial_bytes = partial_bytes
+        self.partial_interval = partial_interval
+
+        self.buffer = bytearray()
+        # position in buffer to start searching for sep from
+        self.search_pos = 0
+        # length of the tail when it was last reported, and when
+        self.partial_len = 0
+        self.partial_time = float("-inf")
+
+    def feed(self, data: bytes, idle: bool = True) -> List[SerialData]:
+        """add data to the buffer, returning any lines (and possibly a partial
+        line) which can be emitted
+
+        idle should be true if no more data is known to be waiting
+        """
+        self.buffer += data
+
+        lines: List[SerialData] = []
+        start = 0
+        while True:
+            end = self.buffer.find(self.sep, self.search_pos)
+            if end < 0:
+                break
+            lines.append(Line(bytes(self.buffer[start:end])))
+            start = self.search_pos = end + len(self.sep)
+
+        if start:
+            del self.buffer[:start]
+            self.partial_len = 0
+        # the separator may be split between this chunk and the next
+        self.search_pos = max(0, len(self.buffer) - len(self.sep) + 1)
+
+        if len(self.buffer) > self.partial_len:
+            now = time.monotonic()
+            if idle:
+                emit = True
+            elif len(self.buffer) <= self.partial_bytes:
+                emit = now - self.partial_time >= self.partial_interval
+            else:
+                emit = len(self.buffer) >= 2 * self.partial_len
+
+            if emit:
+                lines.append(PartialLine(bytes(self.buffer)))
+                self.partial_len = len(self.buffer)
+                self.partial_time = now
+
+        return lines
+
+
+@dataclass
+class HistoryEntry:
+    seq: int
+    time: float
+    item: SerialData
+
+
+class SerialHistory:
+    """bounded record of received lines, which can be read by any number of
+    consumers
+
+    Entries are numbered by an increasing sequence number; consumers keep
+    their own position (the sequence number of the next entry to read), so
+    reading does not remove anything, and a consumer can start reading from
+    the current position, a previously recorded position, or from some time
+    in the past.
+
+    The oldest entries are dropped once the total size (counting
+    entry_overhead bytes per entry) exceeds max_bytes, so memory use is flat
+    however long the session.
+    """
+
+    entry_overhead = 100
+
+    def __init__(self, max_bytes: int = 4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries: Deque[HistoryEntry] = deque()
+        self.size = 0
+        self.next_seq = 0
+        self.cond = threading.Condition()
+        # events to set (in their loops) when an entry is added, for read_async
+        self.async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def put(self, item: SerialData):
+        with self.cond:
+            self.entries.append(HistoryEntry(self.next_seq, time.monotonic(), item))
+            self.next_seq += 1
+            self.size += len(item.data) + self.entry_overhead
+
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                dropped = self.entries.popleft()
+                self.size -= len(dropped.item.data) + self.entry_overhead
+
+            self.cond.notify_all()
+            for loop, event in self.async_waiters:
+                loop.call_soon_threadsafe(event.set)
+
+    def seq_since(self, seconds: float) -> int:
+        """get the position of the first entry received in the last seconds"""
+        start_time = time.monotonic() - seconds
+        with self.cond:
+            seq = self.next_seq
+            for entry in reversed(self.entries):
+                if entry.time < start_time:
+                    break
+                seq = entry.seq
+            return seq
+
+    def read(self, seq: int, timeout: Optional[float] = None) -> List[HistoryEntry]:
+        """get all entries from position seq onwards, waiting up to timeout
+        seconds for one to be available
+
+        returns an empty list on timeout; if entries after seq have been
+        dropped, the returned entries start later than seq
+        """
+        with notify_on_cancel(self.cond), self.cond:
+            if not self.cond.wait_for(
+                lambda: self.next_seq > seq or is_cancelled(), timeout
+            ):
+                return []
+            return self._entries_from(seq)
+
+    async def read_async(
+        self, seq: int, timeout: Optional[float] = None
+    ) -> List[HistoryEntry]:
+        """like read, but waits on the running event loop rather than
+        blocking"""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self.cond:
+            self.async_waiters.append(waiter)
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with wake_on_cancel(lambda: loop.call_soon_threadsafe(waiter[1].set)):
+                while True:
+                    waiter[1].clear()
+                    with self.cond:
+                        if self.next_seq > seq:
+                            return self._entries_from(seq)
+                    if is_cancelled():
+                        return []
+
+                    remaining = remaining_time(deadline)
+                    try:
+                        await asyncio.wait_for(waiter[1].wait(), remaining)
+                    except asyncio.TimeoutError:
+                        return []
+        finally:
+            with self.cond:
+                self.async_waiters.remove(waiter)
+
+    def _entries_from(self, seq: int) -> List[HistoryEntry]:
+        # must be called with self.cond held
+        new_entries = list(
+            itertools.takewhile(lambda entry: entry.seq >= seq, reversed(self.entries))
+        )
+        new_entries.reverse()
+        return new_entries
+
+
+def remaining_time(deadline: Optional[float]) -> Optional[float]:
+    """time in seconds until a time.monotonic deadline, or None for none"""
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+Pattern = Union[bytes, "re.Pattern[bytes]"]
+
+
+def describe_patterns(patterns: Sequence[Pattern]) -> str:
+    return " or ".join(repr(pattern) for pattern in patterns)
+
+
+# backreferences (\1, (?P=name)) and conditionals ((?(1)...)); this may
+# also match escaped backslashes, which only stops patterns being combined
+group_reference_re = re.compile(rb"\\[1-9]|\(\?P=|\(\?\(")
+
+
+def has_group_reference(pattern: "re.Pattern[bytes]") -> bool:
+    return pattern.groups > 0 and group_reference_re.search(pattern.pattern) is not None
+
+
+class PatternSet:
+    """a list of regexes which can be matched against a line in one pass
+
+    Where possible the patterns are combined into one alternation, so that
+    lines which match none of them (nearly all of them) are only scanned once.
+    """
+
+    def __init__(self, patterns: Sequence[Pattern]):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+
+        self.combined: Optional[re.Pattern[bytes]] = None
+        # flags are not preserved when combining, and group numbers are
+        # shifted (breaking numbered references), so patterns using them are
+        # matched one by one
+        default_flags = re.compile(b"").flags
+        if all(
+            pattern.flags == default_flags and not has_group_reference(pattern)
+            for pattern in self.patterns
+        ):
+            try:
+                self.combined = re.compile(
+                    b"|".join(
+                        b"(?P<_expect_%d>%s)" % (i, pattern.pattern)
+                        for i, pattern in enumerate(self.patterns)
+                    )
+                )
+            except re.error:
+                pass
+
+    def match(self, data: bytes) -> Optional[Tuple[int, "re.Match[bytes]"]]:
+        """match data against the patterns
+
+        returns the index of the first pattern which matches and its match
+        object, or None if none match
+        """
+        if self.combined is not None:
+            combined_match = self.combined.match(data)
+            if combined_match is None:
+                return None
+            assert combined_match.lastgroup is not None
+            index = int(combined_match.lastgroup[len("_expect_") :])
+            match = self.patterns[index].match(data)
+            assert match is not None
+            return index, match
+        else:
+            for index, pattern in enumerate(self.patterns):
+                match = pattern.match(data)
+                if match is not None:
+                    return index, match
+            return None
+
+
+@functools.lru_cache(maxsize=64)
+def compile_patterns(patterns: Tuple[Pattern, ...]) -> PatternSet:
+    return PatternSet(patterns)
+
+
 class SerialProtocol(serial.threaded.Protocol):
-    def __init__(self, logger: logging.Logger, queue: Queue[SerialData], sep=b"\r\n"):
+    def __init__(
+        self,
+        logger: logging.Logger,
+        history: SerialHistory,
+        sep=b"\r\n",
+        port: str = "",
+        slot: Optional[str] = None,
+    ):
         super().__init__()
         self.logger = logger
-        self.queue = queue
-        self.sep = sep
-        self.buffer = b""
+        self.history = history
+        # for events, which are emitted from the reader thread
+        self.port = port
+        self.slot = slot
+        self.lines_logger = lines_logger(f"serial.{port}")
+        self.splitter = LineSplitter(sep)
+        self.transport = None
 
     def connection_made(self, transport):
         super().connection_made(transport)
+        self.transport = transport
         self.logger.info("connection made")
 
+    def is_idle(self) -> bool:
+        """is there no more data waiting to be read?"""
+        if self.transport is None:
+            return True
+        return self.transport.serial.in_waiting == 0
+
     def data_received(self, data):
         super().data_received(data)
+        if metrics.registry.enabled:
+            metrics.serial_received.inc(len(data), self.port)
 
-        self.buffer += data
-        parts = self.buffer.split(self.sep)
-        for part in parts[:-1]:
-            self.queue.put(Line(part))
-            self.logger.info(f"rx: {part!r}")
-
-        if parts[-1]:
-            self.queue.put(PartialLine(parts[-1]))
-        self.buffer = parts[-1]
+        for line in self.splitter.feed(data, idle=self.is_idle()):
+            self.history.put(line)
+            if isinstance(line, Line):
+                self.lines_logger.debug("rx: %r", line.data)
+                if bus.enabled:
+                    bus.emit(SerialRx(self.port, line.data), self.slot)
 
     def connection_lost(self, exc):
         if exc is not None:
@@ -55,18 +349,156 @@ class SerialProtocol(serial.threaded.Protocol):
         self.logger.info("connection closed")
 
 
+class SerialMux:
+    """services any number of serial ports from a single thread using
+    selectors, as an alternative to a serial.threaded.ReaderThread per port
+
+    Use get() to get the shared instance, whose thread is started on first
+    use.
+    """
+
+    _instance: Optional["SerialMux"] = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "SerialMux":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+        # calls to run in the mux thread, and a pipe to wake it up
+        self.calls: List[Tuple[Callable[[], None], Future]] = []
+        self.calls_lock = threading.Lock()
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+
+        self.thread = threading.Thread(target=self.run, name="serial-mux", daemon=True)
+        self.thread.start()
+
+    def call(self, fn: Callable[[], None]):
+        """run fn in the mux thread, waiting for it to complete; exceptions
+        raised by fn are raised here"""
+        if threading.current_thread() is self.thread:
+            fn()
+            return
+
+        future: Future = Future()
+        with self.calls_lock:
+            self.calls.append((fn, future))
+        os.write(self.wake_write, b"x")
+        future.result()
+
+    def run(self):
+        # nothing may raise out of this loop, as every port (and every later
+        # call) depends on it
+        while True:
+            for key, _events in self.selector.select():
+                if key.data is None:
+                    os.read(self.wake_read, 4096)
+                    with self.calls_lock:
+                        calls, self.calls = self.calls, []
+                    for fn, future in calls:
+                        try:
+                            fn()
+                        except BaseException as e:
+                            future.set_exception(e)
+                        else:
+                            future.set_result(None)
+                else:
+                    try:
+                        key.data.read_ready()
+                    except Exception:
+                        logging.getLogger("serial").exception("error reading")
+                        # stop reading, rather than failing on every select
+                        self.selector.unregister(key.fileobj)
+
+
+class MuxReader:
+    """reads from a serial port using a SerialMux, dispatching to a protocol
+    like serial.threaded.ReaderThread"""
+
+    read_size = 4096
+
+    def __init__(
+        self,
+        serial_instance: serial.Serial,
+        protocol_factory: Callable[[], serial.threaded.Protocol],
+        mux: Optional[SerialMux] = None,
+    ):
+        self.serial = serial_instance
+        self.protocol_factory = protocol_factory
+        self.mux = mux if mux is not None else SerialMux.get()
+        self.protocol: Optional[serial.threaded.Protocol] = None
+
+    def start(self):
+        self.protocol = self.protocol_factory()
+        self.protocol.connection_made(self)
+        fd = self.serial.fileno()
+        self.mux.call(
+            lambda: self.mux.selector.register(fd, selectors.EVENT_READ, self)
+        )
+
+    def stop(self):
+        self.mux.call(lambda: self.disconnect(None))
+
+    def disconnect(self, exc: Optional[Exception]):
+        # called in the mux thread
+        if self.protocol is None:
+            return
+        self.mux.selector.unregister(self.serial.fileno())
+        protocol, self.protocol = self.protocol, None
+        protocol.connection_lost(exc)
+
+    def read_ready(self):
+        # called in the mux thread
+        assert self.protocol is not None
+        try:
+            data = os.read(self.serial.fileno(), self.read_size)
+            if not data:
+                raise serial.SerialException("device disconnected")
+        except (OSError, serial.SerialException) as e:
+            self.disconnect(e)
+            return
+
+        try:
+            self.protocol.data_received(data)
+        except Exception as e:
+            self.disconnect(e)
+
+
 class Serial(Context):
-    def __init__(self, serial_port: Optional[str] = None):
+    def __init__(self, serial_port: Optional[str] = None, serial_mux: bool = False):
+        # serial_mux: read using one thread shared between all ports, rather
+        # than a thread per port
         assert serial_port is not None
         self.serial = serial.Serial(serial_port, 115200)
         assert hasattr(self.serial, "cancel_read")
-        self.logger = logging.getLogger("serial")
-        self.queue: Queue[SerialData] = Queue()
+        # named after the port, to tell ports apart in fleet runs
+        self.port = os.path.basename(serial_port)
+        self.logger = logging.getLogger(f"serial.{self.port}")
+        self.lines_logger = lines_logger(f"serial.{self.port}")
+        self.history = SerialHistory()
+        # position in history of the next line to be matched by expect
+        self.cursor = 0
 
         def make_protocol():
-            return SerialProtocol(self.logger, self.queue)
+            return SerialProtocol(
+                self.logger,
+                self.history,
+                port=self.port,
+                slot=thread_slot(),
+            )
 
-        self.protocol = serial.threaded.ReaderThread(self.serial, make_protocol)
+        self.protocol: Union[serial.threaded.ReaderThread, MuxReader]
+        if serial_mux:
+            self.protocol = MuxReader(self.serial, make_protocol)
+        else:
+            self.protocol = serial.threaded.ReaderThread(self.serial, make_protocol)
 
     def __enter__(self):
         self.protocol.start()
@@ -80,30 +512,140 @@ class Serial(Context):
             self.serial.baudrate = baudrate
 
     def clear(self):
-        while True:
-            try:
-                self.queue.get_nowait()
-            except Empty:
-                break
+        """ignore everything received so far in future waits"""
+        self.cursor = self.history.next_seq
 
-    def wait_for(self, regex):
-        while True:
-            line = self.queue.get()
-            if isinstance(line, Line):
-                match = re.match(regex, line.data)
-                if match is not None:
-                    return match
+    def mark(self) -> int:
+        """get the current position in the history, which can be passed as
+        start to expect to match lines received after this point"""
+        return self.history.next_seq
+
+    def since(self, seconds: float) -> int:
+        """get the position in the history of the first line received in the
+        last seconds, which can be passed as start to expect"""
+        return self.history.seq_since(seconds)
+
+    def expect(
+        self,
+        patterns: Sequence[Pattern],
+        timeout: Optional[float] = None,
+        partial: bool = False,
+        start: Optional[int] = None,
+    ) -> Tuple[int, "re.Match[bytes]"]:
+        """wait for a line matching any of patterns
+
+        returns the index of the first pattern which matched and its match
+        object; raises Timeout if no line matched within timeout seconds
+
+        if partial is true, partial lines (e.g. prompts) are matched too
 
-    def wait_for_partial(self, regex):
+        matching starts at start (see mark and since) if specified, or after
+        the line matched by the previous wait, and future waits will start
+        after the matched line
+        """
+        pattern_set = compile_patterns(tuple(patterns))
+        timeout = limit_timeout(timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        seq = self.cursor if start is None else start
+
+        with span(lambda: f"wait for {describe_patterns(patterns)}", "serial"):
+            while True:
+                entries = self.history.read(seq, timeout=remaining_time(deadline))
+                result, seq = self._match_entries(pattern_set, entries, seq, partial)
+                if result is not None:
+                    return result
+                if not entries:
+                    check_deadline()
+                    self._expect_timeout(patterns, timeout)
+
+    async def expect_async(
+        self,
+        patterns: Sequence[Pattern],
+        timeout: Optional[float] = None,
+        partial: bool = False,
+        start: Optional[int] = None,
+    ) -> Tuple[int, "re.Match[bytes]"]:
+        """awaitable version of expect"""
+        pattern_set = compile_patterns(tuple(patterns))
+        timeout = limit_timeout(timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        seq = self.cursor if start is None else start
+
+        with span(lambda: f"wait for {describe_patterns(patterns)}", "serial"):
+            while True:
+                entries = await self.history.read_async(
+                    seq, timeout=remaining_time(deadline)
+                )
+                result, seq = self._match_entries(pattern_set, entries, seq, partial)
+                if result is not None:
+                    return result
+                if not entries:
+                    check_deadline()
+                    self._expect_timeout(patterns, timeout)
+
+    def _match_entries(
+        self,
+        pattern_set: PatternSet,
+        entries: List[HistoryEntry],
+        seq: int,
+        partial: bool,
+    ) -> Tuple[Optional[Tuple[int, "re.Match[bytes]"]], int]:
+        """match entries read from seq, returning the result (if any) and the
+        position to continue from, which is also saved to self.cursor"""
+        if entries and entries[0].seq != seq:
+            self.logger.warning(
+                f"{entries[0].seq - seq} lines dropped from history before matching"
+            )
+
+        for entry in entries:
+            seq = entry.seq + 1
+            if partial or isinstance(entry.item, Line):
+                result = pattern_set.match(entry.item.data)
+                if result is not None:
+                    self.cursor = seq
+                    return result, seq
+
+        self.cursor = seq
+        return None, seq
+
+    def _expect_timeout(self, patterns: Sequence[Pattern], timeout: Optional[float]):
+        raise Timeout(
+            f"timed out after {timeout}s waiting for serial output matching "
+            + describe_patterns(patterns)
+        )
+
+    def wait_for(
+        self, regex, timeout: Optional[float] = None, start: Optional[int] = None
+    ):
+        _index, match = self.expect([regex], timeout=timeout, start=start)
+        return match
+
+    def wait_for_partial(
+        self, regex, timeout: Optional[float] = None, start: Optional[int] = None
+    ):
         """match partial or full lines"""
-        while True:
-            line = self.queue.get()
-            match = re.match(regex, line.data)
-            if match is not None:
-                return match
+        _index, match = self.expect([regex], timeout=timeout, partial=True, start=start)
+        return match
+
+    async def wait_for_async(
+        self, regex, timeout: Optional[float] = None, start: Optional[int] = None
+    ):
+        _index, match = await self.expect_async([regex], timeout=timeout, start=start)
+        return match
+
+    async def wait_for_partial_async(
+        self, regex, timeout: Optional[float] = None, start: Optional[int] = None
+    ):
+        """match partial or full lines"""
+        _index, match = await self.expect_async(
+            [regex], timeout=timeout, partial=True, start=start
+        )
+        return match
 
     def write(self, data):
-        self.logger.info(f"tx: {data}")
+        self.lines_logger.debug("tx: %r", data)
+        if bus.enabled:
+            bus.emit(SerialTx(self.port, data))
         self.serial.write(data)
 
     def miniterm(self, **kwargs):
@@ -1,82 +1,496 @@
+import asyncio
 import logging
 import time
 import socket
-from .misc import sha256
+from collections import defaultdict, deque
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Deque, Dict, Generator, List, Optional, Tuple
+from . import metrics
+from .events import SshOutput, bus, lines_logger, thread_slot
+from .exceptions import Timeout
+from .limits import check_deadline, limit_timeout, wake_on_cancel
+from .timing import span
+import hashlib
+import os
 import subprocess
-
+import threading
 
 logger = logging.getLogger("ssh")
+output_logger = lines_logger("ssh")
 
 base_args = "-Fnone -oUserKnownHostsFile=/dev/null -oStrictHostKeyChecking=no".split()
 
 
-def wait_for_ssh(address):
-    def can_connect():
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(1)
+class SshSession:
+    """shares one SSH connection per host between ssh and scp commands, using
+    OpenSSH connection multiplexing, so that the key exchange (which is slow
+    on embedded devices) happens once per host rather than once per command
+
+    The connection to a host is made by the first command run with
+    args(), and is closed by close(). options are extra ssh options, which
+    are used for all commands.
+    """
+
+    def __init__(self, options: List[str] = []):
+        self.options = options
+        self.control_dir = TemporaryDirectory(prefix="autoflash_ssh")
+
+    def args(self) -> List[str]:
+        """arguments for ssh or scp, before the host"""
+        return [
+            *base_args,
+            *self.options,
+            "-oControlMaster=auto",
+            # %C is a hash of the host, port and user
+            f"-oControlPath={self.control_dir.name}/%C",
+            "-oControlPersist=yes",
+        ]
+
+    def close(self):
+        """close all connections"""
+        for control_path in Path(self.control_dir.name).iterdir():
+            # the host is not used, as the control path is given
+            subprocess.run(
+                ["ssh", *base_args, f"-oControlPath={control_path}", "-Oexit", "-"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        self.control_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def ssh_args(session: Optional[SshSession]) -> List[str]:
+    return session.args() if session is not None else base_args
+
+
+#: recent times from starting to wait for SSH to it being ready, by device
+#: name; bounded, as the daemon runs indefinitely
+ready_times: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=100))
+
+
+def is_banner(line: bytes) -> bool:
+    return line.startswith(b"SSH-")
+
+
+def ssh_ready(address: str, elapsed: float, name: Optional[str]):
+    logger.info(f"ssh on {address} ready after {elapsed:.2f}s")
+    if name is not None:
+        ready_times[name].append(elapsed)
+    if metrics.registry.enabled:
+        metrics.ssh_ready_time.observe(elapsed, metrics.slot_label(thread_slot()))
+
+
+def backoff_delays(min_delay: float, max_delay: float):
+    delay = min_delay
+    while True:
+        yield delay
+        delay = min(delay * 2, max_delay)
+
+
+def wait_for_ssh_steps(
+    address: str,
+    timeout: Optional[float],
+    port: int,
+    name: Optional[str],
+    min_delay: float,
+    max_delay: float,
+) -> Generator[Tuple[str, float], Any, float]:
+    """the logic shared by wait_for_ssh and wait_for_ssh_async, without the
+    I/O
+
+    This yields ("probe", attempt_timeout), to be sent the error from
+    probing the server (or None if it is ready), and ("sleep", delay), to be
+    sent True if the sleep was cut short by a wakeup, which resets the
+    backoff. It returns the time taken.
+    """
+    timeout = limit_timeout(timeout)
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    last_error = None
+
+    delays = backoff_delays(min_delay, max_delay)
+    while True:
+        attempt_timeout = 1.0
+        if deadline is not None:
+            attempt_timeout = max(
+                min(attempt_timeout, deadline - time.monotonic()), 0.01
+            )
+
+        error = yield "probe", attempt_timeout
+        if error is None:
+            elapsed = time.monotonic() - start
+            ssh_ready(address, elapsed, name)
+            return elapsed
+
+        # only log changes, as this retries quickly
+        if error != last_error:
+            logger.info(f"waiting for {address}:{port} ({error})")
+            last_error = error
+
+        delay = next(delays)
+        check_deadline()
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            raise Timeout(f"timed out after {timeout}s waiting for ssh on {address}")
+        woken = yield "sleep", delay
+        if woken:
+            delays = backoff_delays(min_delay, max_delay)
+
+
+def probe_banner(address: str, port: int, timeout: float) -> Optional[str]:
+    """connect to an SSH server and read its banner, returning None if it is
+    ready or a description of the problem"""
+    try:
+        with socket.create_connection((address, port), timeout) as s:
+            with s.makefile("rb") as f:
+                line = f.readline(256)
+        return None if is_banner(line) else f"bad banner {line!r}"
+    except socket.timeout:
+        return "timed out"
+    except OSError as e:
+        return e.strerror or str(e)
+
+
+async def probe_banner_async(address: str, port: int, timeout: float) -> Optional[str]:
+    async def read_banner():
+        reader, writer = await asyncio.open_connection(address, port)
+        try:
+            return await reader.readline()
+        finally:
+            writer.close()
+
+    try:
+        line = await asyncio.wait_for(read_banner(), timeout)
+        return None if is_banner(line) else f"bad banner {line!r}"
+    except asyncio.TimeoutError:
+        return "timed out"
+    except OSError as e:
+        return e.strerror or str(e)
+
+
+def wait_for_ssh(
+    address: str,
+    timeout: Optional[float] = None,
+    port: int = 22,
+    name: Optional[str] = None,
+    min_delay: float = 0.05,
+    max_delay: float = 0.25,
+    wake: Optional[threading.Event] = None,
+) -> float:
+    """wait for an SSH server on address to send its banner, retrying with
+    backoff from min_delay to max_delay; a server which accepts connections
+    but closes them or doesn't send a banner is not ready
+
+    if wake is given, setting it (for example when the device says that it
+    has finished booting) causes an immediate retry, and resets the backoff
+
+    returns the time taken, which is also recorded in ready_times[name]
+    """
+    steps = wait_for_ssh_steps(address, timeout, port, name, min_delay, max_delay)
+    with span(f"wait for ssh on {address}", "ssh"):
+        result: Any = None
+        while True:
             try:
-                s.connect((address, 22))
-            except socket.timeout:
-                logger.info(f"waiting for {address}:22")
-                return False
-            except OSError:
-                logger.info(f"error connecting to {address}:22; waiting...")
-                return False
-        return True
+                action, value = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+            if action == "probe":
+                result = probe_banner(address, port, value)
+            elif wake is None:
+                time.sleep(value)
+                result = False
+            else:
+                result = wake.wait(value)
+                if result:
+                    wake = None
+
+
+async def wait_for_ssh_async(
+    address: str,
+    timeout: Optional[float] = None,
+    port: int = 22,
+    name: Optional[str] = None,
+    min_delay: float = 0.05,
+    max_delay: float = 0.25,
+) -> float:
+    steps = wait_for_ssh_steps(address, timeout, port, name, min_delay, max_delay)
+    with span(f"wait for ssh on {address}", "ssh"):
+        result: Any = None
+        while True:
+            try:
+                action, value = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+
+            if action == "probe":
+                result = await probe_banner_async(address, port, value)
+            else:
+                await asyncio.sleep(value)
+                result = False
+
+
+@dataclass
+class UploadProgress:
+    sent: int
+    size: int
+    elapsed: float
+
+    @property
+    def throughput(self) -> float:
+        """in bytes/s"""
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """estimated time remaining in seconds"""
+        if self.sent == 0:
+            return None
+        return (self.size - self.sent) / self.throughput
+
+    def __str__(self):
+        eta = f"{self.eta:.0f}s" if self.eta is not None else "?"
+        return (
+            f"{self.sent / 1e6:.1f} of {self.size / 1e6:.1f}MB, "
+            f"{self.throughput / 1e6:.2f}MB/s, ETA {eta}"
+        )
 
-    while not can_connect():
-        time.sleep(1)
 
+def log_progress(progress: UploadProgress):
+    logger.info(f"uploaded {progress}")
 
-def do_sysupgrade_ssh(address, sysupgrade_fname, options="-v"):
-    checksum = sha256(sysupgrade_fname)
 
+def upload_command(fname: str) -> str:
+    """shell command to receive a file written by stream_upload to fname
+
+    Only the file is sent, so it is just the rest of stdin; BusyBox head -c
+    reads past the requested size (and may be missing), so the checksum
+    can't follow it. It is checked by verify_command instead.
+    """
+    return f"cat > {fname}"
+
+
+def verify_command(fname: str, checksum: str, then: str) -> str:
+    """shell command to run then if the sha256 of fname is checksum"""
+    return f'echo "{checksum}  {fname}" | sha256sum -c > /dev/null && {then}'
+
+
+def stream_upload(
+    f,
+    dest,
+    size: int,
+    on_progress: Callable[[UploadProgress], None] = log_progress,
+    progress_interval: float = 2.0,
+    block_size: int = 1024 * 1024,
+    checksum: Optional[str] = None,
+) -> str:
+    """write size bytes from file f to the unbuffered stream dest, returning
+    their sha256, which is calculated while sending so that f is only read
+    once
+
+    if checksum is given (because the file was hashed earlier) it is returned
+    instead, so that verify_command rejects the file if it has changed since
+
+    on_progress is called (and UploadProgress events emitted) at most every
+    progress_interval seconds, and at the end
+    """
+
+    def progress(p: UploadProgress):
+        if bus.enabled:
+            bus.emit(p)
+        on_progress(p)
+
+    h = hashlib.sha256() if checksum is None else None
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+
+    start = time.monotonic()
+    next_progress = start + progress_interval
+    sent = 0
+    while sent < size:
+        n = f.readinto(view[: min(block_size, size - sent)])
+        if not n:
+            raise Exception(f"file ended after {sent} of {size} bytes")
+        if h is not None:
+            h.update(view[:n])
+
+        written = 0
+        while written < n:
+            written += dest.write(view[written:n])
+        sent += n
+
+        now = time.monotonic()
+        if now >= next_progress:
+            progress(UploadProgress(sent, size, now - start))
+            next_progress = now + progress_interval
+
+    if h is not None:
+        checksum = h.hexdigest()
+    assert checksum is not None
+    final = UploadProgress(sent, size, time.monotonic() - start)
+    progress(final)
+    if metrics.registry.enabled and final.elapsed > 0:
+        metrics.upload_throughput.observe(
+            final.throughput, metrics.slot_label(thread_slot())
+        )
+    return checksum
+
+
+def run_ssh_streaming(
+    address: str,
+    command: str,
+    session: Optional[SshSession],
+    deadline: Optional[float],
+    what: str,
+    send: Optional[Callable[[Any], None]] = None,
+) -> Tuple[int, List[bytes]]:
+    """run command on address, logging (and emitting) its output as it
+    arrives; send, if given, is called with ssh's stdin, which is closed
+    afterwards
+
+    ssh is killed at deadline (a time.monotonic() value, or None), or if the
+    current deadline is cancelled, raising Timeout or Cancelled. Returns the
+    exit code and the output lines.
+    """
+    args = ["ssh", *ssh_args(session), f"root@{address}", command]
+    proc = subprocess.Popen(
+        args,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=0,
+    )
+    assert proc.stdin is not None and proc.stdout is not None
+
+    # output is read in a thread so that ssh doesn't block writing it while
+    # stdin is being sent
+    lines = []
+    slot = thread_slot()
+
+    def read_output():
+        while line := proc.stdout.readline():
+            lines.append(line)
+            output_logger.debug("%r", line.strip())
+            if bus.enabled:
+                bus.emit(SshOutput(address, line), slot)
+
+    reader = threading.Thread(target=read_output)
+    reader.start()
+
+    # killing ssh unblocks both the upload and the reader
+    killed = threading.Event()
+
+    def kill():
+        killed.set()
+        proc.kill()
+
+    watchdog = None
+    if deadline is not None:
+        watchdog = threading.Timer(max(0.0, deadline - time.monotonic()), kill)
+        watchdog.start()
+
+    try:
+        with wake_on_cancel(kill):
+            if send is not None:
+                send(proc.stdin)
+    except BrokenPipeError:
+        # ssh exited early; the output should say why
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        with wake_on_cancel(kill):
+            rc = proc.wait()
+        reader.join()
+        if watchdog is not None:
+            watchdog.cancel()
+
+    if killed.is_set():
+        check_deadline()
+        raise Timeout(f"timed out {what}")
+    return rc, lines
+
+
+def do_sysupgrade_ssh(
+    address,
+    sysupgrade_fname,
+    options="-v",
+    on_progress: Callable[[UploadProgress], None] = log_progress,
+    session: Optional[SshSession] = None,
+    checksum: Optional[str] = None,
+    timeout: Optional[float] = None,
+):
+    """upload sysupgrade_fname to the device at address and run sysupgrade
+    on it; checksum is the sha256 of the file, if it is already known
+
+    The image is uploaded by one ssh command, hashing it as it is sent, and
+    checked and installed by a second; pass a session so that they share a
+    connection.
+
+    ssh is killed if this takes longer than timeout, or the current step
+    deadline; the default wait timeout is not used, as uploads can be slow
+    """
+    timeout = limit_timeout(timeout, use_default=False)
+    deadline = None if timeout is None else time.monotonic() + timeout
     fname = "/tmp/sysupgrade.bin"
-    commands = [
-        f"cat > {fname}",
-        f'echo "{checksum}  {fname}" | sha256sum -c > /dev/null',
-        f"sysupgrade {options} {fname}",
-    ]
-    command = " && ".join(commands)
+
+    with open(sysupgrade_fname, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        sent: List[str] = []
+
+        def send(stdin):
+            sent.append(stream_upload(f, stdin, size, on_progress, checksum=checksum))
+
+        with span("upload", "ssh", size=size):
+            rc, lines = run_ssh_streaming(
+                address, upload_command(fname), session, deadline, "uploading", send
+            )
+        if rc != 0 or not sent:
+            raise Exception("upload failed")
+
+    command = verify_command(fname, sent[0], f"sysupgrade {options} {fname}")
     # run in login shell so that sysupgrade sees the $FAILSAFE variable
     # command must be 100% naturally single-quote free
     command = f"exec $SHELL -l -c '{command}'"
-
-    with open(sysupgrade_fname, "rb") as f:
-        args = ["ssh", *base_args, f"root@{address}", command]
-        proc = subprocess.Popen(
-            args,
-            stdin=f,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+    with span("sysupgrade", "ssh"):
+        rc, lines = run_ssh_streaming(
+            address, command, session, deadline, "running sysupgrade"
         )
 
-        # normally sysupgrade will close the ssh shell, causing ssh to fail;
-        # detect this and don't raise an error even if ssh exits non-zeroly
-        lines = []
-        while line := proc.stdout.readline():
-            lines.append(line)
-            logger.info(line.strip())
-        rc = proc.wait()
+    # normally sysupgrade will close the ssh shell, causing ssh to fail;
+    # detect this and don't raise an error even if ssh exits non-zeroly
+    commencing_str = b"Commencing upgrade. Closing all shell sessions"
+    has_commencing = any(commencing_str in line for line in lines)
 
-        commencing_str = b"Commencing upgrade. Closing all shell sessions"
-        has_commencing = any(commencing_str in line for line in lines)
+    if rc != 0 and not has_commencing:
+        raise Exception("ssh failed")
 
-        if rc != 0 and not has_commencing:
-            raise Exception("ssh failed")
 
+def run_limited(args, **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run, limited by the default wait timeout and the current
+    deadline"""
+    try:
+        return subprocess.run(args, timeout=limit_timeout(None), **kwargs)
+    except subprocess.TimeoutExpired as e:
+        check_deadline()
+        raise Timeout(f"timed out after {e.timeout}s running {args[0]}")
 
-def run_command(address, args):
-    full_args = ["ssh", *base_args, address, *args]
-    result = subprocess.run(
-        full_args,
-        check=True,
-        capture_output=True,
-    )
+
+def run_command(address, args, session: Optional[SshSession] = None):
+    full_args = ["ssh", *ssh_args(session), address, *args]
+    result = run_limited(full_args, check=True, capture_output=True)
 
     return result.stdout
 
 
-def scp_file(address, remote_file, local_file):
-    full_args = ["scp", *base_args, f"{address}:{remote_file}", local_file]
-    subprocess.run(full_args, check=True)
+def scp_file(address, remote_file, local_file, session: Optional[SshSession] = None):
+    full_args = ["scp", *ssh_args(session), f"{address}:{remote_file}", local_file]
+    run_limited(full_args, check=True)
@@ -0,0 +1,103 @@
+from .artifacts import ArtifactStore
+from .misc import sha256
+import os
+import pytest
+import time
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "image.bin"
+    path.write_bytes(os.urandom(100000))
+    return path
+
+
+def test_stage(tmp_path, image):
+    store = ArtifactStore(tmp_path / "store")
+
+    with store.stage({"initramfs.bin": image}) as a, store.stage(
+        {"dir/initramfs.bin": str(image)}
+    ) as b:
+        a_path = a.path / "initramfs.bin"
+        b_path = b.path / "dir/initramfs.bin"
+        assert a_path.read_bytes() == b_path.read_bytes() == image.read_bytes()
+        # both boots share one stored file
+        assert a_path.stat().st_ino == b_path.stat().st_ino
+
+        objects = [path for path in store.objects_dir.iterdir() if not path.suffix]
+        assert [path.name for path in objects] == [sha256(image)]
+
+    assert not a.path.exists() and not b.path.exists()
+    assert list(store.staging_dir.iterdir()) == []
+
+
+def test_modified(tmp_path, image):
+    store = ArtifactStore(tmp_path / "store")
+    first = store.add(image)
+
+    # modify in place, which affects the stored file if it was hardlinked
+    time.sleep(0.01)
+    with open(image, "r+b") as f:
+        f.write(b"modified")
+
+    second = store.add(image)
+    assert second.digest != first.digest
+    assert second.path.read_bytes() == image.read_bytes()
+
+    first_again = store.add(second.path)
+    assert first_again.digest == second.digest
+
+
+def test_evict(tmp_path):
+    store = ArtifactStore(tmp_path / "store", max_size=250000, max_age=100)
+
+    images = []
+    for i in range(3):
+        path = tmp_path / f"image{i}.bin"
+        path.write_bytes(os.urandom(100000))
+        images.append(path)
+
+    a = store.add(images[0])
+    with store.stage({"image": images[1]}):
+        # make the first two old
+        old = time.time() - 50
+        for digest in a.digest, sha256(images[1]):
+            os.utime(store.objects_dir / f"{digest}.meta", (old, old))
+
+        # over max_size; image0 is evicted, but image1 is in use
+        c = store.add(images[2])
+        assert not a.path.exists()
+        assert (store.objects_dir / sha256(images[1])).exists()
+        assert c.path.exists()
+
+        # too old, but still in use
+        old = time.time() - 200
+        os.utime(store.objects_dir / f"{c.digest}.meta", (old, old))
+        os.utime(store.objects_dir / f"{sha256(images[1])}.meta", (old, old))
+        store.evict()
+        assert not c.path.exists()
+        assert (store.objects_dir / sha256(images[1])).exists()
+
+    store.evict()
+    assert list(store.objects_dir.iterdir()) == []
+
+
+def test_stale_staging(tmp_path, image):
+    store = ArtifactStore(tmp_path / "store")
+    staged = store.stage({"image": image})
+
+    # as if the process died without cleaning up
+    stale = store.staging_dir / "stale"
+    os.rename(staged.path, stale)
+    staged.path = tmp_path / "nonexistent"
+    for fd in staged.lock_fds:
+        os.close(fd)
+    staged.lock_fds.clear()
+
+    store.evict()
+    assert stale.exists()
+
+    old = time.time() - 100
+    os.utime(stale, (old, old))
+    store.evict()
+    assert not stale.exists()
@@ -1,6 +1,18 @@
-from .cli import Step, Runner, Context
+from . import metrics
+from .cli import Step, Runner, Context, UserError
+from .exceptions import Cancelled, Timeout
+from .limits import Limits, check_deadline, is_cancelled, limit_timeout
+from .limits import notify_on_cancel
 from .registry import Device, DeviceRegistry
 from typing import Optional
+import asyncio
+import json
+import logging
+import pytest
+import subprocess
+import sys
+import threading
+import time
 
 
 def ex_fn(
@@ -68,8 +80,32 @@ def flash(sysupgrade: str, sysupgrade_args: str = "-v"):
     record_call(flash, sysupgrade=sysupgrade, sysupgrade_args=sysupgrade_args)
 
 
+@device.register_step
+async def wait(serial: Serial, seconds: float = 0.0):
+    await asyncio.sleep(seconds)
+    record_call(wait, serial=serial, seconds=seconds)
+
+
+@device.register_step
+def fail(serial: Serial):
+    if serial.serial_port == "/fail":
+        raise Exception("failed")
+
+
+@device.register_step
+def hang(serial: Serial):
+    """wait until timed out or cancelled, like waits for a device"""
+    cond = threading.Condition()
+    with notify_on_cancel(cond), cond:
+        cancelled = cond.wait_for(is_cancelled, limit_timeout(None))
+    check_deadline()
+    if not cancelled:
+        raise Timeout("timed out waiting for nothing")
+
+
 registry = DeviceRegistry()
 registry.devices.append(device)
+registry.add_context(Limits)
 
 
 def test_runner():
@@ -102,3 +138,198 @@ def test_runner():
     call_record.clear()
     runner.parse_and_run(args)
     check_calls(serial_path="/foo", sysupgrade_args="-w")
+
+
+def test_runner_async():
+    runner = Runner(registry)
+
+    call_record.clear()
+    runner.parse_and_run("testdev wait --seconds=0.01 boot initrd.bin".split())
+
+    [serial_init, serial_enter, wait_call, boot_call, serial_exit] = call_record
+    serial = serial_init[1]["self"]
+    assert serial_enter == (Serial.__enter__, dict(self=serial))
+    assert wait_call == (wait, dict(serial=serial, seconds=0.01))
+    assert boot_call == (boot, dict(serial=serial, initrd="initrd.bin"))
+    assert serial_exit == (Serial.__exit__, dict(self=serial))
+
+
+def test_runner_fleet():
+    runner = Runner(registry)
+
+    args = [
+        "--slot=testdev,serial-port=/a",
+        "--slot=testdev,serial-port=/b",
+        "fleet",
+        "boot",
+        "initrd.bin",
+    ]
+
+    call_record.clear()
+    runner.parse_and_run(args)
+
+    inits = [args for f, args in call_record if f is Serial.__init__]
+    boots = [args for f, args in call_record if f is boot]
+    assert sorted(init["serial_port"] for init in inits) == ["/a", "/b"]
+    assert sorted(id(boot["serial"]) for boot in boots) == sorted(
+        id(init["self"]) for init in inits
+    )
+
+    args = ["--slot=testdev", "--slot=testdev,serial-port=/fail", "fleet", "fail"]
+    with pytest.raises(UserError, match="1 of 2 slots failed"):
+        runner.parse_and_run(args)
+
+
+def test_runner_step_timeout():
+    runner = Runner(registry)
+
+    call_record.clear()
+    start = time.monotonic()
+    with pytest.raises(Timeout, match="step hang timed out after 0.2s"):
+        runner.parse_and_run("--step-timeout=0.2 testdev boot x hang".split())
+    assert time.monotonic() - start < 1.0
+    assert call_record[-1][0] is Serial.__exit__
+
+    # the default wait timeout applies to waits without their own timeout
+    with pytest.raises(Timeout):
+        runner.parse_and_run("--wait-timeout=0.1 testdev hang".split())
+
+
+@pytest.mark.parametrize("step", ["hang", "wait --seconds=10"])
+def test_runner_cancel(step):
+    runner = Runner(registry)
+    errors = []
+
+    def run():
+        try:
+            runner.parse_and_run(f"testdev {step}".split())
+        except Exception as e:
+            errors.append(e)
+
+    call_record.clear()
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    runner.cancel()
+    thread.join()
+
+    assert time.monotonic() - start < 1.0
+    assert call_record[-1][0] is Serial.__exit__
+    assert len(errors) == 1 and isinstance(errors[0], Cancelled)
+
+
+def test_runner_timing(tmp_path):
+    runner = Runner(registry)
+    timing_path = tmp_path / "timing.json"
+    trace_path = tmp_path / "trace.json"
+
+    runner.parse_and_run(
+        [
+            f"--timing={timing_path}",
+            f"--trace={trace_path}",
+            "--slot=testdev",
+            "fleet",
+            "boot",
+            "initrd.bin",
+            "wait",
+            "--seconds=0.05",
+        ]
+    )
+
+    spans = json.loads(timing_path.read_text())["spans"]
+    assert [(s["name"], s["slot"]) for s in spans] == [
+        ("boot", "slot0"),
+        ("wait", "slot0"),
+    ]
+    assert spans[1]["duration"] >= 0.05
+
+    trace = json.loads(trace_path.read_text())
+    assert [e["name"] for e in trace["traceEvents"] if e["ph"] == "X"] == [
+        "boot",
+        "wait",
+    ]
+
+
+# maximum total import time for 'autoflash list', in seconds
+list_import_budget = 1.0
+
+
+def test_list_startup():
+    """check that 'autoflash list' doesn't import device modules or pyroute2,
+    and that imports take less than list_import_budget"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "autoflash.cli", "list"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert "bt_homehub-v5a" in result.stdout
+
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:"):
+            self_us, _cumulative_us, name = line[len("import time:") :].split("|")
+            if self_us.strip().isdigit():
+                import_times[name.strip()] = int(self_us) / 1e6
+
+    assert "autoflash.registry" in import_times
+    assert not any(name.startswith("autoflash.devices.") for name in import_times)
+    assert "pyroute2" not in import_times
+    assert sum(import_times.values()) < list_import_budget
+
+
+@device.register_step
+def check_lines():
+    record_call(check_lines, level=logging.getLogger("lines").level)
+
+
+def test_runner_log_lines():
+    runner = Runner(registry)
+    level = logging.getLogger("lines").level
+
+    for args, expected in [
+        ("testdev check_lines", logging.NOTSET),
+        ("--no-log-lines testdev check_lines", logging.WARNING),
+        ("--slot=testdev fleet check_lines", logging.WARNING),
+        ("--log-lines --slot=testdev fleet check_lines", logging.DEBUG),
+    ]:
+        call_record.clear()
+        runner.parse_and_run(args.split())
+        assert call_record == [(check_lines, dict(level=expected))]
+        # restored afterwards
+        assert logging.getLogger("lines").level == level
+
+
+def test_runner_events(tmp_path):
+    runner = Runner(registry)
+    events_path = tmp_path / "events.jsonl"
+
+    runner.parse_and_run(
+        [f"--events={events_path}", "--slot=testdev", "fleet", "boot", "initrd.bin"]
+    )
+
+    events = [json.loads(line) for line in events_path.read_text().splitlines()]
+    assert [(e["event"], e["slot"]) for e in events] == [
+        ("StepStarted", "slot0"),
+        ("StepFinished", "slot0"),
+    ]
+    assert events[1]["data"]["error"] is None
+
+
+def test_runner_metrics():
+    runner = Runner(registry)
+    labels = ("testdev", "slot0")
+    started = metrics.flashes_started.get(*labels)
+    succeeded = metrics.flashes_succeeded.get(*labels)
+
+    runner.parse_and_run(
+        ["--metrics=127.0.0.1:0", "--slot=testdev", "fleet", "boot", "initrd.bin"]
+    )
+
+    assert metrics.flashes_started.get(*labels) == started + 1
+    assert metrics.flashes_succeeded.get(*labels) == succeeded + 1
+    boot = metrics.step_duration.get("testdev", "boot", "slot0")
+    assert boot is not None and boot.count >= 1
+    # disabled again once the server is stopped
+    assert not metrics.registry.enabled
@@ -0,0 +1,147 @@
+from .cli import Runner, Slot
+from .client import run_command
+from .daemon import Daemon, remove_stale_socket
+from .exceptions import UserError
+from .registry import Context, Device, DeviceRegistry
+from typing import List, Optional, Tuple
+import io
+import logging
+import os
+import pytest
+import socket
+import threading
+import time
+
+events: List[Tuple] = []
+
+
+class Serial(Context):
+    def __init__(self, serial_port: Optional[str] = None):
+        self.serial_port = serial_port
+
+    def __enter__(self):
+        events.append(("enter", self.serial_port))
+
+    def __exit__(self):
+        events.append(("exit", self.serial_port))
+
+
+device = Device("testarch", "testdev")
+
+
+@device.register_step
+def boot(serial: Serial, initrd: str):
+    logging.getLogger("test_daemon").info(f"booting {initrd}")
+    events.append(("boot", serial.serial_port, initrd))
+
+
+@device.register_step
+def fail(serial: Serial):
+    raise Exception("failed")
+
+
+release = threading.Event()
+
+
+@device.register_step
+def slow(serial: Serial):
+    logging.getLogger("test_daemon").info("slow started")
+    release.wait(10)
+    logging.getLogger("test_daemon").info("slow finished")
+
+
+registry = DeviceRegistry()
+registry.devices.append(device)
+
+
+def test_daemon(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    runner = Runner(registry)
+    slots = [
+        Slot("a", runner.devices["testdev"], dict(serial_port="/a")),
+        Slot("b", runner.devices["testdev"], dict(serial_port="/b")),
+    ]
+    daemon = Daemon(runner, slots, {Serial: dict(serial_port=None)})
+
+    socket_path = str(tmp_path / "socket")
+    server_thread = threading.Thread(target=daemon.serve, args=(socket_path,))
+    server_thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket_path):
+            assert server_thread.is_alive(), "daemon failed to start"
+            assert time.monotonic() < deadline, "timed out waiting for the daemon"
+            time.sleep(0.01)
+
+        log = io.StringIO()
+        assert run_command(socket_path, "--slot b testdev boot 1.bin".split(), log)
+        assert "booting 1.bin" in log.getvalue()
+        assert run_command(socket_path, "--slot b testdev boot 2.bin".split())
+
+        # contexts are kept open between commands
+        assert events == [
+            ("enter", "/b"),
+            ("boot", "/b", "1.bin"),
+            ("boot", "/b", "2.bin"),
+        ]
+
+        # and reopened after failures
+        events.clear()
+        log = io.StringIO()
+        assert not run_command(socket_path, "--slot b testdev fail".split(), log)
+        assert "failed" in log.getvalue()
+        assert run_command(socket_path, "--slot b testdev boot 3.bin".split())
+        assert events == [("exit", "/b"), ("enter", "/b"), ("boot", "/b", "3.bin")]
+
+        assert not run_command(socket_path, "otherdev boot 1.bin".split(), log)
+        assert not run_command(socket_path, "testdev nonexistent".split(), log)
+
+        # a client waiting for a busy slot only gets the log for its request
+        warm_slot = daemon.warm_slots["b"]
+        logs = [io.StringIO(), io.StringIO()]
+        commands = ["--slot b testdev slow", "--slot b testdev boot 4.bin"]
+        clients = []
+        for i, command in enumerate(commands):
+            clients.append(
+                threading.Thread(
+                    target=run_command, args=(socket_path, command.split(), logs[i])
+                )
+            )
+            clients[-1].start()
+            while warm_slot.load != i + 1:
+                time.sleep(0.01)
+        release.set()
+        for client in clients:
+            client.join()
+
+        assert "slow finished" in logs[0].getvalue()
+        assert "booting 4.bin" not in logs[0].getvalue()
+        assert "booting 4.bin" in logs[1].getvalue()
+        assert "slow" not in logs[1].getvalue()
+    finally:
+        daemon.server.shutdown()
+        server_thread.join()
+
+    assert events[-1] == ("exit", "/b")
+
+
+def test_stale_socket(tmp_path):
+    socket_path = str(tmp_path / "socket")
+    remove_stale_socket(socket_path)
+
+    # not a socket, so not removed
+    (tmp_path / "socket").write_text("")
+    with pytest.raises(UserError, match="not a socket"):
+        remove_stale_socket(socket_path)
+    os.unlink(socket_path)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(socket_path)
+        sock.listen()
+        with pytest.raises(UserError, match="another daemon"):
+            remove_stale_socket(socket_path)
+
+    # the socket file is left behind, but nothing is listening
+    assert os.path.exists(socket_path)
+    remove_stale_socket(socket_path)
+    assert not os.path.exists(socket_path)
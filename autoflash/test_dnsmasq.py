@@ -0,0 +1,170 @@
+from .artifacts import ArtifactStore
+from .dnsmasq import DhcpHost, DhcpLease, DhcpRange, Dnsmasq, TftpSent, parse_log_line
+from .exceptions import Timeout, UserError
+from pathlib import Path
+import pytest
+import sys
+import textwrap
+
+
+@pytest.fixture
+def fake_dnsmasq(tmp_path, monkeypatch):
+    """install a fake dnsmasq on the PATH, running the given bash script"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}:/usr/bin:/bin")
+
+    def install(script, interpreter="/bin/bash"):
+        path = bin_dir / "dnsmasq"
+        path.write_text(f"#!{interpreter}\n" + textwrap.dedent(script))
+        path.chmod(0o755)
+
+    return install
+
+
+def test_startup(tmp_path, fake_dnsmasq):
+    fake_dnsmasq("""
+        sleep 0.1
+        echo "dnsmasq: started, version 2.90 DNS disabled" >&2
+        exec sleep 100
+        """)
+    image = tmp_path / "image.bin"
+    image.write_bytes(b"image")
+
+    store = ArtifactStore(tmp_path / "store")
+    with Dnsmasq(tftp={"initramfs.bin": image}, store=store) as dnsmasq:
+        assert dnsmasq.startup_time is not None
+        assert 0.1 <= dnsmasq.startup_time < 1.0
+        assert (dnsmasq.tftp_root / "initramfs.bin").read_bytes() == b"image"
+
+
+def test_startup_failure(fake_dnsmasq):
+    fake_dnsmasq("""
+        echo "dnsmasq: failed to create listening socket: Address in use" >&2
+        exit 2
+        """)
+    with pytest.raises(UserError, match="(?s)failed to start.*Address in use"):
+        with Dnsmasq():
+            pass
+
+
+def test_parse_log_line():
+    assert parse_log_line(
+        "dnsmasq-tftp: sent /tmp/x/initramfs.bin to 192.168.1.1", 1.0
+    ) == TftpSent(1.0, Path("/tmp/x/initramfs.bin"), "192.168.1.1")
+    assert parse_log_line(
+        "Oct 17 12:00:00 dnsmasq-dhcp[123]: "
+        "DHCPACK(eth0) 192.168.1.100 aa:bb:cc:dd:ee:ff myhost",
+        2.0,
+    ) == DhcpLease(2.0, "eth0", "192.168.1.100", "aa:bb:cc:dd:ee:ff", "myhost")
+    assert parse_log_line(
+        "dnsmasq-dhcp: BOOTP(eth0) 192.168.1.101 aa:bb:cc:dd:ee:00", 3.0
+    ) == DhcpLease(3.0, "eth0", "192.168.1.101", "aa:bb:cc:dd:ee:00", None)
+    assert parse_log_line("dnsmasq-dhcp: DHCPDISCOVER(eth0) aa:bb", 4.0) is None
+    assert parse_log_line("dnsmasq: read /etc/hosts - 2 names", 5.0) is None
+
+
+def test_events(tmp_path, fake_dnsmasq):
+    """check events from a burst of leases, measuring the latency from the
+    log line being written to the event being received"""
+    n_leases = 1000
+    fake_dnsmasq(
+        f"""
+        import sys, time
+        tftp_root = [a for a in sys.argv if a.startswith("--tftp-root=")][0][12:]
+        print("dnsmasq: started, version 2.90 DNS disabled", file=sys.stderr)
+        time.sleep(0.1)
+        for i in range({n_leases}):
+            mac = f"02:00:00:00:{{i // 256:02x}}:{{i % 256:02x}}"
+            print(
+                f"dnsmasq-dhcp: DHCPACK(eth0) 10.0.{{i // 256}}.{{i % 256}} {{mac}} "
+                f"{{time.time()!r}}",
+                file=sys.stderr,
+                flush=True,
+            )
+        print(
+            f"dnsmasq-tftp: sent {{tftp_root}}/initramfs.bin to 10.0.0.1",
+            file=sys.stderr,
+            flush=True,
+        )
+        time.sleep(100)
+        """,
+        interpreter=sys.executable,
+    )
+    image = tmp_path / "image.bin"
+    image.write_bytes(b"image")
+
+    store = ArtifactStore(tmp_path / "store")
+    with Dnsmasq(tftp={"initramfs.bin": image}, store=store) as dnsmasq:
+        lease = dnsmasq.wait_for_dhcp("02:00:00:00:00:05", timeout=5)
+        assert lease.address == "10.0.0.5"
+
+        start = 0
+        latencies = []
+        for _i in range(n_leases):
+            lease = dnsmasq.wait_for_dhcp(timeout=5, start=start)
+            latencies.append(lease.time - float(lease.hostname))
+            start += 1
+        assert lease.mac == "02:00:00:00:03:e7"
+
+        sent = dnsmasq.wait_for_tftp("initramfs.bin", timeout=5)
+        assert sent.address == "10.0.0.1"
+
+        with pytest.raises(Timeout):
+            dnsmasq.wait_for_tftp(timeout=0.01, start=dnsmasq.mark())
+
+    latencies.sort()
+    print(
+        f"lease event latency: median {latencies[len(latencies) // 2] * 1e6:.0f}us, "
+        f"max {latencies[-1] * 1e6:.0f}us"
+    )
+    assert latencies[-1] < 1.0
+
+
+def test_hosts(tmp_path, fake_dnsmasq):
+    """serve different files to two clients, checking that each can be
+    waited for"""
+    args_path = tmp_path / "args"
+    fake_dnsmasq(f"""
+        echo "$@" > {args_path}
+        echo "dnsmasq: started, version 2.90 DNS disabled" >&2
+        sleep 0.1
+        for i in 1 2; do
+            echo "dnsmasq-dhcp: DHCPACK(eth0) 10.0.0.$i 02:00:00:00:00:0$i" >&2
+        done
+        root=$(echo "$@" | grep -o -- '--tftp-root=[^ ]*' | cut -d= -f2)
+        echo "dnsmasq-tftp: sent $root/b.bin to 10.0.0.2" >&2
+        sleep 0.1
+        echo "dnsmasq-tftp: sent $root/a.bin to 10.0.0.1" >&2
+        exec sleep 100
+        """)
+    images = {}
+    for name in "a.bin", "b.bin", "c.bin":
+        images[name] = tmp_path / name
+        images[name].write_bytes(name.encode())
+
+    store = ArtifactStore(tmp_path / "store")
+    with Dnsmasq(
+        tftp=images,
+        store=store,
+        ranges=[DhcpRange("10.0.0.100,10.0.0.200", "c.bin")],
+        hosts=[
+            DhcpHost("02:00:00:00:00:01", "10.0.0.1", "a.bin"),
+            DhcpHost("02:00:00:00:00:02", boot_file="b.bin"),
+        ],
+    ) as dnsmasq:
+        sent = dnsmasq.wait_for_tftp(timeout=5, mac="02:00:00:00:00:01")
+        assert sent.path.name == "a.bin"
+        sent = dnsmasq.wait_for_tftp("b.bin", timeout=5, mac="02:00:00:00:00:02")
+        assert sent.address == "10.0.0.2"
+
+        with pytest.raises(Timeout):
+            dnsmasq.wait_for_tftp("a.bin", timeout=0.2, mac="02:00:00:00:00:02")
+
+    args = args_path.read_text().split()
+    assert "--dhcp-range=set:range0,10.0.0.100,10.0.0.200" in args
+    assert "--dhcp-boot=tag:range0,c.bin" in args
+    assert "--dhcp-host=02:00:00:00:00:01,set:host0,10.0.0.1" in args
+    assert "--dhcp-boot=tag:host0,a.bin" in args
+    assert "--dhcp-host=02:00:00:00:00:02,set:host1" in args
+    assert "--dhcp-boot=tag:host1,b.bin" in args
@@ -0,0 +1,95 @@
+from .events import EventBus, JsonLinesSink, SerialRx, StepFinished, open_sink
+from .exceptions import UserError
+import io
+import json
+import pytest
+import socket
+import threading
+
+
+class Stream(io.BytesIO):
+    def close(self):
+        # keep the contents readable after the sink is closed
+        pass
+
+
+def test_disabled():
+    bus = EventBus()
+    assert not bus.enabled
+    # nothing is recorded without sinks
+    bus.emit(SerialRx("ttyUSB0", b"hello"))
+
+
+def test_sink():
+    bus = EventBus()
+    stream = Stream()
+    sink = JsonLinesSink(stream)
+    bus.add_sink(sink)
+    assert bus.enabled
+
+    bus.emit(SerialRx("ttyUSB0", b"U-Boot \xff"), slot="slot0")
+    thread = threading.Thread(target=bus.emit, args=(StepFinished("boot", 1.5),))
+    thread.autoflash_slot = "slot1"  # type: ignore
+    thread.start()
+    thread.join()
+
+    bus.remove_sink(sink)
+    assert not bus.enabled
+    sink.close()
+
+    rx, finished = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert rx["event"] == "SerialRx" and rx["slot"] == "slot0"
+    assert rx["data"] == dict(port="ttyUSB0", data="U-Boot \\xff")
+    assert finished["slot"] == "slot1"
+    assert finished["data"] == dict(step="boot", duration=1.5, error=None)
+    assert rx["time"] <= finished["time"]
+
+
+def test_sink_full():
+    class BlockedStream(Stream):
+        def __init__(self):
+            super().__init__()
+            self.writing = threading.Event()
+            self.unblock = threading.Event()
+
+        def write(self, data):
+            self.writing.set()
+            self.unblock.wait()
+            return super().write(data)
+
+    stream = BlockedStream()
+    sink = JsonLinesSink(stream, max_queued=2)
+    sink.put((0.0, None, StepFinished("first", 0.0)))
+    stream.writing.wait()
+
+    # the writer is blocked, so once the queue is full records are dropped
+    # rather than blocking emit
+    for i in range(10):
+        sink.put((0.0, None, StepFinished(f"step{i}", 0.0)))
+    assert sink.dropped == 8
+    stream.unblock.set()
+    sink.close()
+    assert len(stream.getvalue().splitlines()) == 3
+
+
+def test_unix_socket(tmp_path):
+    path = str(tmp_path / "events.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    sink = open_sink(f"unix:{path}")
+    conn, _addr = server.accept()
+    sink.put((0.0, "slot0", SerialRx("ttyUSB0", b"hello")))
+    sink.close()
+
+    with conn, server:
+        line = conn.makefile("rb").readline()
+    assert json.loads(line)["data"]["data"] == "hello"
+
+
+def test_open_sink_errors(tmp_path):
+    with pytest.raises(UserError):
+        open_sink(str(tmp_path / "missing" / "events.jsonl"))
+    with pytest.raises(UserError):
+        open_sink(f"unix:{tmp_path / 'missing.sock'}")
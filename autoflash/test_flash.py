@@ -0,0 +1,58 @@
+from .exceptions import UserError
+from .flash import ImagePrefetch, MarkerWatch, init_complete
+from .serial import Serial
+import hashlib
+import os
+import pytest
+import time
+
+
+def test_image_prefetch(tmp_path):
+    image = tmp_path / "image.bin"
+    image.write_bytes(os.urandom(3 * 1024 * 1024 + 5))
+    prefetch = ImagePrefetch(str(image))
+    assert prefetch.result() == hashlib.sha256(image.read_bytes()).hexdigest()
+
+    image.write_bytes(b"")
+    with pytest.raises(UserError):
+        ImagePrefetch(str(image)).result()
+
+    with pytest.raises(FileNotFoundError):
+        ImagePrefetch(str(tmp_path / "missing.bin")).result()
+
+
+@pytest.fixture
+def serial():
+    master, slave = os.openpty()
+    with Serial(os.ttyname(slave)) as port:
+        os.close(slave)
+        port.master = master
+        yield port
+    os.close(master)
+
+
+def test_marker_watch(serial):
+    marker = b"[   12.400000] procd: - init complete -\r\n"
+    os.write(serial.master, marker)
+    serial.wait_for(init_complete, timeout=5)
+
+    # lines before start are ignored
+    cursor = serial.cursor
+    with MarkerWatch(serial, init_complete, serial.mark()) as watch:
+        os.write(serial.master, b"[   12.345678] br-lan: port 1 entered forwarding\r\n")
+        assert not watch.seen.wait(0.1)
+
+        os.write(serial.master, marker)
+        assert watch.seen.wait(5)
+        assert watch.seen_time is not None
+
+    # the foreground cursor is left alone, so waits there still see the lines
+    assert serial.cursor == cursor
+    serial.wait_for(rb".*br-lan", timeout=5)
+
+    # close stops waiting if the marker never arrives
+    start = time.monotonic()
+    with MarkerWatch(serial, init_complete, serial.mark()) as watch:
+        pass
+    assert not watch.seen.is_set()
+    assert time.monotonic() - start < 1.0
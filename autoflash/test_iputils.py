@@ -0,0 +1,179 @@
+from . import iputils
+from .exceptions import Timeout
+import errno
+import os
+import pytest
+import socket
+import subprocess
+import threading
+import time
+
+
+def get_addresses():
+    with iputils.iproute() as ipr:
+        names = {
+            link["index"]: link.get_attr("IFLA_IFNAME") for link in ipr.get_links()
+        }
+        return {
+            (names[addr["index"]], addr.get_attr("IFA_LOCAL"), addr["prefixlen"])
+            for addr in ipr.get_addr(family=socket.AF_INET)
+            if names[addr["index"]] != "lo"
+        }
+
+
+def test_setup_ipv4(veth):
+    ifname, _peer = veth
+
+    iputils.setup_ipv4(ifname, "192.168.1.2")
+    iputils.setup_ipv4(ifname, "192.168.1.2")
+    assert get_addresses() == {(ifname, "192.168.1.2", 24)}
+
+    iputils.setup_ipv4(ifname, "192.168.88.10", prefixlen=16)
+    assert get_addresses() == {(ifname, "192.168.88.10", 16)}
+
+    with iputils.iproute() as ipr:
+        [link] = ipr.get_links(ipr.link_lookup(ifname=ifname)[0])
+        assert link["flags"] & 1
+
+
+def test_setup_ipv4_vlan(veth):
+    ifname, _peer = veth
+    iputils.setup_ipv4(ifname, "192.168.1.2")
+
+    try:
+        iputils.setup_ipv4(ifname, "10.0.0.2", vlan=5)
+    except Exception as e:
+        if getattr(e, "code", None) == errno.EOPNOTSUPP:
+            pytest.skip("VLANs are not supported")
+        raise
+    assert get_addresses() == {(f"{ifname}.5", "10.0.0.2", 24)}
+
+    iputils.setup_ipv4(ifname, "10.0.1.2", vlan=6)
+    assert get_addresses() == {(f"{ifname}.6", "10.0.1.2", 24)}
+
+    with iputils.iproute() as ipr:
+        assert ipr.link_lookup(ifname=f"{ifname}.5") == []
+        [link] = ipr.get_links(ipr.link_lookup(ifname=f"{ifname}.6")[0])
+        assert link["flags"] & 1
+
+    iputils.setup_ipv4(ifname, "192.168.1.2")
+    assert get_addresses() == {(ifname, "192.168.1.2", 24)}
+
+
+def test_make_netns(veth):
+    _ifname, peer = veth
+    name = f"aftest_{os.getpid()}_inner"
+
+    iputils.make_netns(name, [peer])
+    try:
+        # already moved
+        iputils.make_netns(name, [peer])
+
+        with iputils.iproute() as ipr:
+            assert ipr.link_lookup(ifname=peer) == []
+        with iputils.in_netns(name):
+            iputils.setup_ipv4(peer, "192.168.1.1")
+            assert get_addresses() == {(peer, "192.168.1.1", 24)}
+    finally:
+        iputils.del_netns(name)
+
+
+def test_setup_ipv4_benchmark(veth):
+    """compare setup_ipv4 on an already-configured interface with just the
+    three ip processes that the subprocess implementation ran in this case"""
+    ifname, _peer = veth
+    n = 50
+
+    iputils.setup_ipv4(ifname, "192.168.1.2")
+    start = time.perf_counter()
+    for _i in range(n):
+        iputils.setup_ipv4(ifname, "192.168.1.2")
+    netlink_time = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    for _i in range(n):
+        for cmd in ["link", "show", "type", "vlan"], ["addr", "show"], ["link", "show"]:
+            subprocess.check_output(["ip", "-j"] + cmd)
+    subprocess_time = (time.perf_counter() - start) / n
+
+    print(
+        f"setup_ipv4: netlink {netlink_time * 1000:.2f}ms, "
+        f"subprocess >= {subprocess_time * 1000:.2f}ms"
+    )
+    assert netlink_time < subprocess_time
+
+
+def set_up(ifname, up=True):
+    with iputils.iproute() as ipr:
+        ipr.link(
+            "set", index=iputils.get_index(ipr, ifname), state="up" if up else "down"
+        )
+
+
+def test_wait_for_carrier(veth):
+    ifname, peer = veth
+    iputils.ensure_up(ifname, None)
+
+    # the peer is down, so there's no carrier
+    with pytest.raises(Timeout):
+        iputils.wait_for_carrier(ifname, timeout=0.1)
+
+    up_time = None
+
+    def bring_up():
+        nonlocal up_time
+        time.sleep(0.2)
+        up_time = time.monotonic()
+        set_up(peer)
+
+    # threads start in the same network namespace
+    thread = threading.Thread(target=bring_up)
+    thread.start()
+    iputils.wait_for_carrier(ifname, timeout=5)
+    latency = time.monotonic() - up_time
+    thread.join()
+    print(f"carrier latency: {latency * 1000:.2f}ms")
+    assert latency < 0.5
+
+    # already up
+    iputils.wait_for_carrier(ifname, timeout=0.1)
+
+
+def test_wait_for_neighbour(veth):
+    ifname, peer = veth
+    name = f"aftest_{os.getpid()}_inner"
+
+    iputils.setup_ipv4(ifname, "10.9.0.1")
+    iputils.make_netns(name, [peer])
+    try:
+        with pytest.raises(Timeout):
+            iputils.wait_for_neighbour("10.9.0.2", timeout=0.2)
+
+        up_time = None
+
+        def bring_up():
+            nonlocal up_time
+            time.sleep(0.3)
+            with iputils.in_netns(name):
+                iputils.setup_ipv4(peer, "10.9.0.2")
+            up_time = time.monotonic()
+
+        thread = threading.Thread(target=bring_up)
+        thread.start()
+        iputils.wait_for_neighbour("10.9.0.2", timeout=5)
+        latency = time.monotonic() - up_time
+        thread.join()
+        print(f"neighbour latency: {latency * 1000:.2f}ms")
+        assert latency < 0.5
+
+        # already resolved, but it's asked again
+        iputils.wait_for_neighbour("10.9.0.2", timeout=0.1)
+
+        # an entry from before the call doesn't count: the peer is gone (as
+        # U-Boot is once it has booted the kernel), but its entry remains
+        with iputils.in_netns(name):
+            iputils.setup_ipv4(peer, "10.9.0.3")
+        with pytest.raises(Timeout):
+            iputils.wait_for_neighbour("10.9.0.2", timeout=0.3)
+    finally:
+        iputils.del_netns(name)
@@ -0,0 +1,84 @@
+from .exceptions import Cancelled, Timeout, UserError
+from .limits import Limits, deadline, limit_timeout, retry
+from .serial import SerialHistory
+import pytest
+import threading
+import time
+
+
+def test_limit_timeout():
+    assert limit_timeout(None) is None
+    assert limit_timeout(5.0) == 5.0
+
+    with deadline(None, "outer", wait_timeout=3.0):
+        assert limit_timeout(None) == 3.0
+        assert limit_timeout(None, use_default=False) is None
+        assert limit_timeout(5.0) == 5.0
+
+        with deadline(1.0, "inner"):
+            # the default wait timeout is inherited, and limited
+            assert 0.9 < limit_timeout(None) <= 1.0
+            assert limit_timeout(0.5) == 0.5
+
+            time.sleep(1.0)
+            with pytest.raises(Timeout, match="inner timed out after 1.0s"):
+                limit_timeout(None)
+
+        assert limit_timeout(None) == 3.0
+
+
+def test_retry_wait_timeout():
+    # nothing times out by default, even waits which could be retried
+    assert Limits().retry_wait_timeout() is None
+    assert Limits(wait_timeout=10).retry_wait_timeout() is None
+    assert Limits(retries=2).retry_wait_timeout() == Limits.retry_timeout
+
+
+def test_retry():
+    attempts = []
+
+    def fail_twice():
+        attempts.append(time.monotonic())
+        if len(attempts) <= 2:
+            raise UserError("failed")
+        return "ok"
+
+    assert retry(fail_twice, 2, "test") == "ok"
+    assert len(attempts) == 3
+
+    attempts.clear()
+    with pytest.raises(UserError):
+        retry(fail_twice, 1, "test")
+    assert len(attempts) == 2
+
+    # other exceptions are not retried
+    def error():
+        attempts.append(time.monotonic())
+        raise ValueError()
+
+    attempts.clear()
+    with pytest.raises(ValueError):
+        retry(error, 2, "test")
+    assert len(attempts) == 1
+
+
+def test_cancel_wakes_waits():
+    history = SerialHistory()
+
+    with deadline(None, "test") as test_deadline:
+        started = threading.Event()
+
+        def cancel():
+            started.wait()
+            time.sleep(0.1)
+            test_deadline.cancel()
+
+        threading.Thread(target=cancel).start()
+        start = time.monotonic()
+        started.set()
+        result = history.read(0)
+        assert time.monotonic() - start < 0.5
+        assert result == []
+
+        with pytest.raises(Cancelled, match="test was cancelled"):
+            limit_timeout(None)
@@ -0,0 +1,56 @@
+from .exceptions import UserError
+from .metrics import MetricsRegistry, MetricsServer
+import pytest
+import urllib.request
+
+
+def test_exposition():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_total", "a counter", ["port"])
+    histogram = registry.histogram("test_seconds", "a histogram", ["slot"], [1, 5])
+
+    counter.inc(10, "ttyUSB0")
+    counter.inc(5, "ttyUSB0")
+    counter.inc(1, 'a"b\\')
+    for value in [0.5, 1, 3, 10]:
+        histogram.observe(value, "slot0")
+
+    assert registry.expose().splitlines() == [
+        "# HELP test_total a counter",
+        "# TYPE test_total counter",
+        r'test_total{port="a\"b\\"} 1.0',
+        'test_total{port="ttyUSB0"} 15.0',
+        "# HELP test_seconds a histogram",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{slot="slot0",le="1.0"} 2',
+        'test_seconds_bucket{slot="slot0",le="5.0"} 3',
+        'test_seconds_bucket{slot="slot0",le="+Inf"} 4',
+        'test_seconds_sum{slot="slot0"} 14.5',
+        'test_seconds_count{slot="slot0"} 4',
+    ]
+
+    with pytest.raises(ValueError):
+        counter.inc(1)
+
+
+def test_server():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_total", "a counter")
+
+    with MetricsServer("127.0.0.1:0", registry) as server:
+        assert registry.enabled
+        counter.inc(1)
+        url = f"http://127.0.0.1:{server.port}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "test_total 1.0" in response.read().decode().splitlines()
+    assert not registry.enabled
+
+
+def test_bad_address():
+    with pytest.raises(UserError):
+        MetricsServer("localhost")
+
+    with MetricsServer("127.0.0.1:0") as server:
+        with pytest.raises(UserError, match="can't serve"):
+            MetricsServer(f"127.0.0.1:{server.port}")
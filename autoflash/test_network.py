@@ -0,0 +1,80 @@
+from . import network
+from .exceptions import UserError
+from .network import Network
+import logging
+import os
+import pytest
+
+
+@pytest.fixture
+def lock_dir(tmp_path, monkeypatch):
+    """isolate namespaces created by tests from real ones: the locks of real
+    namespaces aren't in tmp_path, so they would look stale"""
+    monkeypatch.setattr(network, "lock_dir", tmp_path)
+    monkeypatch.setattr(network, "netns_prefix", f"autoflash_test{os.getpid()}_")
+    return tmp_path
+
+
+def has_link(ifname):
+    from pyroute2 import IPRoute
+
+    with IPRoute() as ipr:
+        return bool(ipr.link_lookup(ifname=ifname))
+
+
+def test_netns(veth, lock_dir):
+    import pyroute2.netns
+
+    ifname, _peer = veth
+    with Network(ifname) as net:
+        assert net.netns_name == f"{network.netns_prefix}{ifname}"
+        assert net.netns_name in pyroute2.netns.listnetns()
+        assert has_link(ifname)
+
+        with pytest.raises(UserError, match="in use"):
+            with Network(ifname):
+                pass
+
+    assert not has_link(ifname)
+    assert net.netns_name not in pyroute2.netns.listnetns()
+
+
+def test_keep_netns(veth, lock_dir):
+    import pyroute2.netns
+
+    ifname, _peer = veth
+    with Network(ifname, keep_netns=True) as net:
+        net.setup_ipv4("192.168.1.2")
+
+    try:
+        assert net.netns_name in pyroute2.netns.listnetns()
+        assert (lock_dir / f"{net.netns_name}.keep").exists()
+
+        # not stale, so not removed by another run
+        network.reclaim_stale_netns(logging.getLogger(), network.netns_prefix)
+        assert net.netns_name in pyroute2.netns.listnetns()
+
+        # the interface is already in the namespace
+        with Network(ifname, keep_netns=False) as net:
+            assert has_link(ifname)
+    finally:
+        if net.netns_name in pyroute2.netns.listnetns():
+            pyroute2.netns.remove(net.netns_name)
+
+    assert net.netns_name not in pyroute2.netns.listnetns()
+    assert not (lock_dir / f"{net.netns_name}.keep").exists()
+
+
+def test_reclaim_stale(veth, lock_dir):
+    import pyroute2.netns
+
+    ifname, _peer = veth
+    # as if left behind by a run which crashed
+    stale = f"{network.netns_prefix}stale"
+    pyroute2.netns.create(stale)
+    try:
+        with Network(ifname):
+            assert stale not in pyroute2.netns.listnetns()
+    finally:
+        if stale in pyroute2.netns.listnetns():
+            pyroute2.netns.remove(stale)
@@ -0,0 +1,106 @@
+from .cli import Runner
+from .inventory import load_inventory
+from .registry import Context, Device, DeviceRegistry
+from .scheduler import Job, JobQueueDir, Scheduler
+from typing import List, Optional, Tuple
+import json
+import threading
+
+runs: List[Tuple[Optional[str], str]] = []
+release = threading.Event()
+
+
+class Serial(Context):
+    def __init__(self, serial_port: Optional[str] = None):
+        self.serial_port = serial_port
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self):
+        pass
+
+
+device = Device("testarch", "testdev")
+
+
+@device.register_step
+def boot(serial: Serial, initrd: str):
+    release.wait()
+    runs.append((serial.serial_port, initrd))
+
+
+@device.register_step
+def fail(serial: Serial):
+    raise Exception("failed")
+
+
+registry = DeviceRegistry()
+registry.devices.append(device)
+
+
+def write_job(queue_dir, name, **job):
+    with open(queue_dir / f"{name}.json", "w") as f:
+        json.dump(job, f)
+
+
+def test_scheduler(tmp_path):
+    inventory_path = tmp_path / "inventory.toml"
+    inventory_path.write_text("""
+        [[slot]]
+        device = "testdev"
+        serial_port = "/a"
+
+        [[slot]]
+        name = "b"
+        device = "testdev"
+        serial-port = "/b"
+        """)
+    inventory = load_inventory(str(inventory_path))
+    assert [slot.name for slot in inventory.slots] == ["slot0", "b"]
+    assert inventory.slots[1].options == dict(serial_port="/b")
+
+    runner = Runner(registry)
+    slots = [runner.slot_from_inventory(slot) for slot in inventory.slots]
+    scheduler = Scheduler(runner, slots, {Serial: dict(serial_port=None)})
+
+    queue_dir = tmp_path / "queue"
+    queue = JobQueueDir(str(queue_dir))
+    write_job(queue_dir, "1", device="testdev", steps=["boot", "1.bin"])
+    write_job(queue_dir, "2", device="testdev", steps=["boot", "2.bin"], slot="b")
+    write_job(queue_dir, "3", device="testdev", steps=["boot", "3.bin"])
+    write_job(queue_dir, "4", device="otherdev", steps=["boot", "4.bin"])
+    queue.submit(Job(device="testdev", steps=["fail"]), "5")
+    (queue_dir / "6.json").write_text("{")
+    # being written, so ignored
+    (queue_dir / ".7.json.tmp").write_text("{")
+
+    # both slots are busy after the first two jobs, so the others wait
+    release.clear()
+    threads = scheduler.schedule(queue)
+    assert len(threads) == 2
+    assert sorted(path.name for path in queue_dir.glob("*.json")) == [
+        "3.json",
+        "5.json",
+    ]
+
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    while threads := scheduler.schedule(queue):
+        for thread in threads:
+            thread.join()
+
+    assert sorted(runs) == [("/a", "1.bin"), ("/a", "3.bin"), ("/b", "2.bin")]
+
+    def result(status, name):
+        with open(queue_dir / status / f"{name}.result.json") as f:
+            return json.load(f)
+
+    for name in "1", "2", "3":
+        assert result("done", name)["ok"]
+    assert result("done", "2")["slot"] == "b"
+    for name in "4", "5", "6":
+        assert not result("failed", name)["ok"]
+    assert (queue_dir / ".7.json.tmp").exists()
@@ -0,0 +1,255 @@
+from .serial import (
+    LineSplitter,
+    Line,
+    PartialLine,
+    SerialProtocol,
+    PatternSet,
+    Serial,
+    SerialHistory,
+    SerialMux,
+    compile_patterns,
+)
+from .exceptions import Timeout
+import asyncio
+import contextlib
+import logging
+import os
+import pytest
+import re
+import statistics
+import threading
+import time
+
+
+def test_splitter_lines():
+    splitter = LineSplitter()
+
+    assert splitter.feed(b"foo\r\nba") == [Line(b"foo"), PartialLine(b"ba")]
+    # separator split across chunks
+    assert splitter.feed(b"r\r") == [PartialLine(b"bar\r")]
+    assert splitter.feed(b"\nbaz\r\n\r\n") == [Line(b"bar"), Line(b"baz"), Line(b"")]
+    assert splitter.feed(b"") == []
+
+
+def test_splitter_partial_policy():
+    splitter = LineSplitter(partial_bytes=8, partial_interval=1000)
+
+    # short tails are reported when idle, or not at all within the interval
+    assert splitter.feed(b"VR9", idle=False) == [PartialLine(b"VR9")]
+    assert splitter.feed(b" #", idle=False) == []
+    assert splitter.feed(b" ", idle=True) == [PartialLine(b"VR9 # ")]
+    assert splitter.feed(b"", idle=True) == []
+
+    # while busy, long tails are reported each time they double in length
+    assert splitter.feed(b"abcdefgh", idle=False) == [PartialLine(b"VR9 # abcdefgh")]
+    assert splitter.feed(b"x" * 13, idle=False) == []
+    assert len(splitter.feed(b"x", idle=False)[0].data) == 28
+
+    # but are always reported if changed when idle
+    assert len(splitter.feed(b"y", idle=True)[0].data) == 29
+    assert splitter.feed(b"", idle=True) == []
+
+    # completing the line resets the policy
+    assert splitter.feed(b"\r\n>", idle=True)[1:] == [PartialLine(b">")]
+
+    # a prompt after a long unterminated run is seen as soon as it's idle
+    splitter = LineSplitter(partial_bytes=1024)
+    assert len(splitter.feed(b"x" * 1100, idle=True)[0].data) == 1100
+    assert splitter.feed(b"  VR9 #", idle=True) == [
+        PartialLine(b"x" * 1100 + b"  VR9 #")
+    ]
+
+
+class FakeSerial:
+    in_waiting = 1
+
+
+class FakeTransport:
+    serial = FakeSerial()
+
+
+def test_protocol_throughput():
+    """feed a console stream with long unterminated runs (like a u-boot md
+    dump with the wrong line ending) through the protocol, checking that the
+    amount of data queued is proportional to the input, and report the
+    throughput"""
+    history = SerialHistory(max_bytes=2**30)
+    protocol = SerialProtocol(logging.getLogger("test_serial"), history)
+    protocol.connection_made(FakeTransport())
+
+    line = b"84000000: 27051956 e3a0e8f3 00000000 00000000    '..V............\n"
+    block = line * 1024 + b"\r\n" + b"[    1.234567] short kernel line\r\n" * 64
+    stream = block * 32  # around 2.2MB
+    chunk_size = 4096
+
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk_size):
+        protocol.data_received(stream[i : i + chunk_size])
+    duration = time.perf_counter() - start
+
+    queued = [entry.item for entry in history.read(0)]
+
+    lines = [item.data for item in queued if isinstance(item, Line)]
+    assert lines == stream.split(b"\r\n")[:-1]
+
+    partial_size = sum(
+        len(item.data) for item in queued if isinstance(item, PartialLine)
+    )
+    assert partial_size <= 2 * len(stream)
+
+    print(f"{len(stream) / duration / 1e6:.1f} MB/s")
+
+
+def test_pattern_set():
+    patterns = PatternSet([b"done$", b"(TFTP) error", b"(?i)retry"])
+    assert patterns.combined is None
+
+    patterns = PatternSet([b"done$", b"(TFTP) error: (.*)", b"T+"])
+    assert patterns.combined is not None
+
+    assert patterns.match(b"foo") is None
+    assert patterns.match(b"done.") is None
+
+    index, match = patterns.match(b"done")
+    assert index == 0
+
+    # groups refer to the matching pattern, not the combined one
+    index, match = patterns.match(b"TFTP error: 'File not found'")
+    assert index == 1
+    assert match.groups() == (b"TFTP", b"'File not found'")
+
+    # first pattern wins
+    assert PatternSet([b"TFTP", b"T"]).match(b"TFTP")[0] == 0
+    assert PatternSet([b"T", b"TFTP"]).match(b"TFTP")[0] == 0
+
+
+@pytest.mark.parametrize("pattern", [rb"(a)\1", rb"(?P<x>a)(?P=x)", rb"(a)?(?(1)a|b)"])
+def test_pattern_set_references(pattern):
+    # combining would renumber the groups these refer to
+    patterns = PatternSet([b"zz", pattern])
+    assert patterns.combined is None
+    assert patterns.match(b"aa")[0] == 1
+    assert compile_patterns((b"zz", re.compile(pattern))).match(b"aa")[0] == 1
+
+
+def make_serial():
+    serial = Serial.__new__(Serial)
+    serial.logger = logging.getLogger("test_serial")
+    serial.history = SerialHistory()
+    serial.cursor = 0
+    return serial
+
+
+def test_expect():
+    serial = make_serial()
+
+    for line in [PartialLine(b"VR"), PartialLine(b"VR9 #"), Line(b"done")]:
+        serial.history.put(line)
+
+    assert serial.expect([b"done", b"VR9 #"])[0] == 0
+    assert serial.cursor == 3
+
+    with pytest.raises(Timeout):
+        serial.expect([b"done"], timeout=0.01)
+
+
+def test_expect_lookback():
+    serial = make_serial()
+
+    serial.history.put(PartialLine(b"VR9 #"))
+    serial.clear()
+    mark = serial.mark()
+    serial.history.put(Line(b"foo"))
+
+    # clear skips the prompt, but it can still be found by looking back
+    with pytest.raises(Timeout):
+        serial.wait_for_partial(b"VR9 #", timeout=0)
+    assert serial.wait_for_partial(b"VR9 #", start=serial.since(10))
+    assert serial.wait_for(b"foo", start=mark)
+
+    # waits are woken by new lines
+    timer = threading.Timer(0.01, serial.history.put, [Line(b"bar")])
+    timer.start()
+    assert serial.wait_for(b"bar", timeout=10)
+    timer.join()
+
+
+def test_expect_async():
+    serial = make_serial()
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.01, serial.history.put, Line(b"done"))
+        assert (await serial.expect_async([b"foo", b"done"], timeout=10))[0] == 1
+
+        with pytest.raises(Timeout):
+            await serial.expect_async([b"done"], timeout=0.01)
+
+        # lines added from other threads wake the loop
+        timer = threading.Timer(0.01, serial.history.put, [Line(b"bar")])
+        timer.start()
+        assert await serial.wait_for_async(b"bar", timeout=10)
+        timer.join()
+
+    asyncio.run(run())
+    assert serial.history.async_waiters == []
+
+
+def test_history_bounded():
+    history = SerialHistory(max_bytes=10 * (SerialHistory.entry_overhead + 10))
+
+    for i in range(1000):
+        history.put(Line(b"%010d" % i))
+
+    entries = history.read(0)
+    assert len(entries) == 10
+    assert [entry.seq for entry in entries] == list(range(990, 1000))
+    assert history.read(995)[0].item == Line(b"0000000995")
+
+
+@pytest.mark.parametrize("serial_mux", [False, True])
+def test_serial_backends(serial_mux):
+    """exchange lines with a number of pty pairs using each backend, checking
+    that they work and reporting cpu time and latency"""
+    n_ports = 16
+    n_rounds = 20
+
+    with contextlib.ExitStack() as stack:
+        ports = []
+        for _i in range(n_ports):
+            master, slave = os.openpty()
+            stack.callback(os.close, master)
+            port = Serial(os.ttyname(slave), serial_mux=serial_mux)
+            os.close(slave)
+            stack.enter_context(port)
+            ports.append((master, port))
+
+        latencies = []
+        cpu_start = time.process_time()
+        for i in range(n_rounds):
+            for master, port in ports:
+                start = time.perf_counter()
+                os.write(master, b"line %d\r\n" % i)
+                port.wait_for(b"line %d$" % i, timeout=5)
+                latencies.append(time.perf_counter() - start)
+        cpu_time = time.process_time() - cpu_start
+
+    print(
+        f"serial_mux={serial_mux}: {n_ports} ports, {cpu_time:.3f}s cpu, "
+        f"median latency {statistics.median(latencies) * 1000:.2f}ms"
+    )
+
+
+def test_serial_mux_call_error():
+    mux = SerialMux()
+
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError, match="failed"):
+        mux.call(fail)
+
+    # the mux thread survives, and later calls still run
+    ran = []
+    mux.call(lambda: ran.append(threading.current_thread()))
+    assert ran == [mux.thread] and mux.thread.is_alive()
@@ -0,0 +1,318 @@
+from . import iputils, ssh
+from .exceptions import Timeout
+from pathlib import Path
+from types import SimpleNamespace
+import asyncio
+import getpass
+import hashlib
+import os
+import pytest
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+
+class FakeServer:
+    """accepts connections, closing them without a banner until ready"""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.ready_time = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                conn, _addr = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                if self.ready_time is not None:
+                    conn.sendall(b"SSH-2.0-dropbear_2022.83\r\n")
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def server():
+    server = FakeServer()
+    yield server
+    server.close()
+
+
+def become_ready_later(server, delay=0.3):
+    def run():
+        time.sleep(delay)
+        server.ready_time = time.monotonic()
+
+    threading.Thread(target=run).start()
+
+
+def test_wait_for_ssh(server):
+    become_ready_later(server)
+    ssh.wait_for_ssh("127.0.0.1", timeout=5, port=server.port, name="test")
+    latency = time.monotonic() - server.ready_time
+    print(f"ssh ready latency: {latency * 1000:.1f}ms")
+    assert latency < 0.3
+
+    assert len(ssh.ready_times["test"]) == 1
+    assert ssh.ready_times["test"][0] >= 0.3
+
+
+def test_wait_for_ssh_async(server):
+    become_ready_later(server)
+    asyncio.run(ssh.wait_for_ssh_async("127.0.0.1", timeout=5, port=server.port))
+    assert time.monotonic() - server.ready_time < 0.3
+
+
+def test_wait_for_ssh_wake(server):
+    """with a long backoff, setting wake makes it retry immediately"""
+    wake = threading.Event()
+
+    def run():
+        time.sleep(0.3)
+        server.ready_time = time.monotonic()
+        wake.set()
+
+    threading.Thread(target=run).start()
+    ssh.wait_for_ssh(
+        "127.0.0.1", timeout=5, port=server.port, min_delay=2, max_delay=2, wake=wake
+    )
+    assert time.monotonic() - server.ready_time < 0.3
+
+
+def test_wait_for_ssh_timeout(server):
+    start = time.monotonic()
+    with pytest.raises(Timeout):
+        ssh.wait_for_ssh("127.0.0.1", timeout=0.5, port=server.port)
+    assert time.monotonic() - start < 0.7
+
+    server.close()
+    with pytest.raises(Timeout):
+        asyncio.run(ssh.wait_for_ssh_async("127.0.0.1", timeout=0.2, port=server.port))
+
+
+def busybox_shell(tmp_path):
+    """argv prefix for a shell which runs everything with busybox, as on
+    OpenWrt, or None if busybox is not installed"""
+    busybox = shutil.which("busybox")
+    if busybox is None:
+        return None
+    bin_dir = tmp_path / "busybox"
+    bin_dir.mkdir()
+    for applet in ["sh", "cat", "echo", "sha256sum", "head"]:
+        (bin_dir / applet).symlink_to(busybox)
+    return ["env", f"PATH={bin_dir}", str(bin_dir / "sh"), "-c"]
+
+
+class CountingReader:
+    """wraps a file, counting the bytes read from it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.read_bytes = 0
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.read_bytes += n
+        return n
+
+
+def flip_last_block(dest, block_size):
+    """wrap stream dest, flipping a bit in blocks of block_size bytes"""
+
+    def write(data):
+        data = bytearray(data)
+        if len(data) == block_size:
+            data[0] ^= 1
+        return dest.write(data)
+
+    return SimpleNamespace(write=write)
+
+
+def run_upload(shell_args, dest, f, size, corrupt=False, **kwargs):
+    """upload size bytes of f to dest with stream_upload and upload_command,
+    then check them with verify_command; returns the checksum, the return
+    code of the verify command and its output
+
+    if corrupt, a bit in the last block is flipped after it has been hashed;
+    this must be 5 bytes long
+    """
+    proc = subprocess.Popen(
+        [*shell_args, ssh.upload_command(str(dest))],
+        stdin=subprocess.PIPE,
+        bufsize=0,
+    )
+    stdin = flip_last_block(proc.stdin, 5) if corrupt else proc.stdin
+    checksum = ssh.stream_upload(f, stdin, size, **kwargs)
+    proc.stdin.close()
+    assert proc.wait() == 0
+
+    verify = subprocess.run(
+        [*shell_args, ssh.verify_command(str(dest), checksum, "echo ok")],
+        stdout=subprocess.PIPE,
+    )
+    return checksum, verify.returncode, verify.stdout
+
+
+@pytest.mark.parametrize("shell", ["sh", "busybox"])
+def test_stream_upload(tmp_path, shell):
+    """run the upload and verify commands locally, as if they were on the
+    device"""
+    if shell == "busybox":
+        shell_args = busybox_shell(tmp_path)
+        if shell_args is None:
+            pytest.skip("busybox is not installed")
+    else:
+        shell_args = ["sh", "-c"]
+
+    image = tmp_path / "image.bin"
+    image.write_bytes(os.urandom(3 * 1024 * 1024 + 5))
+    size = image.stat().st_size
+    dest = tmp_path / "uploaded.bin"
+
+    for corrupt in False, True:
+        progress = []
+        with open(image, "rb") as raw:
+            f = CountingReader(raw)
+            checksum, rc, output = run_upload(
+                shell_args,
+                dest,
+                f,
+                size,
+                corrupt,
+                on_progress=progress.append,
+                progress_interval=0,
+                block_size=2**20,
+            )
+
+        # the image is hashed as it is sent, so it is only read once
+        assert f.read_bytes == size
+        assert checksum == hashlib.sha256(image.read_bytes()).hexdigest()
+        if corrupt:
+            assert rc != 0 and output == b""
+        else:
+            assert rc == 0 and output == b"ok\n"
+            assert dest.read_bytes() == image.read_bytes()
+
+        assert [p.sent for p in progress] == [2**20, 2 * 2**20, 3 * 2**20, size, size]
+        assert progress[-1].eta == 0
+
+
+def test_stream_upload_checksum(tmp_path):
+    """a checksum calculated earlier is returned instead, so changes to the
+    file since then are detected"""
+    image = tmp_path / "image.bin"
+    image.write_bytes(os.urandom(1024 * 1024))
+    size = image.stat().st_size
+    checksum = hashlib.sha256(image.read_bytes()).hexdigest()
+    dest = tmp_path / "uploaded.bin"
+
+    for changed in False, True:
+        if changed:
+            image.write_bytes(os.urandom(size))
+        with open(image, "rb") as f:
+            sent, rc, output = run_upload(
+                ["sh", "-c"], dest, f, size, checksum=checksum
+            )
+
+        assert sent == checksum
+        assert (rc == 0) != changed
+        assert (output == b"ok\n") != changed
+
+
+@pytest.fixture
+def sshd(veth, tmp_path):
+    """run sshd on localhost in a test network namespace, returning the
+    extra ssh options needed to log in to it"""
+    sshd_path = shutil.which("sshd") or "/usr/sbin/sshd"
+    if not os.path.exists(sshd_path):
+        pytest.skip("sshd is not installed")
+
+    iputils.ensure_up("lo", None)
+    for name in "host_key", "user_key":
+        subprocess.run(
+            ["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", tmp_path / name],
+            check=True,
+        )
+    (tmp_path / "sshd_config").write_text(
+        f"HostKey {tmp_path}/host_key\n"
+        f"AuthorizedKeysFile {tmp_path}/user_key.pub\n"
+        "ListenAddress 127.0.0.1:2222\n"
+        "PermitRootLogin yes\n"
+        "StrictModes no\n"
+    )
+    proc = subprocess.Popen([sshd_path, "-D", "-e", "-f", tmp_path / "sshd_config"])
+    try:
+        ssh.wait_for_ssh("127.0.0.1", timeout=5, port=2222)
+        yield ["-p2222", f"-i{tmp_path}/user_key", "-oIdentitiesOnly=yes"]
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def test_session_args():
+    with ssh.SshSession(["-p2222"]) as session:
+        args = session.args()
+        assert args[: len(ssh.base_args)] == ssh.base_args
+        assert "-p2222" in args
+        assert "-oControlMaster=auto" in args
+        assert f"-oControlPath={session.control_dir.name}/%C" in args
+        # every command in the session shares the control path
+        assert session.args() == args
+    assert ssh.ssh_args(None) == ssh.base_args
+
+
+def test_session_close(tmp_path, monkeypatch):
+    session = ssh.SshSession()
+    control_dir = Path(session.control_dir.name)
+    # what ssh leaves behind for a connection
+    control_path = control_dir / "0123abcd"
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control_socket:
+        control_socket.bind(str(control_path))
+
+        calls = []
+        monkeypatch.setattr(
+            ssh.subprocess, "run", lambda args, **kwargs: calls.append(args)
+        )
+        session.close()
+
+    assert calls == [
+        ["ssh", *ssh.base_args, f"-oControlPath={control_path}", "-Oexit", "-"]
+    ]
+    assert not control_dir.exists()
+
+
+def test_session_benchmark(sshd):
+    """compare running commands with and without connection reuse"""
+    address = f"{getpass.getuser()}@127.0.0.1"
+    n = 10
+
+    session = ssh.SshSession(sshd)
+    try:
+        assert ssh.run_command(address, ["echo", "hi"], session=session) == b"hi\n"
+        start = time.perf_counter()
+        for _i in range(n):
+            ssh.run_command(address, ["true"], session=session)
+        session_time = (time.perf_counter() - start) / n
+    finally:
+        session.close()
+
+    no_session = SimpleNamespace(args=lambda: ssh.base_args + sshd)
+    start = time.perf_counter()
+    for _i in range(n):
+        ssh.run_command(address, ["true"], session=no_session)
+    no_session_time = (time.perf_counter() - start) / n
+
+    print(
+        f"ssh command: {no_session_time * 1000:.1f}ms without session, "
+        f"{session_time * 1000:.1f}ms with session"
+    )
+    assert session_time < no_session_time
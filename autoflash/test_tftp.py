@@ -0,0 +1,219 @@
+from . import iputils
+from .artifacts import ArtifactStore
+from .dnsmasq import Dnsmasq
+from .exceptions import Timeout, UserError
+from .tftp import TftpServer, TftpFailed, TftpFinished, TftpProgress
+from typing import Dict, List, Set, Tuple
+import os
+import pytest
+import shutil
+import socket
+import struct
+import time
+
+
+def tftp_get(
+    port: int, filename: str, options: Dict[str, str] = {}, drop: Set[int] = set()
+) -> Tuple[bytes, Dict[str, str]]:
+    """minimal TFTP client, returning the file contents and the options in the
+    OACK; blocks in drop are ignored the first time they are received"""
+    drop = set(drop)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2**20)
+        sock.settimeout(5)
+        request = struct.pack("!H", 1) + filename.encode() + b"\0octet\0"
+        for name, value in options.items():
+            request += f"{name}\0{value}\0".encode()
+        sock.sendto(request, ("127.0.0.1", port))
+
+        blksize, windowsize = 512, 1
+        oack: Dict[str, str] = {}
+        blocks: List[bytes] = []
+        since_ack = 0
+
+        def ack(block, addr):
+            sock.sendto(struct.pack("!HH", 4, block & 0xFFFF), addr)
+
+        addr = None
+        timeouts = 0
+        while True:
+            try:
+                packet, addr = sock.recvfrom(65536)
+            except socket.timeout:
+                # re-acknowledge the last block received in order
+                timeouts += 1
+                assert timeouts < 100 and addr is not None
+                ack(len(blocks), addr)
+                since_ack = 0
+                continue
+            sock.settimeout(0.05)
+
+            opcode, block = struct.unpack_from("!HH", packet)
+            if opcode == 6:
+                fields = packet[2:].split(b"\0")[:-1]
+                oack = {
+                    k.decode(): v.decode() for k, v in zip(fields[::2], fields[1::2])
+                }
+                blksize = int(oack.get("blksize", blksize))
+                windowsize = int(oack.get("windowsize", windowsize))
+                ack(0, addr)
+            elif opcode == 5:
+                raise Exception(packet[4:-1].decode())
+            elif opcode == 3:
+                if block in drop:
+                    drop.remove(block)
+                    continue
+
+                expected = len(blocks) + 1
+                if block == expected & 0xFFFF:
+                    blocks.append(packet[4:])
+                    since_ack = 0 if since_ack + 1 == windowsize else since_ack + 1
+                    last = len(packet) - 4 < blksize
+                    if last or since_ack == 0:
+                        ack(expected, addr)
+                    if last:
+                        return b"".join(blocks), oack
+                elif (block - expected) & 0xFFFF < 0x8000:
+                    # a gap; ack the last block received in order
+                    ack(expected - 1, addr)
+                    since_ack = 0
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = {}
+    for name, size in ("empty", 0), ("small", 1000), ("exact", 1024), ("big", 2**23):
+        path = tmp_path / name
+        path.write_bytes(os.urandom(size))
+        paths[name] = str(path)
+    return paths
+
+
+def test_tftp_options(files):
+    events = []
+    with TftpServer(
+        tftp=files, address="127.0.0.1", port=0, timeout=0.1, on_event=events.append
+    ) as server:
+        for name in "empty", "small", "exact":
+            with open(files[name], "rb") as f:
+                contents = f.read()
+            assert tftp_get(server.port, name) == (contents, {})
+            assert server.wait_for_tftp(name, timeout=5).size == len(contents)
+
+        contents, oack = tftp_get(
+            server.port, "/small", dict(blksize="100", tsize="0", windowsize="4")
+        )
+        with open(files["small"], "rb") as f:
+            assert contents == f.read()
+        assert oack == dict(blksize="100", tsize="1000", windowsize="4")
+        server.wait_for_tftp("small", timeout=5)
+
+        # lost blocks are resent, with and without windowsize
+        with open(files["exact"], "rb") as f:
+            contents = f.read()
+        for windowsize in "1", "4":
+            options = dict(blksize="100", windowsize=windowsize)
+            assert tftp_get(server.port, "exact", options, drop={3, 6})[0] == contents
+            server.wait_for_tftp("exact", timeout=5)
+
+        with pytest.raises(Exception, match="not found"):
+            tftp_get(server.port, "nonexistent")
+        with pytest.raises(UserError, match="not found"):
+            server.wait_for_tftp("nonexistent", timeout=5)
+
+        with pytest.raises(Timeout):
+            server.wait_for_tftp(timeout=0.01)
+
+    assert sum(isinstance(event, TftpFinished) for event in events) == 6
+    assert sum(isinstance(event, TftpFailed) for event in events) == 1
+
+
+def test_tftp_missing_file(tmp_path):
+    """files which can't be opened give the client an error, and make
+    wait_for_tftp fail rather than waiting forever"""
+    unreadable = tmp_path / "unreadable"
+    unreadable.mkdir()
+    tftp = dict(missing=str(tmp_path / "missing"), unreadable=str(unreadable))
+    events = []
+    with TftpServer(
+        tftp=tftp, address="127.0.0.1", port=0, on_event=events.append
+    ) as server:
+        for name in tftp:
+            with pytest.raises(Exception):
+                tftp_get(server.port, name)
+            with pytest.raises(UserError, match=name):
+                server.wait_for_tftp(name)
+
+    assert [type(event) for event in events] == [TftpFailed, TftpFailed]
+
+
+def test_tftp_throughput(files):
+    """compare the throughput of lock-step transfers (as for a client which
+    doesn't negotiate options) with larger blocks and windows"""
+    with open(files["big"], "rb") as f:
+        contents = f.read()
+
+    with TftpServer(tftp=files, address="127.0.0.1", port=0) as server:
+        results = {}
+        for blksize, windowsize in (512, 1), (1468, 1), (1468, 16), (8192, 16):
+            options = dict(blksize=str(blksize), windowsize=str(windowsize))
+            start = time.perf_counter()
+            assert tftp_get(server.port, "big", options)[0] == contents
+            results[blksize, windowsize] = len(contents) / (time.perf_counter() - start)
+
+            finished = server.wait_for_tftp("big", timeout=5)
+            print(
+                f"blksize={blksize} windowsize={windowsize}: "
+                f"{results[blksize, windowsize] / 1e6:.1f} MB/s "
+                f"(server: {finished.throughput / 1e6:.1f} MB/s)"
+            )
+
+    assert results[1468, 16] > results[512, 1]
+
+
+def test_tftp_throughput_dnsmasq(files, veth, tmp_path):
+    """report the throughput of the built-in server next to dnsmasq, which
+    must listen on port 69, so is run in a test network namespace; both are
+    measured with the same client, so this only checks the transfers"""
+    if shutil.which("dnsmasq") is None:
+        pytest.skip("dnsmasq is not installed")
+    iputils.ensure_up("lo", None)
+
+    with open(files["big"], "rb") as f:
+        contents = f.read()
+    # dnsmasq doesn't support windowsize, so ignores it
+    option_sets = (512, 1), (1468, 1), (1468, 16), (8192, 16)
+
+    def measure(port):
+        results = {}
+        for blksize, windowsize in option_sets:
+            options = dict(blksize=str(blksize), windowsize=str(windowsize))
+            start = time.perf_counter()
+            assert tftp_get(port, "big", options)[0] == contents
+            results[blksize, windowsize] = len(contents) / (time.perf_counter() - start)
+        return results
+
+    with TftpServer(tftp=files, address="127.0.0.1", port=0) as server:
+        builtin = measure(server.port)
+    with Dnsmasq(tftp=files, store=ArtifactStore(tmp_path / "store")):
+        dnsmasq = measure(69)
+
+    for blksize, windowsize in option_sets:
+        print(
+            f"blksize={blksize} windowsize={windowsize}: "
+            f"built-in {builtin[blksize, windowsize] / 1e6:.1f} MB/s, "
+            f"dnsmasq {dnsmasq[blksize, windowsize] / 1e6:.1f} MB/s"
+        )
+
+
+def test_tftp_progress(files):
+    events = []
+    with TftpServer(
+        tftp=files, address="127.0.0.1", port=0, on_event=events.append
+    ) as server:
+        tftp_get(server.port, "big", dict(blksize="8192", windowsize="8"))
+        server.wait_for_tftp("big", timeout=5)
+
+    progress = [event.sent for event in events if isinstance(event, TftpProgress)]
+    assert len(progress) == 8
+    assert progress == sorted(progress)
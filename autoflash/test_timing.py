@@ -0,0 +1,68 @@
+from .timing import Timeline, instant, recording, span
+import json
+import threading
+import time
+
+
+def test_no_timeline():
+    # recording does nothing without a current timeline
+    with span("step", "step") as step_span:
+        instant("event", "test")
+    assert step_span is None
+
+
+def test_timeline():
+    timeline = Timeline()
+
+    with recording(timeline):
+        with span("boot", "step"):
+            for _i in range(3):
+                with span("wait for prompt", "serial"):
+                    time.sleep(0.01)
+            with span("tftp", "tftp", size=100):
+                instant("lease", "dnsmasq", address="192.168.1.1")
+                time.sleep(0.02)
+
+        # spans on other threads have no parent unless one is given
+        thread = threading.Thread(target=lambda: timeline.begin("other", "test"))
+        thread.start()
+        thread.join()
+
+    boot, wait, _wait, _wait, tftp, other = timeline.spans
+    assert boot.parent is None and other.parent is None
+    assert wait.parent == boot.id and tftp.parent == boot.id
+    assert timeline.instants[0].parent == tftp.id
+    assert 0.05 <= boot.duration < 0.2
+
+    data = json.loads(json.dumps(timeline.to_json()))
+    assert [s["name"] for s in data["spans"]][:2] == ["boot", "wait for prompt"]
+    assert data["spans"][4]["args"] == dict(size=100)
+    assert data["instants"][0]["args"] == dict(address="192.168.1.1")
+
+    trace = json.loads(json.dumps(timeline.chrome_trace()))
+    complete = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+    assert len(complete) == 6
+    assert complete[0]["name"] == "boot" and complete[0]["dur"] >= 50000
+    assert any(e["ph"] == "i" for e in trace["traceEvents"])
+
+    summary = timeline.summary().splitlines()
+    assert summary[0].startswith("boot: ")
+    assert summary[1].startswith("  wait for prompt (x3): ")
+    assert summary[2].startswith("  tftp: ")
+    assert summary[3].startswith("other: ")
+
+
+def test_lazy_name():
+    def name():
+        names.append("made")
+        return "expensive"
+
+    names = []
+    with span(name, "test"):
+        pass
+    assert names == []
+
+    timeline = Timeline()
+    with recording(timeline), span(name, "test"):
+        pass
+    assert names == ["made"] and timeline.spans[0].name == "expensive"
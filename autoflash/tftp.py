@@ -0,0 +1,487 @@
+from dataclasses import dataclass
+from queue import Queue, Empty
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from . import metrics
+from .events import bus, thread_slot
+from .exceptions import Timeout, UserError
+from .limits import check_deadline, limit_timeout, run_in_executor, wake_on_cancel
+from .timing import Span, Timeline, current_timeline
+
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+ERR_UNDEFINED = 0
+ERR_NOT_FOUND = 1
+ERR_ACCESS = 2
+ERR_ILLEGAL_OP = 4
+ERR_OPTION = 8
+
+Address = Tuple[str, int]
+
+
+@dataclass
+class TftpEvent:
+    filename: str
+    client: Address
+
+
+@dataclass
+class TftpStarted(TftpEvent):
+    size: int
+    blksize: int
+    windowsize: int
+
+
+@dataclass
+class TftpProgress(TftpEvent):
+    sent: int
+    size: int
+
+
+@dataclass
+class TftpFinished(TftpEvent):
+    size: int
+    duration: float
+
+    @property
+    def throughput(self) -> float:
+        """average throughput in bytes per second"""
+        return self.size / self.duration if self.duration > 0 else float("inf")
+
+
+@dataclass
+class TftpFailed(TftpEvent):
+    error: str
+
+
+class TftpError(Exception):
+    """an error in a transfer; code is the TFTP error code to send to the
+    client, or None to not send one"""
+
+    def __init__(self, code: Optional[int], message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def parse_request(packet: bytes) -> Tuple[str, str, Dict[str, str]]:
+    """parse a RRQ packet into the filename, mode and options (with lower-case
+    names)"""
+    if len(packet) < 2:
+        raise TftpError(ERR_ILLEGAL_OP, "malformed request")
+    (opcode,) = struct.unpack_from("!H", packet)
+    if opcode == OP_WRQ:
+        raise TftpError(ERR_ACCESS, "server is read-only")
+    elif opcode != OP_RRQ:
+        raise TftpError(ERR_ILLEGAL_OP, "expected a read request")
+
+    raw_fields = packet[2:].split(b"\0")
+    # the packet should end with a null, giving an empty last field
+    if len(raw_fields) < 3 or raw_fields[-1] != b"" or len(raw_fields) % 2 != 1:
+        raise TftpError(ERR_ILLEGAL_OP, "malformed request")
+    fields = [field.decode("ascii", errors="replace") for field in raw_fields[:-1]]
+
+    filename, mode = fields[:2]
+    options = {name.lower(): value for name, value in zip(fields[2::2], fields[3::2])}
+    return filename, mode.lower(), options
+
+
+def release_packets(packets):
+    for _header, block in packets:
+        block.release()
+
+
+def error_packet(code: int, message: str) -> bytes:
+    return struct.pack("!HH", OP_ERROR, code) + message.encode() + b"\0"
+
+
+class TftpServer:
+    """a read-only TFTP server, run on its own thread, serving the files in
+    tftp (a dict from name to local path)
+
+    This supports the blksize (RFC 2348), tsize and timeout (RFC 2349) and
+    windowsize (RFC 7440) options. Files are served directly from their
+    source paths through mmap, and each block is sent with sendmsg, so file
+    data is not copied into python objects.
+
+    Like Dnsmasq, this is used as a context manager, and wait_for_tftp waits
+    for a transfer to complete. on_event is called with each TftpEvent (from
+    the server thread), including TftpProgress every progress_interval bytes.
+    """
+
+    def __init__(
+        self,
+        tftp: dict = {},
+        address: str = "0.0.0.0",
+        port: int = 69,
+        max_blksize: int = 65464,
+        max_windowsize: int = 64,
+        timeout: float = 1.0,
+        retries: int = 5,
+        on_event: Optional[Callable[[TftpEvent], None]] = None,
+        progress_interval: int = 1024 * 1024,
+    ):
+        self.tftp = {name.lstrip("/"): path for name, path in tftp.items()}
+        self.address = address
+        self.port = port
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+        self.timeout = timeout
+        self.retries = retries
+        self.on_event = on_event
+        self.progress_interval = progress_interval
+        self.logger = logging.getLogger("tftp")
+
+        self.events: Queue[Optional[TftpEvent]] = Queue()
+        self.tasks: "set[asyncio.Task]" = set()
+
+        # spans for the server and each transfer, if timing is enabled
+        self.timeline: Optional[Timeline] = None
+        self.span: Optional[Span] = None
+        self.transfer_spans: Dict[Tuple[str, Address], Span] = {}
+        # events are emitted from the server thread, with the slot of the
+        # thread which started the server
+        self.slot: Optional[str] = None
+
+    def __enter__(self):
+        self.slot = thread_slot()
+        self.timeline = current_timeline()
+        if self.timeline is not None:
+            self.span = self.timeline.begin("tftp server", "tftp")
+
+        # sockets are made in this thread (and the server thread is started
+        # from it) so that they are in the right network namespace
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.address, self.port))
+        self.port = self.sock.getsockname()[1]
+        self.sock.setblocking(False)
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="tftp")
+        self.thread.daemon = True
+        self.thread.start()
+
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+        self.logger.debug(f"listening on {self.address}:{self.port}")
+
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.sock.close()
+
+        if self.span is not None:
+            self.span.end = time.monotonic()
+            self.span = None
+
+    async def start(self):
+        server = self
+
+        class ListenProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                server.request_received(data, addr)
+
+        self.transport, _protocol = await self.loop.create_datagram_endpoint(
+            ListenProtocol, sock=self.sock
+        )
+
+    async def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        self.transport.abort()
+
+    def emit(self, event: TftpEvent):
+        if not isinstance(event, TftpProgress):
+            self.events.put(event)
+            self.record(event)
+        if bus.enabled:
+            bus.emit(event, self.slot)
+        if (
+            metrics.registry.enabled
+            and isinstance(event, TftpFinished)
+            and event.duration > 0
+        ):
+            metrics.tftp_throughput.observe(
+                event.throughput, metrics.slot_label(self.slot)
+            )
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def record(self, event: TftpEvent):
+        """record a span for each transfer, if timing is enabled"""
+        if self.timeline is None or self.span is None:
+            return
+        key = (event.filename, event.client)
+        if isinstance(event, TftpStarted):
+            self.transfer_spans[key] = self.timeline.begin(
+                f"tftp {event.filename}",
+                "tftp",
+                parent=self.span,
+                slot=self.span.slot,
+                size=event.size,
+                blksize=event.blksize,
+                windowsize=event.windowsize,
+            )
+        elif key in self.transfer_spans:
+            transfer_span = self.transfer_spans.pop(key)
+            transfer_span.end = time.monotonic()
+            if isinstance(event, TftpFinished):
+                transfer_span.args["throughput"] = event.throughput
+            elif isinstance(event, TftpFailed):
+                transfer_span.args["error"] = event.error
+
+    def wait_for_tftp(
+        self, filename: Optional[str] = None, timeout: Optional[float] = None
+    ) -> TftpFinished:
+        """wait for a transfer (of filename, if specified) to finish, raising
+        UserError if one fails"""
+        timeout = limit_timeout(timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # cancelling puts None in the queue to wake this up
+        with wake_on_cancel(lambda: self.events.put(None)):
+            while True:
+                try:
+                    if deadline is None:
+                        event = self.events.get()
+                    else:
+                        remaining = max(0, deadline - time.monotonic())
+                        event = self.events.get(timeout=remaining)
+                except Empty:
+                    check_deadline()
+                    raise Timeout(f"timed out after {timeout}s waiting for tftp")
+
+                if event is None:
+                    check_deadline()
+                elif filename is not None and event.filename != filename.lstrip("/"):
+                    continue
+                elif isinstance(event, TftpFinished):
+                    return event
+                elif isinstance(event, TftpFailed):
+                    raise UserError(
+                        f"tftp transfer of {event.filename} to {event.client[0]} "
+                        f"failed: {event.error}"
+                    )
+
+    async def wait_for_tftp_async(
+        self, filename: Optional[str] = None, timeout: Optional[float] = None
+    ) -> TftpFinished:
+        return await run_in_executor(self.wait_for_tftp, filename, timeout)
+
+    def request_received(self, packet: bytes, client: Address):
+        try:
+            filename, mode, options = parse_request(packet)
+            if mode != "octet":
+                raise TftpError(ERR_ILLEGAL_OP, "only octet mode is supported")
+        except TftpError as e:
+            assert e.code is not None
+            self.logger.warning(f"bad request from {client}: {e}")
+            self.transport.sendto(error_packet(e.code, e.message), client)
+            return
+
+        task = self.loop.create_task(self.transfer(filename, options, client))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def transfer(self, filename: str, options: Dict[str, str], client: Address):
+        filename = filename.lstrip("/")
+
+        # each transfer uses a new port (transfer ID)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            try:
+                sock.bind((self.address, 0))
+                sock.connect(client)
+                sock.setblocking(False)
+
+                with self.open_file(filename) as f:
+                    await self.send_file(sock, filename, f, options, client)
+            except OSError as e:
+                # errors from the file are TftpErrors, so this is from the
+                # socket, and sending an error would probably fail
+                raise TftpError(None, f"network error: {e}")
+        except TftpError as e:
+            self.logger.warning(f"transfer of {filename} to {client} failed: {e}")
+            self.emit(TftpFailed(filename, client, str(e)))
+            if e.code is not None:
+                try:
+                    sock.send(error_packet(e.code, e.message))
+                except OSError:
+                    pass
+        finally:
+            sock.close()
+
+    def open_file(self, filename: str):
+        if filename not in self.tftp:
+            raise TftpError(ERR_NOT_FOUND, f"{filename} not found")
+        try:
+            return open(self.tftp[filename], "rb")
+        except FileNotFoundError:
+            raise TftpError(ERR_NOT_FOUND, f"{filename} not found")
+        except OSError as e:
+            raise TftpError(ERR_ACCESS, f"can't open {filename}: {e.strerror}")
+
+    def negotiate(self, options: Dict[str, str], size: int) -> Dict[str, int]:
+        """get the options to acknowledge in an OACK"""
+        accepted = {}
+
+        def int_option(name, low, high):
+            try:
+                value = int(options[name])
+            except ValueError:
+                raise TftpError(ERR_OPTION, f"invalid {name}")
+            if value < low:
+                raise TftpError(ERR_OPTION, f"invalid {name}")
+            accepted[name] = min(value, high)
+
+        if "blksize" in options:
+            int_option("blksize", 8, self.max_blksize)
+        if "windowsize" in options:
+            int_option("windowsize", 1, self.max_windowsize)
+        if "timeout" in options:
+            int_option("timeout", 1, 255)
+        if "tsize" in options:
+            accepted["tsize"] = size
+
+        return accepted
+
+    async def send_file(
+        self, sock: socket.socket, filename: str, f, options, client: Address
+    ):
+        size = os.fstat(f.fileno()).st_size
+        accepted = self.negotiate(options, size)
+        blksize = accepted.get("blksize", 512)
+        windowsize = accepted.get("windowsize", 1)
+        timeout = accepted.get("timeout", self.timeout)
+
+        # the last block is always shorter than blksize, possibly empty
+        n_blocks = size // blksize + 1
+
+        self.logger.info(
+            f"sending {filename} ({size} bytes) to {client[0]}:{client[1]} "
+            f"with blksize={blksize} windowsize={windowsize}"
+        )
+        self.emit(TftpStarted(filename, client, size, blksize, windowsize))
+        start_time = time.monotonic()
+
+        # empty files can't be mapped
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        except OSError as e:
+            raise TftpError(ERR_ACCESS, f"can't map {filename}: {e.strerror}")
+        view = memoryview(data if data is not None else b"")
+        packets: List[Tuple[bytes, memoryview]] = []
+        try:
+            if accepted:
+                oack = struct.pack("!H", OP_OACK) + b"".join(
+                    f"{name}\0{value}\0".encode() for name, value in accepted.items()
+                )
+                await self.send_and_wait_for_ack(sock, [oack], 0, 0, timeout)
+
+            acked = 0
+            next_progress = self.progress_interval
+            while acked < n_blocks:
+                end = min(acked + windowsize, n_blocks)
+                packets = [
+                    (
+                        struct.pack("!HH", OP_DATA, block & 0xFFFF),
+                        view[(block - 1) * blksize : block * blksize],
+                    )
+                    for block in range(acked + 1, end + 1)
+                ]
+                acked = await self.send_and_wait_for_ack(
+                    sock, packets, acked, end, timeout
+                )
+                release_packets(packets)
+
+                sent = min(acked * blksize, size)
+                if sent >= next_progress:
+                    self.emit(TftpProgress(filename, client, sent, size))
+                    next_progress = sent + self.progress_interval
+        finally:
+            # the mmap can't be closed while there are views of it
+            release_packets(packets)
+            view.release()
+            if data is not None:
+                data.close()
+
+        duration = time.monotonic() - start_time
+        finished = TftpFinished(filename, client, size, duration)
+        self.logger.info(
+            f"sent {filename} to {client[0]} in {duration:.2f}s "
+            f"({finished.throughput / 1e6:.2f} MB/s)"
+        )
+        self.emit(finished)
+
+    async def send_and_wait_for_ack(
+        self, sock: socket.socket, packets, acked: int, end: int, timeout: float
+    ) -> int:
+        """send packets (the blocks after acked, up to end), and wait for an
+        ACK of any of them, resending on timeout; returns the (absolute)
+        number of the block acknowledged"""
+        for _attempt in range(self.retries + 1):
+            for packet in packets:
+                await self.send(sock, packet)
+
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    reply = await asyncio.wait_for(
+                        self.loop.sock_recv(sock, 65536), remaining
+                    )
+                except asyncio.TimeoutError:
+                    break
+                except ConnectionRefusedError:
+                    raise TftpError(None, "client went away")
+
+                if len(reply) < 4:
+                    continue
+                opcode, block = struct.unpack_from("!HH", reply)
+                if opcode == OP_ERROR:
+                    message = reply[4:].rstrip(b"\0").decode(errors="replace")
+                    # don't reply to errors
+                    raise TftpError(None, f"client error: {message}")
+                elif opcode == OP_ACK:
+                    # blocks numbers wrap around; duplicate ACKs of earlier
+                    # blocks are ignored (see "Sorcerer's Apprentice")
+                    absolute = acked + ((block - acked) & 0xFFFF)
+                    if acked < absolute <= end or absolute == acked == end:
+                        return absolute
+        raise TftpError(ERR_UNDEFINED, "timed out")
+
+    async def send(self, sock: socket.socket, packet):
+        """send a packet (bytes, or a tuple of buffers) without blocking"""
+        buffers = [packet] if isinstance(packet, bytes) else list(packet)
+        while True:
+            try:
+                sock.sendmsg(buffers)
+                return
+            except BlockingIOError:
+                writable = self.loop.create_future()
+                self.loop.add_writer(sock.fileno(), writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(sock.fileno())
+            except ConnectionRefusedError:
+                raise TftpError(None, "client went away")
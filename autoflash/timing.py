@@ -0,0 +1,272 @@
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Union
+import itertools
+import json
+import threading
+import time
+from .events import thread_slot
+
+# spans are recorded into the timeline of the current run (held in a context
+# variable, like deadlines), so that steps, contexts and waits can record
+# phases without a timeline being passed around; when timing is not enabled
+# there is no current timeline, and recording does nothing
+
+
+@dataclass
+class Span:
+    """a named period of time; times are from time.monotonic()"""
+
+    id: int
+    name: str
+    category: str
+    start: float
+    end: Optional[float] = None
+    #: id of the span this was started within, if any
+    parent: Optional[int] = None
+    #: fleet slot this was recorded for, if any
+    slot: Optional[str] = None
+    args: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.monotonic()) - self.start
+
+
+@dataclass
+class Instant:
+    """something which happened at a point in time"""
+
+    name: str
+    category: str
+    time: float
+    parent: Optional[int] = None
+    slot: Optional[str] = None
+    args: Dict[str, Any] = field(default_factory=dict)
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+class Timeline:
+    """records spans and instants from any thread, and writes them out as a
+    JSON timeline, a Chrome trace, or a summary"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.spans: List[Span] = []
+        self.instants: List[Instant] = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+
+    def begin(
+        self,
+        name: str,
+        category: str,
+        parent: Optional[Span] = None,
+        slot: Optional[str] = None,
+        **args,
+    ) -> Span:
+        """start a span, which is ended by setting its end; parent and slot
+        default to the current span and slot"""
+        if parent is None:
+            parent = _current_span.get()
+        new_span = Span(
+            next(self.ids),
+            name,
+            category,
+            time.monotonic(),
+            parent=parent.id if parent is not None else None,
+            slot=slot if slot is not None else thread_slot(),
+            args=args,
+        )
+        with self.lock:
+            self.spans.append(new_span)
+        return new_span
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        """record the with block as a span, which is the parent of spans
+        started within it"""
+        new_span = self.begin(name, category, **args)
+        token = _current_span.set(new_span)
+        try:
+            yield new_span
+        finally:
+            new_span.end = time.monotonic()
+            _current_span.reset(token)
+
+    def instant(
+        self,
+        name: str,
+        category: str,
+        parent: Optional[Span] = None,
+        slot: Optional[str] = None,
+        **args,
+    ):
+        if parent is None:
+            parent = _current_span.get()
+        new_instant = Instant(
+            name,
+            category,
+            time.monotonic(),
+            parent=parent.id if parent is not None else None,
+            slot=slot if slot is not None else thread_slot(),
+            args=args,
+        )
+        with self.lock:
+            self.instants.append(new_instant)
+
+    def to_json(self) -> Dict[str, Any]:
+        """the timeline as a JSON-compatible dict, with times in seconds
+        from the start of the timeline"""
+        with self.lock:
+            spans = list(self.spans)
+            instants = list(self.instants)
+
+        def relative(data, *keys):
+            for key in keys:
+                if data[key] is not None:
+                    data[key] = round(data[key] - self.start, 6)
+            return data
+
+        return dict(
+            spans=[
+                dict(relative(asdict(s), "start", "end"), duration=s.duration)
+                for s in spans
+            ],
+            instants=[relative(asdict(i), "time") for i in instants],
+        )
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """the timeline in Chrome trace event format, which can be loaded
+        into chrome://tracing or Perfetto; each slot is shown as a thread"""
+        with self.lock:
+            spans = list(self.spans)
+            instants = list(self.instants)
+
+        tids: Dict[Optional[str], int] = {}
+
+        def tid(slot):
+            return tids.setdefault(slot, len(tids))
+
+        def us(t):
+            return round((t - self.start) * 1e6)
+
+        events = []
+        for s in spans:
+            events.append(
+                dict(
+                    name=s.name,
+                    cat=s.category,
+                    ph="X",
+                    ts=us(s.start),
+                    dur=round(s.duration * 1e6),
+                    pid=0,
+                    tid=tid(s.slot),
+                    args=s.args,
+                )
+            )
+        for i in instants:
+            events.append(
+                dict(
+                    name=i.name,
+                    cat=i.category,
+                    ph="i",
+                    s="t",
+                    ts=us(i.time),
+                    pid=0,
+                    tid=tid(i.slot),
+                    args=i.args,
+                )
+            )
+        for slot, slot_tid in tids.items():
+            events.append(
+                dict(
+                    name="thread_name",
+                    ph="M",
+                    pid=0,
+                    tid=slot_tid,
+                    args=dict(name=slot if slot is not None else "autoflash"),
+                )
+            )
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def summary(self) -> str:
+        """a summary of the time taken by each step (per slot), broken down
+        by the phases within it, with phases of the same name combined"""
+        with self.lock:
+            spans = list(self.spans)
+
+        children: Dict[Optional[int], List[Span]] = defaultdict(list)
+        for s in spans:
+            children[s.parent].append(s)
+
+        lines = []
+
+        def add_phases(parent: Span, depth: int):
+            by_name: Dict[str, List[Span]] = {}
+            for child in children[parent.id]:
+                by_name.setdefault(child.name, []).append(child)
+            for name, group in by_name.items():
+                total = sum(child.duration for child in group)
+                count = f" (x{len(group)})" if len(group) > 1 else ""
+                lines.append(f"{'  ' * depth}{name}{count}: {total:.2f}s")
+                if len(group) == 1:
+                    add_phases(group[0], depth + 1)
+
+        for s in children[None]:
+            slot = f"[{s.slot}] " if s.slot is not None else ""
+            lines.append(f"{slot}{s.name}: {s.duration:.2f}s")
+            add_phases(s, 1)
+        return "\n".join(lines)
+
+    def write_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=1)
+
+    def write_chrome_trace(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+_current_timeline: ContextVar[Optional[Timeline]] = ContextVar("timeline", default=None)
+
+
+def current_timeline() -> Optional[Timeline]:
+    return _current_timeline.get()
+
+
+@contextmanager
+def recording(timeline: Optional[Timeline]):
+    """record spans in the with block into timeline (or nothing, if None)"""
+    token = _current_timeline.set(timeline)
+    try:
+        yield timeline
+    finally:
+        _current_timeline.reset(token)
+
+
+def span(name: Union[str, Callable[[], str]], category: str, **args):
+    """record the with block as a span in the current timeline, if any
+
+    name may be a function returning the name, so that names which are
+    expensive to format are only made when timing is enabled
+    """
+    timeline = _current_timeline.get()
+    if timeline is None:
+        return nullcontext()
+    return timeline.span(name if isinstance(name, str) else name(), category, **args)
+
+
+def instant(name: str, category: str, **args):
+    """record an instant in the current timeline, if any"""
+    timeline = _current_timeline.get()
+    if timeline is not None:
+        timeline.instant(name, category, **args)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()